@@ -1,6 +1,256 @@
-from django.contrib import admin
-from api_app.models import Patient, Hospital
+"""
+Admin tuned for large Patient and Hospital tables: estimated counts, keyset
+pagination on the primary key, prefix search on lower-cased expression
+indexes, only the listed columns loaded, and bulk deletes that skip
+per-object work.
+"""
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models.functions import Lower
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
+from api_app import audit, events
+from api_app.models import Patient, Hospital, Tombstone, allocate_change_seqs
 
-# Register your models here.
-admin.site.register(Patient)
-admin.site.register(Hospital)
\ No newline at end of file
+# Query string parameter holding the last primary key of the previous page
+CURSOR_VAR = 'after'
+
+# Filtered changelists count at most this many rows
+COUNT_CAP = 10000
+
+# Seconds an estimated table size is cached
+ESTIMATE_TTL = 60
+
+# Rows deleted per transaction by the bulk delete action
+DELETE_CHUNK = 1000
+
+
+def estimated_row_count(model, using='default'):
+    """
+    Approximate row count from the database's statistics, falling back to
+    the highest primary key. Never scans the table.
+    """
+    key = f'admin:estimated_count:{using}:{model._meta.db_table}'
+    estimate = cache.get(key)
+    if estimate is not None:
+        return estimate
+
+    connection = connections[using]
+    table = model._meta.db_table
+    estimate = None
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            estimate = row[0] if row and row[0] >= 0 else None
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s',
+                [table],
+            )
+            row = cursor.fetchone()
+            estimate = row[0] if row else None
+        elif connection.vendor == 'sqlite':
+            # Populated by ANALYZE; the first number of each stat is the row count
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone():
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+                row = cursor.fetchone()
+                estimate = int(row[0].split()[0]) if row else None
+    if estimate is None:
+        highest = model._default_manager.using(using).order_by('-pk').values_list('pk', flat=True).first()
+        estimate = highest or 0
+
+    cache.set(key, estimate, ESTIMATE_TTL)
+    return estimate
+
+
+def prefix_range(queryset, field, prefix):
+    """
+    Case-insensitive prefix match as a range on Lower(field), so it is
+    answered from the Lower() expression index instead of a LIKE scan
+    """
+    prefix = prefix.lower()
+    alias = f'{field}_lower'
+    return queryset.alias(**{alias: Lower(field)}).filter(**{
+        f'{alias}__gte': prefix,
+        f'{alias}__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1),
+    })
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Unfiltered lists use the table size estimate; filtered lists count at
+    most COUNT_CAP rows
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.has_filters():
+            return estimated_row_count(queryset.model, queryset.db)
+        return queryset.order_by()[:COUNT_CAP].count()
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Pages forward with ?after=<pk> (pk__lt on a -pk ordering) instead of
+    OFFSET, so deep pages cost the same as the first one. The ordering is
+    fixed, as the cursor is a primary key: ?o= is ignored.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = request.GET.get(CURSOR_VAR)
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_ordering(self, request, queryset):
+        return ['-pk']
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters)
+        if self.cursor and self.cursor.isdigit():
+            queryset = queryset.filter(pk__lt=int(self.cursor))
+        return queryset
+
+    def get_results(self, request):
+        super().get_results(request)
+        page = list(self.result_list)
+        self.result_list = page
+        self.count_capped = self.result_count >= COUNT_CAP
+        self.next_cursor = page[-1].pk if len(page) >= self.list_per_page else None
+        self.next_url = self.get_query_string({CURSOR_VAR: self.next_cursor}, [PAGE_VAR]) if self.next_cursor else None
+        self.first_url = self.get_query_string(remove=[CURSOR_VAR, PAGE_VAR]) if self.cursor else None
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    """
+    Base admin for large tables. Subclasses set `list_display` (loaded with
+    only()) and `audit_resource`/`resource_name` for the bulk delete action,
+    plus `shard_key_field` when tombstones carry the row's shard key.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 100
+    list_max_show_all = 0
+    list_select_related = False
+    ordering = ('-pk',)
+    # No sortable headers: KeysetChangeList always orders by -pk
+    sortable_by = ()
+    actions = ['bulk_delete']
+    resource_name = None
+    audit_resource = None
+    shard_key_field = None
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if request.resolver_match and request.resolver_match.url_name.endswith('_changelist'):
+            fields = [name for name in self.list_display if name != '__str__' and hasattr(self.model, name)]
+            queryset = queryset.only(*fields)
+        return queryset
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # The stock action loads every object and lists them for confirmation
+        actions.pop('delete_selected', None)
+        return actions
+
+    @admin.action(permissions=['delete'], description='Delete selected %(verbose_name_plural)s')
+    def bulk_delete(self, request, queryset):
+        """
+        Delete in chunks with one set of tombstones per chunk instead of
+        per-object signals, after a count-only confirmation
+        """
+        if request.POST.get('post') != 'yes':
+            return TemplateResponse(request, 'admin/api_app/bulk_delete_confirmation.html', {
+                **self.admin_site.each_context(request),
+                'opts': self.model._meta,
+                'count': queryset.count(),
+                'selected': request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME),
+                'select_across': request.POST.get('select_across', '0'),
+                'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+            })
+
+        using = queryset.db
+        queryset = queryset.order_by('pk').values_list('pk', flat=True)
+        deleted = 0
+        last = None
+        while True:
+            # Walk the selection by primary key so each chunk is an index range
+            page = queryset if last is None else queryset.filter(pk__gt=last)
+            chunk = list(page[:DELETE_CHUNK])
+            if not chunk:
+                break
+            deleted += self._delete_chunk(request, chunk, using)
+            last = chunk[-1]
+        self.message_user(request, f'Deleted {deleted} {self.model._meta.verbose_name_plural}', messages.SUCCESS)
+
+    def _delete_chunk(self, request, ids, using):
+        with transaction.atomic(using=using):
+            groups = {}
+            if self.shard_key_field:
+                groups = dict(self.model._default_manager.using(using).filter(pk__in=ids).values_list('pk', self.shard_key_field))
+            seqs = allocate_change_seqs(len(ids), using)
+            Tombstone.objects.using(using).bulk_create([
+                Tombstone(resource=self.resource_name, object_id=object_id, change_seq=seq, hospital_group=groups.get(object_id))
+                for object_id, seq in zip(ids, seqs)
+            ])
+            # Skips the per-object post_delete handlers; tombstones are written above
+            deleted = self.model._default_manager.using(using).filter(pk__in=ids)._raw_delete(using)
+            if events.has_listeners():
+                transaction.on_commit(
+                    lambda: [events.publish(self.resource_name, 'deleted', object_id) for object_id in ids],
+                    using=using,
+                )
+        if self.audit_resource:
+            audit.record(request.user.get_username(), 'delete', self.audit_resource, ids)
+        return deleted
+
+
+@admin.register(Patient)
+class PatientAdmin(ScalableModelAdmin):
+    list_display = ('patient_id', 'last_name', 'first_name', 'blood', 'updated_at')
+    search_fields = ('last_name',)
+    search_help_text = 'Patient id, last name prefix, or "last, first" prefixes'
+    resource_name = 'patient'
+    audit_resource = 'patient'
+    shard_key_field = 'hospital_group'
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if term.isdigit():
+            return queryset.filter(pk=int(term)), False
+        last, _, first = (part.strip() for part in term.partition(','))
+        if last:
+            queryset = prefix_range(queryset, 'last_name', last)
+        if first:
+            queryset = prefix_range(queryset, 'first_name', first)
+        return queryset, False
+
+
+@admin.register(Hospital)
+class HospitalAdmin(ScalableModelAdmin):
+    list_display = ('hospital_id', 'name', 'phone', 'capacity', 'updated_at')
+    search_fields = ('name',)
+    search_help_text = 'Hospital id or name prefix'
+    resource_name = 'hospital'
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if term.isdigit():
+            return queryset.filter(pk=int(term)), False
+        return prefix_range(queryset, 'name', term), False
@@ -0,0 +1,196 @@
+"""
+Admission control: cap in-flight requests per worker, queue briefly by
+priority and shed the rest with 503 + Retry-After
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+from django.conf import settings
+
+# Priority classes, lowest value served first
+READ = 0
+WRITE = 1
+EXPENSIVE = 2
+
+
+class Waiter:
+    """
+    A queued request, woken from another thread when a slot frees up
+    """
+
+    __slots__ = ('priority', 'admitted', '_event', '_loop', '_future')
+
+    def __init__(self, priority, loop=None):
+        self.priority = priority
+        self.admitted = False
+        self._loop = loop
+        if loop is None:
+            self._event = threading.Event()
+            self._future = None
+        else:
+            self._event = None
+            self._future = loop.create_future()
+
+    def wake(self):
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+
+    async def await_(self, timeout):
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class AdmissionController:
+    """
+    At most `max_in_flight` requests run at once. Others wait up to
+    `queue_timeout` seconds in a queue of `max_queue`, ordered by priority
+    class then arrival. At most `expensive_share` of the slots may hold
+    EXPENSIVE requests, and they get that share of the queue, so logins and
+    bulk writes cannot crowd out reads during a spike; they still run
+    whenever the worker has a free slot within that share.
+    """
+
+    def __init__(self, max_in_flight=16, max_queue=64, queue_timeout=2.0, expensive_share=0.25):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.expensive_share = expensive_share
+        self.in_flight = 0
+        self.expensive_in_flight = 0
+        self.shed = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def _has_slot(self, priority):
+        if self.in_flight >= self.max_in_flight:
+            return False
+        if priority == EXPENSIVE:
+            return self.expensive_in_flight < max(1, int(self.max_in_flight * self.expensive_share))
+        return True
+
+    def _admit(self, priority):
+        self.in_flight += 1
+        if priority == EXPENSIVE:
+            self.expensive_in_flight += 1
+
+    def _queue_limit(self, priority):
+        if priority == EXPENSIVE:
+            return int(self.max_queue * self.expensive_share)
+        return self.max_queue
+
+    def _try_enter(self, priority, loop=None):
+        """
+        Admit immediately (True), shed (False) or return a queued Waiter.
+        Must hold the lock.
+        """
+        waiting_ahead = any(queued[0] <= priority for queued in self._queue)
+        if not waiting_ahead and self._has_slot(priority):
+            self._admit(priority)
+            return True
+        if len(self._queue) >= self._queue_limit(priority):
+            self.shed += 1
+            return False
+        waiter = Waiter(priority, loop)
+        heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+        return waiter
+
+    def _give_up(self, waiter):
+        """
+        Called after a wait; returns whether the waiter was admitted meanwhile
+        """
+        with self._lock:
+            if waiter.admitted:
+                return True
+            self._queue = [queued for queued in self._queue if queued[2] is not waiter]
+            heapq.heapify(self._queue)
+            self.shed += 1
+            self.timeouts += 1
+            return False
+
+    def acquire(self, priority):
+        """
+        Block until admitted; returns False if the request should be shed
+        """
+        with self._lock:
+            result = self._try_enter(priority)
+        if not isinstance(result, Waiter):
+            return result
+        result.wait(self.queue_timeout)
+        return self._give_up(result)
+
+    async def aacquire(self, priority):
+        with self._lock:
+            result = self._try_enter(priority, asyncio.get_running_loop())
+        if not isinstance(result, Waiter):
+            return result
+        await result.await_(self.queue_timeout)
+        return self._give_up(result)
+
+    def release(self, priority):
+        with self._lock:
+            self.in_flight -= 1
+            if priority == EXPENSIVE:
+                self.expensive_in_flight -= 1
+            # Anything behind an EXPENSIVE head is EXPENSIVE too, so stopping
+            # at the first waiter without a slot skips nobody
+            while self._queue:
+                priority, _, waiter = self._queue[0]
+                if not self._has_slot(priority):
+                    break
+                heapq.heappop(self._queue)
+                waiter.admitted = True
+                self._admit(priority)
+                waiter.wake()
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """
+    The worker's controller. Every handler's AdmissionControlMiddleware uses
+    it, so the full and stateless chains share one cap.
+    """
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                config = getattr(settings, 'ADMISSION_CONTROL', {})
+                _controller = AdmissionController(
+                    max_in_flight=config.get('max_in_flight', 16),
+                    max_queue=config.get('max_queue', 64),
+                    queue_timeout=config.get('queue_timeout', 2.0),
+                    expensive_share=config.get('expensive_share', 0.25),
+                )
+    return _controller
+
+
+def classify(request, expensive_paths):
+    """
+    Cheap authenticated reads first, then other requests, then logins,
+    token refreshes and bulk writes
+    """
+    if any(request.path.startswith(path) for path in expensive_paths):
+        return EXPENSIVE
+    if request.method in ('GET', 'HEAD') and 'HTTP_AUTHORIZATION' in request.META:
+        return READ
+    return WRITE
+
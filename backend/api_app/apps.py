@@ -4,3 +4,49 @@ from django.apps import AppConfig
 class ApiAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api_app'
+
+    def ready(self):
+        import logging
+        from django.core import checks
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate
+        from api_app import metrics
+        from api_app.log import BackgroundQueueHandler
+        from api_app import events, signals
+        from api_app import admission, audit, coalesce, fragments, health, memory, sharding
+        import keycloak_provisioning
+
+        def dropped_log_records():
+            handlers = {handler for name in ('', 'django', 'api_app') for handler in logging.getLogger(name).handlers}
+            return sum(handler.dropped for handler in handlers if isinstance(handler, BackgroundQueueHandler))
+
+        # Count queries on every connection, whichever thread opened it
+        connection_created.connect(metrics.install_query_counter)
+        post_migrate.connect(sharding.set_id_ranges, sender=self)
+        checks.register(sharding.check_shard_vendors)
+        metrics.registry.set_gauge('log_records_dropped', 'Log records dropped because the queue was full', dropped_log_records)
+        metrics.registry.set_gauge('event_subscribers', 'Open change-feed connections on this worker', events.broker.subscriber_count)
+        metrics.registry.set_gauge('user_provisioning_pending', 'User syncs waiting for the write-behind flush', keycloak_provisioning.pending_count)
+        metrics.registry.set_gauge('audit_events_pending', 'Audit events waiting to be written', audit.pending_count)
+        metrics.registry.set_gauge('fragment_cache_bytes', 'Bytes held by the list fragment cache', lambda: fragments.get_cache().size)
+        metrics.registry.set_gauge('fragment_cache_hits_total', 'List rows served from cached fragments', lambda: fragments.get_cache().hits, kind='counter')
+        metrics.registry.set_gauge('fragment_cache_misses_total', 'List rows serialized again', lambda: fragments.get_cache().misses, kind='counter')
+        metrics.registry.set_gauge('fragment_cache_evictions_total', 'Fragments evicted to stay under max_bytes', lambda: fragments.get_cache().evictions, kind='counter')
+        metrics.registry.set_gauge('coalesced_requests_total', 'GETs answered with the response of an identical concurrent request', lambda: coalesce.flights.shared, kind='counter')
+        metrics.registry.set_gauge('coalesce_timeouts_total', 'GETs that stopped waiting for an identical request and ran their own', lambda: coalesce.flights.timeouts, kind='counter')
+        metrics.registry.set_gauge('ready', 'Whether the last readiness checks passed', lambda: int(health.monitor.ready))
+        metrics.registry.set_gauge('admission_in_flight', 'Requests being processed by this worker', lambda: admission.get_controller().in_flight)
+        metrics.registry.set_gauge('admission_queue_depth', 'Requests waiting for admission', lambda: admission.get_controller().queue_depth())
+        metrics.registry.set_gauge('admission_shed_total', 'Requests rejected with 503', lambda: admission.get_controller().shed, kind='counter')
+        metrics.registry.set_gauge('admission_timeouts_total', 'Requests shed after waiting in the queue', lambda: admission.get_controller().timeouts, kind='counter')
+
+        # Sizes reported with memory snapshots; tracing itself is opt-in
+        memory.register_cache('fragment_cache_entries', lambda: len(fragments.get_cache()._entries))
+        memory.register_cache('fragment_cache_bytes', lambda: fragments.get_cache().size)
+        memory.register_cache('user_provisioning_synced', keycloak_provisioning.synced_count)
+        memory.register_cache('user_provisioning_pending', keycloak_provisioning.pending_count)
+        memory.register_cache('audit_events_pending', audit.pending_count)
+        memory.register_cache('event_subscribers', events.broker.subscriber_count)
+        memory.register_cache('coalesce_in_flight', coalesce.flights.in_flight)
+        memory.register_cache('metrics_series', metrics.registry.series_count)
+        memory.start()
@@ -0,0 +1,211 @@
+"""
+Hot/cold archival: patients nobody has updated for a while move to the
+ArchivedPatient table, keeping the Patient table and its indexes small.
+Archived rows stay reachable through the API.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction
+from django.http import Http404
+from django.utils import timezone
+from rest_framework.response import Response
+from api_app.models import Patient, ArchivedPatient
+from api_app.query_budget import QueryTracker
+from api_app.sharding import merge_by_pk
+
+# Query parameter asking list endpoints to include archived rows
+INCLUDE_ARCHIVED_PARAM = 'include_archived'
+
+# Actions that restore an archived row to the hot table before running
+RESTORE_ACTIONS = ('update', 'partial_update', 'destroy')
+
+
+def archived_fields():
+    """
+    Columns copied between Patient and ArchivedPatient
+    """
+    return [field.attname for field in Patient._meta.concrete_fields]
+
+
+def archive_cutoff(inactive_days=None):
+    if inactive_days is None:
+        inactive_days = getattr(settings, 'PATIENT_ARCHIVE', {}).get('inactive_days', 3 * 365)
+    return timezone.now() - timedelta(days=inactive_days)
+
+
+def to_patient(archived):
+    """
+    Unsaved Patient carrying an archived row's values, for serializers
+    """
+    return Patient(**{name: getattr(archived, name) for name in archived_fields()})
+
+
+def archive_batches(cutoff, batch_size=None, using='default'):
+    """
+    Walk Patient in primary key order, moving rows last updated before
+    `cutoff` to ArchivedPatient, one transaction per `batch_size` keys.
+    Yields (last primary key, rows archived) after each batch.
+
+    Archived rows are not deleted for delta sync (no tombstone): clients
+    keep them, and a later write restores the row with a new change sequence.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'PATIENT_ARCHIVE', {}).get('batch_size', 1000)
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(Patient._meta.get_field(name).column) for name in archived_fields())
+    pk_column = quote(Patient._meta.pk.column)
+    # Copied with INSERT ... SELECT so rows never round-trip through Python
+    copy_sql = (
+        f'INSERT INTO {quote(ArchivedPatient._meta.db_table)} ({columns}, {quote("archived_at")}) '
+        f'SELECT {columns}, %s FROM {quote(Patient._meta.db_table)} '
+        f'WHERE {pk_column} >= %s AND {pk_column} <= %s AND {quote("updated_at")} < %s'
+    )
+    hot = Patient.objects.using(using)
+    last = None
+    while True:
+        keys = hot.order_by('pk').values_list('pk', flat=True)
+        if last is not None:
+            keys = keys.filter(pk__gt=last)
+        keys = list(keys[:batch_size])
+        if not keys:
+            return
+        first, last = keys[0], keys[-1]
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(copy_sql, [
+                connection.ops.adapt_datetimefield_value(timezone.now()),
+                first, last,
+                connection.ops.adapt_datetimefield_value(cutoff),
+            ])
+            archived = cursor.rowcount
+            # Not a deletion for delta sync or the change feed: skip the post_delete handlers
+            hot.filter(pk__gte=first, pk__lte=last, updated_at__lt=cutoff)._raw_delete(using)
+        yield last, archived
+
+
+def restore(pk, using='default'):
+    """
+    Move an archived patient back to the hot table. Returns the Patient, or
+    None if it is not archived.
+    """
+    with transaction.atomic(using=using):
+        archived = ArchivedPatient.objects.using(using).select_for_update().filter(pk=pk).first()
+        if archived is None:
+            return None
+        patient = to_patient(archived)
+        Patient.objects.using(using).bulk_create([patient])
+        archived.delete(using=using)
+    return patient
+
+
+class ArchiveMixin:
+    """
+    Patient viewset mixin making the archive transparent: retrieve falls
+    back to ArchivedPatient, update and delete restore the row to the hot
+    table first, and list includes archived rows with ?include_archived=1.
+    Query budgets grow by the queries the archive lookups issued.
+    """
+    archive_queries = 0
+
+    def include_archived(self):
+        return self.request.GET.get(INCLUDE_ARCHIVED_PARAM, '').lower() in ('1', 'true', 'yes')
+
+    def get_query_budget(self):
+        budget = super().get_query_budget()
+        return budget + self.archive_queries if budget is not None else None
+
+    def _tracked(self, func, *args):
+        tracker = QueryTracker()
+        with tracker.track():
+            result = func(*args)
+        self.archive_queries += tracker.count
+        return result
+
+    def _archive_databases(self, pk):
+        # Sharded viewsets keep an archive per shard, home shard first
+        return self.lookup_databases(pk) if hasattr(self, 'lookup_databases') else ['default']
+
+    def _find_archived(self, pk):
+        for using in self._archive_databases(pk):
+            archived = ArchivedPatient.objects.using(using).filter(pk=pk).first()
+            if archived is not None:
+                return archived
+        return None
+
+    def _restore(self, pk):
+        return any(restore(pk, using) for using in self._archive_databases(pk))
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404 as missing:
+            pk = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+            try:
+                if self.action == 'retrieve':
+                    archived = self._tracked(self._find_archived, pk)
+                    if archived is not None:
+                        patient = to_patient(archived)
+                        self.check_object_permissions(self.request, patient)
+                        return patient
+                elif self.action in RESTORE_ACTIONS and self._tracked(self._restore, pk):
+                    return self._tracked(super().get_object)
+            except (ValueError, TypeError, ValidationError):
+                pass
+            raise missing
+
+    def _shard_querysets(self, queryset):
+        querysets = self.shard_querysets(queryset) if hasattr(self, 'shard_querysets') else [queryset]
+        # One hot and one archive read per database, the first hot read is budgeted
+        self.archive_queries += 2 * len(querysets) - 1
+        return querysets
+
+    def _archived_queryset(self, queryset):
+        """
+        Archived rows matching the hot `queryset`: same database, shard key
+        and filter backends
+        """
+        archived = ArchivedPatient.objects.using(queryset.db)
+        key = self.shard_key() if hasattr(self, 'shard_key') else None
+        if key is not None:
+            archived = archived.filter(**{self.shard_key_field: key})
+        return self.filter_queryset(archived).order_by('pk')
+
+    def list(self, request, *args, **kwargs):
+        if not self.include_archived():
+            return super().list(request, *args, **kwargs)
+        streams = []
+        for queryset in self._shard_querysets(self.filter_queryset(self.get_queryset()).order_by('pk')):
+            streams.append(queryset.iterator())
+            streams.append(to_patient(row) for row in self._archived_queryset(queryset).iterator())
+        objects = list(merge_by_pk(*streams))
+        page = self.paginate_queryset(objects)
+        if page is not None:
+            objects = page
+        data = self.serialize_list(objects) if hasattr(self, 'serialize_list') else self.get_serializer(objects, many=True).data
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    async def alist_objects(self):
+        if not self.include_archived():
+            return await super().alist_objects()
+        streams = []
+        for queryset in self._shard_querysets(self.filter_queryset(self.get_queryset()).order_by('pk')):
+            streams.append([obj async for obj in queryset.aiterator(chunk_size=self.async_chunk_size)])
+            streams.append([
+                to_patient(row)
+                async for row in self._archived_queryset(queryset).aiterator(chunk_size=self.async_chunk_size)
+            ])
+        return list(merge_by_pk(*streams))
+
+    async def aget_missing_object(self, pk):
+        obj = await super().aget_missing_object(pk)
+        if obj is not None:
+            return obj
+        for using in self._archive_databases(pk):
+            self.archive_queries += 1
+            archived = await ArchivedPatient.objects.using(using).filter(pk=pk).afirst()
+            if archived is not None:
+                return to_patient(archived)
+        return None
@@ -0,0 +1,200 @@
+"""
+Async list and retrieve for viewsets served under ASGI
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from api_app import audit, metrics
+from api_app.authentication import TokenAuthentication
+from api_app.fragments import FragmentJSONRenderer
+from api_app.permissions import has_resource_permission
+from api_app.query_budget import enforce_budget
+
+# Viewset actions with an async implementation, by handler name
+ASYNC_ACTIONS = {'list': 'async_list', 'retrieve': 'async_retrieve'}
+
+
+def _wants_json(request):
+    """
+    The async path only renders JSON; the browsable API and ?format= stay sync
+    """
+    if 'format' in request.GET:
+        return False
+    accept = request.headers.get('Accept', '')
+    return 'text/html' not in accept or 'application/json' in accept
+
+
+class AsyncReadMixin:
+    """
+    Serves GET list/retrieve with the async ORM (aiterator/aget) and async
+    authentication and permission checks when settings.ASYNC_READS is on,
+    producing the same responses as the sync viewset. Other methods, and
+    everything when ASYNC_READS is off, go through the normal DRF view.
+
+    Covers viewsets using TokenAuthentication with HasResourcePermission;
+    AuditMixin and query_budgets are honoured.
+    """
+    async_chunk_size = 2000
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super().as_view(actions, **initkwargs)
+        if not getattr(settings, 'ASYNC_READS', False):
+            return view
+
+        handlers = {
+            method: (action, getattr(cls, ASYNC_ACTIONS[action]))
+            for method, action in actions.items()
+            if action in ASYNC_ACTIONS
+        }
+        if not handlers:
+            return view
+        sync_view = sync_to_async(view)
+
+        async def async_view(request, *args, **kwargs):
+            handler = handlers.get(request.method.lower())
+            if handler is None or not _wants_json(request):
+                return await sync_view(request, *args, **kwargs)
+            action, method = handler
+            self = cls(**initkwargs)
+            self.action_map = actions
+            for http_method, viewset_action in actions.items():
+                setattr(self, http_method, getattr(self, viewset_action))
+            if hasattr(self, 'get') and not hasattr(self, 'head'):
+                self.head = self.get
+            self.action = action
+            self.request = request
+            self.args = args
+            self.kwargs = kwargs
+            self.format_kwarg = None
+            if metrics.current_timer() is not None:
+                return await method(self, request, *args, **kwargs)
+            # Query budgets count through the request timer, so time the
+            # request here when MetricsMiddleware is not installed
+            timer, token = metrics.start_timer()
+            try:
+                return await method(self, request, *args, **kwargs)
+            finally:
+                metrics.stop_timer(token)
+
+        # Same attributes DRF sets, so routers, batch and schema tools still work
+        async_view.cls = cls
+        async_view.initkwargs = view.initkwargs
+        async_view.actions = actions
+        async_view.csrf_exempt = True
+        async_view.sync_view = view
+        return async_view
+
+    async def async_list(self, request, *args, **kwargs):
+        denied = await self._aauthorize(request)
+        if denied:
+            return denied
+        # Provisioning on first sight is not part of the budget
+        queries = self._query_count()
+        _, data, content = await self._acoalesce(request, self._alist_content)
+        return await self._afinish(request, data, queries, content)
+
+    async def async_retrieve(self, request, *args, **kwargs):
+        denied = await self._aauthorize(request)
+        if denied:
+            return denied
+        # Provisioning on first sight is not part of the budget
+        queries = self._query_count()
+        status, data, content = await self._acoalesce(request, self._aretrieve_content)
+        if status != 200:
+            return self._render_content(content, status)
+        return await self._afinish(request, data, queries, content)
+
+    async def _alist_content(self):
+        objects = await self.alist_objects()
+        if hasattr(self, 'serialize_list'):
+            data = self.serialize_list(objects)
+        else:
+            data = self.get_serializer(objects, many=True).data
+        return 200, data, FragmentJSONRenderer().render(data)
+
+    async def _aretrieve_content(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup = self.kwargs[lookup_url_kwarg]
+        try:
+            obj = await queryset.aget(**{self.lookup_field: lookup})
+        except queryset.model.DoesNotExist:
+            obj = await self.aget_missing_object(lookup)
+            if obj is None:
+                return self._error_content({'detail': f'No {queryset.model._meta.object_name} matches the given query.'}, 404)
+        except (ValueError, TypeError, ValidationError):
+            return self._error_content({'detail': 'Not found.'}, 404)
+        data = self.get_serializer(obj).data
+        return 200, data, FragmentJSONRenderer().render(data)
+
+    def _error_content(self, data, status):
+        return status, data, FragmentJSONRenderer().render(data)
+
+    async def _acoalesce(self, request, compute):
+        """
+        (status, data, rendered body) from `compute`; CoalesceMixin shares
+        it between identical concurrent requests
+        """
+        return await compute()
+
+    async def alist_objects(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        return [obj async for obj in queryset.aiterator(chunk_size=self.async_chunk_size)]
+
+    async def aget_missing_object(self, lookup):
+        """
+        Object to return when the lookup matches no row, or None for a 404
+        """
+        return None
+
+    async def _aauthorize(self, request):
+        """
+        Return an error response, or None once the request may proceed
+        """
+        result = await TokenAuthentication().aauthenticate(request)
+        if result is None:
+            response = self._render({'detail': 'Authentication credentials were not provided.'}, 401)
+            response['WWW-Authenticate'] = TokenAuthentication().authenticate_header(request)
+            return response
+        request.user, request.auth = result
+
+        with metrics.phase('permission'):
+            self.get_permissions()
+            required_permission = getattr(self, 'required_permission', None)
+            allowed = not required_permission or has_resource_permission(request.token_payload, required_permission)
+        if not allowed:
+            return self._render({'detail': 'You do not have permission to perform this action.'}, 403)
+        return None
+
+    async def _afinish(self, request, data, queries, content):
+        self._check_query_budget(queries)
+        if getattr(self, 'audit_resource', None):
+            await audit.arecord(request.user.get_username(), audit.AUDITED_ACTIONS[self.action], self.audit_resource, self.audited_ids(data))
+        return self._render_content(content)
+
+    def _query_count(self):
+        timer = metrics.current_timer()
+        return timer.queries if timer else None
+
+    def _check_query_budget(self, queries_before):
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', True):
+            return
+        budget = self.get_query_budget() if hasattr(self, 'get_query_budget') else None
+        queries = self._query_count()
+        if budget is None or queries is None or queries_before is None:
+            return
+        count = queries - queries_before
+        if count > budget:
+            enforce_budget(f'{self.__class__.__name__}.{self.action} issued {count} queries (budget {budget})')
+
+    def _render(self, data, status=200):
+        return self._render_content(FragmentJSONRenderer().render(data), status)
+
+    def _render_content(self, content, status=200):
+        response = HttpResponse(content, status=status, content_type='application/json')
+        response['Allow'] = ', '.join(self.allowed_methods)
+        patch_vary_headers(response, ('Accept',))
+        return response
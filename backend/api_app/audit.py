@@ -0,0 +1,314 @@
+"""
+Append-only audit trail of patient record access.
+
+Viewsets record events on the request thread into an in-memory buffer; a
+background thread writes them out in batches, either as bulk inserts into
+AuditRecord or as JSON lines in rotating append-only files. At most one flush
+interval of events is lost if the process dies.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Viewset actions that are audited, and the action name recorded for each
+AUDITED_ACTIONS = {
+    'list': 'list',
+    'changes': 'list',
+    'retrieve': 'retrieve',
+    'create': 'create',
+    'update': 'update',
+    'partial_update': 'update',
+    'destroy': 'delete',
+}
+
+
+def id_ranges(object_ids):
+    """
+    Distinct ids as sorted, inclusive [first, last] runs
+    """
+    ranges = []
+    for object_id in sorted(set(object_ids)):
+        if ranges and object_id == ranges[-1][1] + 1:
+            ranges[-1][1] = object_id
+        else:
+            ranges.append([object_id, object_id])
+    return ranges
+
+
+class DatabaseSink:
+    """
+    Bulk insert events into AuditRecord, one row per event: a single object
+    id as object_id, several as id ranges
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+    def write(self, events):
+        from api_app.models import AuditRecord
+        close_old_connections()
+        records = []
+        for actor, action, resource, object_ids, timestamp in events:
+            record = AuditRecord(actor=actor, action=action, resource=resource, timestamp=timestamp)
+            ranges = id_ranges(object_id for object_id in object_ids or () if object_id is not None)
+            if len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+                record.object_id = ranges[0][0]
+            elif ranges:
+                record.object_ranges = ranges
+                record.first_object_id, record.last_object_id = ranges[0][0], ranges[-1][1]
+            records.append(record)
+        AuditRecord.objects.bulk_create(records, batch_size=self.batch_size)
+
+    def close(self):
+        connection.close()
+
+
+class FileSink:
+    """
+    Append events as JSON lines to `path`. When the file grows past
+    `max_bytes` it is renamed with a timestamp suffix and a new one started;
+    existing files are never rewritten.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, fsync=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.stream = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.stream = open(self.path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        self.stream.close()
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S')}.{os.getpid()}"
+        target, n = f'{self.path}.{stamp}', 0
+        while os.path.exists(target):
+            n += 1
+            target = f'{self.path}.{stamp}.{n}'
+        os.rename(self.path, target)
+        self._open()
+
+    def write(self, events):
+        if self.stream is None:
+            self._open()
+        lines = ''.join(
+            json.dumps({
+                'actor': actor,
+                'action': action,
+                'resource': resource,
+                'object_ids': object_ids,
+                'timestamp': timestamp.isoformat(),
+            }) + '\n'
+            for actor, action, resource, object_ids, timestamp in events
+        )
+        self.stream.write(lines)
+        self.stream.flush()
+        if self.fsync:
+            os.fsync(self.stream.fileno())
+        if self.stream.tell() >= self.max_bytes:
+            self._rotate()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class AuditBuffer:
+    """
+    In-memory buffer of audit events flushed by a background thread every
+    `flush_interval` seconds or once `batch_size` events are waiting. When
+    `max_pending` events are waiting the recording request flushes inline
+    instead of dropping events.
+    """
+
+    def __init__(self, sink, batch_size=500, flush_interval=1.0, max_pending=50000):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.written = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Stop the worker after it has written everything buffered
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def restart_after_fork(self):
+        self.pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.start()
+
+    def record(self, actor, action, resource, object_ids):
+        if self._append(actor, action, resource, object_ids):
+            self.flush()
+
+    async def arecord(self, actor, action, resource, object_ids):
+        if self._append(actor, action, resource, object_ids):
+            await sync_to_async(self.flush)()
+
+    def _append(self, actor, action, resource, object_ids):
+        """
+        Buffer one event; returns True when the caller must flush inline
+        """
+        event = (actor, action, resource, object_ids, timezone.now())
+        with self._lock:
+            self.pending.append(event)
+            size = len(self.pending)
+        if size >= self.max_pending or not self.running:
+            return True
+        if size >= self.batch_size:
+            self._wakeup.set()
+        return False
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+        self.sink.close()
+
+    def flush(self):
+        """
+        Write everything buffered. Returns how many events were written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self.pending = self.pending, []
+            if not events:
+                return 0
+            try:
+                self.sink.write(events)
+            except Exception:
+                logger.exception("Audit flush failed", extra={'events': len(events)})
+                self.failed += len(events)
+                # Put the events back in front of anything recorded meanwhile
+                with self._lock:
+                    self.pending[:0] = events[-self.max_pending:]
+                return 0
+            self.written += len(events)
+            return len(events)
+
+
+def _create_buffer():
+    config = getattr(settings, 'AUDIT_LOG', {})
+    if config.get('sink', 'database') == 'file':
+        sink = FileSink(config['path'], max_bytes=config.get('max_bytes', 100 * 1024 * 1024), fsync=config.get('fsync', True))
+    else:
+        sink = DatabaseSink()
+    buffer = AuditBuffer(
+        sink,
+        batch_size=config.get('batch_size', 500),
+        flush_interval=config.get('flush_interval', 1.0),
+        max_pending=config.get('max_pending', 50000),
+    )
+    if config.get('background', True):
+        buffer.start()
+        atexit.register(buffer.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=buffer.restart_after_fork)
+    return buffer
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = _create_buffer()
+    return _buffer
+
+
+def pending_count():
+    return len(_buffer.pending) if _buffer is not None else 0
+
+
+def record(actor, action, resource, object_ids):
+    """
+    Buffer one audit event; `object_ids` lists every row the action touched
+    """
+    if not getattr(settings, 'AUDIT_LOG', {}).get('enabled', True):
+        return
+    get_buffer().record(actor, action, resource, object_ids)
+
+
+async def arecord(actor, action, resource, object_ids):
+    """
+    Async counterpart of record()
+    """
+    if not getattr(settings, 'AUDIT_LOG', {}).get('enabled', True):
+        return
+    await get_buffer().arecord(actor, action, resource, object_ids)
+
+
+class AuditMixin:
+    """
+    Records every successful audited action of a viewset with the acting
+    user and the ids of the objects returned or changed.
+    """
+    audit_resource = None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        action = AUDITED_ACTIONS.get(self.action)
+        if action and self.audit_resource and response.status_code < 400:
+            record(request.user.get_username(), action, self.audit_resource, self.audited_ids(response.data))
+        return response
+
+    def audited_ids(self, data):
+        """
+        Ids of the objects in a successful response to the current action
+        """
+        pk_name = self.get_queryset().model._meta.pk.name
+        if self.action in ('list', 'changes'):
+            if hasattr(data, 'ids'):
+                # FragmentList responses carry their object ids
+                return list(data.ids)
+            rows = data.get('results', []) if isinstance(data, dict) else data
+            ids = [row[pk_name] for row in rows if pk_name in row]
+            if isinstance(data, dict):
+                ids += data.get('deleted', [])
+            return ids
+        if self.action == 'create':
+            return [data.get(pk_name)]
+        return [int(self.kwargs[self.lookup_url_kwarg or self.lookup_field])]
@@ -3,16 +3,83 @@ Custom authentication for token-based auth
 """
 from rest_framework import authentication
 from rest_framework import exceptions
-from django.contrib.auth.models import User
-import jwt
-from keycloak_config import KEYCLOAK_CONFIG
+from keycloak_auth import verify_token
+from keycloak_provisioning import provision_user, aprovision_user
+from keycloak_session import claims_digest
+from api_app import metrics
 
 class TokenAuthentication(authentication.BaseAuthentication):
     """
-    Custom token authentication that validates JWT tokens from Keycloak
+    Custom token authentication that validates JWT tokens from Keycloak.
+    Tokens are verified against the realm's signing keys here, unless
+    KeycloakMiddleware already verified the same token for this request.
     """
     
     def authenticate(self, request):
+        with metrics.phase('auth'):
+            return self._authenticate(request)
+
+    async def aauthenticate(self, request):
+        """
+        Async counterpart of authenticate() for the ASGI read path
+        """
+        with metrics.phase('auth'):
+            preauthenticated = self._preauthenticated(request)
+            if preauthenticated:
+                return preauthenticated
+
+            decoded = self._decode(request)
+            if decoded is None:
+                return None
+            token, token_payload, digest = decoded
+
+            try:
+                user = getattr(request, 'keycloak_user', None)
+                if user is None or user.username != digest['username']:
+                    user = await aprovision_user(digest)
+            except Exception as e:
+                return None
+
+            request.token_payload = token_payload
+            return (user, token)
+
+    def _authenticate(self, request):
+        preauthenticated = self._preauthenticated(request)
+        if preauthenticated:
+            return preauthenticated
+
+        decoded = self._decode(request)
+        if decoded is None:
+            return None
+        token, token_payload, digest = decoded
+
+        try:
+            # Reuse the user the middleware already resolved for this token
+            user = getattr(request, 'keycloak_user', None)
+            if user is None or user.username != digest['username']:
+                user = provision_user(digest)
+        except Exception as e:
+            return None
+
+        # Store token info in request for permission checks
+        request.token_payload = token_payload
+
+        return (user, token)
+
+    def _preauthenticated(self, request):
+        # Sub-requests of a batch reuse the batch's authentication
+        preauthenticated = getattr(request, 'preauthenticated', None)
+        if not preauthenticated:
+            return None
+        user, token, token_payload = preauthenticated
+        request.token_payload = token_payload
+        return (user, token)
+
+    def _decode(self, request):
+        """
+        Return (token, payload, claims digest) for the request's bearer
+        token, or None when there is no valid token
+        """
         auth_header = request.META.get('HTTP_AUTHORIZATION')
         if not auth_header:
             return None
@@ -24,34 +91,20 @@ class TokenAuthentication(authentication.BaseAuthentication):
                 return None
                 
             token = parts[1]
-            
-            # Decode token without verification to get user info
-            token_payload = jwt.decode(token, options={"verify_signature": False})
-            
-            # Extract user information
-            username = token_payload.get('preferred_username')
-            if not username:
-                return None
-                
-            # Get or create Django user
-            user, created = User.objects.get_or_create(
-                username=username,
-                defaults={
-                    'email': token_payload.get('email', ''),
-                    'first_name': token_payload.get('given_name', ''),
-                    'last_name': token_payload.get('family_name', ''),
-                    'is_staff': 'admin' in token_payload.get('realm_access', {}).get('roles', []),
-                    'is_superuser': 'admin' in token_payload.get('realm_access', {}).get('roles', [])
-                }
-            )
-            
-            # Store token info in request for permission checks
-            request.token_payload = token_payload
-            
-            return (user, token)
-            
+
+            verified = getattr(request, 'verified_token', None)
+            if verified and verified[0] == token:
+                token_payload = verified[1]
+            else:
+                # Signature, expiry and audience; signing keys are cached
+                token_payload = verify_token(token)
         except Exception as e:
             return None
+
+        digest = claims_digest(token_payload)
+        if not digest['username']:
+            return None
+        return (token, token_payload, digest)
     
     def authenticate_header(self, request):
-        return 'Bearer realm="api"' 
\ No newline at end of file
+        return 'Bearer realm="api"'
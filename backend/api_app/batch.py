@@ -0,0 +1,131 @@
+"""
+Batch endpoint: run several api_app router requests in one round trip
+"""
+import contextvars
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections
+from django.urls import resolve, Resolver404
+from rest_framework import status
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from api_app.authentication import TokenAuthentication
+
+SAFE_METHODS = ('GET', 'HEAD')
+ALLOWED_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+# Request META copied from the batch request into every sub-request
+INHERITED_META = ('SERVER_NAME', 'SERVER_PORT', 'REMOTE_ADDR', 'HTTP_HOST', 'HTTP_X_FORWARDED_FOR', 'wsgi.url_scheme')
+
+
+def _router_viewsets():
+    from api_app.urls import router
+    return {viewset for prefix, viewset, basename in router.registry}
+
+
+def _build_request(parent, method, path, body):
+    url = urlsplit(path)
+    payload = b'' if body is None else json.dumps(body).encode()
+    environ = {key: parent.META[key] for key in INHERITED_META if key in parent.META}
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(payload)),
+        'wsgi.input': io.BytesIO(payload),
+    })
+    environ.setdefault('wsgi.url_scheme', 'http')
+    environ.setdefault('SERVER_NAME', 'localhost')
+    environ.setdefault('SERVER_PORT', '80')
+    request = WSGIRequest(environ)
+    # Reuse the batch's authentication instead of decoding the token again
+    request.preauthenticated = parent.preauthenticated
+    return request
+
+
+def _run(parent, spec, viewsets):
+    method = str(spec.get('method', 'GET')).upper()
+    path = spec.get('path')
+    if method not in ALLOWED_METHODS or not isinstance(path, str):
+        return {'status': status.HTTP_400_BAD_REQUEST, 'body': {'error': 'Each request needs a method and a path'}}
+
+    try:
+        match = resolve(urlsplit(path).path)
+    except Resolver404:
+        match = None
+    if match is None or getattr(match.func, 'cls', None) not in viewsets:
+        return {'status': status.HTTP_404_NOT_FOUND, 'body': {'error': f'{path} is not a batchable endpoint'}}
+
+    request = _build_request(parent, method, path, spec.get('body'))
+    request.resolver_match = match
+    # Under ASGI the router view may be async; sub-requests use its sync form
+    view = getattr(match.func, 'sync_view', match.func)
+    response = view(request, *match.args, **match.kwargs)
+    if hasattr(response, 'data'):
+        body = response.data
+    else:
+        body = response.content.decode() or None
+    return {'status': response.status_code, 'body': body}
+
+
+def _run_in_thread(context, parent, spec, viewsets):
+    try:
+        return context.run(_run, parent, spec, viewsets)
+    finally:
+        # Worker threads open their own DB connections
+        connections.close_all()
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def batch(request):
+    """
+    Execute {"requests": [{"method", "path", "body"?}, ...]} against the
+    api_app router with a single authentication pass. Runs of consecutive
+    GETs execute in parallel; writes run in order and act as barriers.
+    Returns {"responses": [{"status", "body"}, ...]} in request order.
+    """
+    specs = request.data.get('requests') if isinstance(request.data, dict) else None
+    max_requests = getattr(settings, 'BATCH_MAX_REQUESTS', 20)
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        return Response({'error': 'requests must be a non-empty list of objects'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(specs) > max_requests:
+        return Response({'error': f'At most {max_requests} requests per batch'}, status=status.HTTP_400_BAD_REQUEST)
+
+    parent = request._request
+    parent.preauthenticated = (request.user, request.auth, request.token_payload)
+    viewsets = _router_viewsets()
+    responses = [None] * len(specs)
+    max_workers = getattr(settings, 'BATCH_MAX_WORKERS', 4)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        index = 0
+        while index < len(specs):
+            method = str(specs[index].get('method', 'GET')).upper()
+            if method not in SAFE_METHODS:
+                responses[index] = _run(parent, specs[index], viewsets)
+                index += 1
+                continue
+            # Collect the run of consecutive reads and fan it out
+            end = index
+            while end < len(specs) and str(specs[end].get('method', 'GET')).upper() in SAFE_METHODS:
+                end += 1
+            if end - index == 1:
+                responses[index] = _run(parent, specs[index], viewsets)
+            else:
+                futures = [
+                    pool.submit(_run_in_thread, contextvars.copy_context(), parent, specs[i], viewsets)
+                    for i in range(index, end)
+                ]
+                for i, future in zip(range(index, end), futures):
+                    responses[i] = future.result()
+            index = end
+
+    return Response({'responses': responses})
@@ -0,0 +1,186 @@
+"""
+Single-flight for read endpoints: identical GETs arriving while one is
+being computed wait for it and share its rendered body instead of running
+the same queries and serialization again
+"""
+import asyncio
+import threading
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from api_app.permissions import PERMISSION_TABLE
+
+# Result of a flight its waiters may not reuse (an error or a non-200 response)
+NOT_SHARED = object()
+
+
+def enabled():
+    return getattr(settings, 'COALESCE', {}).get('enabled', True)
+
+
+def max_wait():
+    return getattr(settings, 'COALESCE', {}).get('max_wait', 5.0)
+
+
+class _Flight:
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = NOT_SHARED
+
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time. Callers arriving while it runs
+    wait up to `timeout` seconds for its result; after that, or when the
+    result is not shareable, they compute on their own. Results are not kept
+    once the flight lands.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self.timeouts = 0
+        self._flights = {}
+        self._async_flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout, shareable=lambda result: True):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if leader:
+            try:
+                result = func()
+                if shareable(result):
+                    flight.result = result
+                return result
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        if not flight.done.wait(timeout):
+            self.timeouts += 1
+            return func()
+        if flight.result is NOT_SHARED:
+            return func()
+        self.shared += 1
+        return flight.result
+
+    async def ado(self, key, func, timeout, shareable=lambda result: True):
+        """
+        do() for coroutines of one event loop
+        """
+        future = self._async_flights.get(key)
+        if future is None:
+            future = self._async_flights[key] = asyncio.get_running_loop().create_future()
+            result = NOT_SHARED
+            try:
+                result = await func()
+                return result
+            finally:
+                del self._async_flights[key]
+                future.set_result(result if result is not NOT_SHARED and shareable(result) else NOT_SHARED)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return await func()
+        if result is NOT_SHARED:
+            return await func()
+        self.shared += 1
+        return result
+
+    def in_flight(self):
+        return len(self._flights) + len(self._async_flights)
+
+
+flights = SingleFlight()
+
+
+class CoalesceMixin:
+    """
+    Viewset mixin coalescing concurrent identical list and retrieve GETs.
+    Requests match on path, query string, media type and permission, and
+    on what the caller's roles allow on the resource (permission_scope());
+    each one is still authenticated, authorized and audited on its own, and
+    only the query, serialization and rendering are shared. Rendering for several
+    users means the response must not depend on who asked, and only JSON
+    responses are shared.
+    """
+    coalesce_actions = ('list', 'retrieve')
+
+    def coalesce_key(self, request):
+        """
+        Key identifying requests that may share a response, or None
+        """
+        if not enabled() or request.method != 'GET' or self.action not in self.coalesce_actions:
+            return None
+        renderer = getattr(request, 'accepted_renderer', None)
+        if renderer is not None and not isinstance(renderer, JSONRenderer):
+            return None
+        return (
+            self.__class__.__qualname__,
+            request.get_full_path(),
+            getattr(request, 'accepted_media_type', 'application/json'),
+            tuple(permission.__qualname__ for permission in self.permission_classes),
+            getattr(self, 'required_permission', None),
+            self.permission_scope(request),
+        )
+
+    def permission_scope(self, request):
+        """
+        Actions the caller's roles allow on the view's resource, so callers
+        with different permissions never share a response
+        """
+        required_permission = getattr(self, 'required_permission', None)
+        if not required_permission:
+            return None
+        resource = required_permission.split(':')[0]
+        roles = getattr(request, 'token_payload', {}).get('realm_access', {}).get('roles', [])
+        return tuple(sorted(
+            action for (granted_resource, action), allowed in PERMISSION_TABLE.items()
+            if granted_resource == resource and not allowed.isdisjoint(roles)
+        ))
+
+    def _coalesced(self, handler, request, *args, **kwargs):
+        key = self.coalesce_key(request)
+        if key is None:
+            return handler(request, *args, **kwargs)
+
+        own = []
+
+        def compute():
+            response = handler(request, *args, **kwargs)
+            own.append(response)
+            if not isinstance(response, Response) or response.status_code != 200:
+                return None
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = self.get_renderer_context()
+            response.render()
+            return response.data, response.content, response['Content-Type']
+
+        shared = flights.do(key, compute, max_wait(), lambda result: result is not None)
+        if own:
+            return own[0]
+        # Computed for another request: copy its body
+        data, content, content_type = shared
+        response = Response(data)
+        response.content = content
+        response['Content-Type'] = content_type
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._coalesced(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._coalesced(super().retrieve, request, *args, **kwargs)
+
+    async def _acoalesce(self, request, compute):
+        key = self.coalesce_key(request)
+        if key is None:
+            return await compute()
+        return await flights.ado(key, compute, max_wait(), lambda result: result[0] == 200)
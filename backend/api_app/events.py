@@ -0,0 +1,169 @@
+"""
+Change events for patients and hospitals, fanned out to Server-Sent Events subscribers
+"""
+import asyncio
+import itertools
+import json
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Events buffered per subscriber before it is considered too slow and dropped
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+class Subscriber:
+    """
+    One SSE connection: an asyncio queue bound to the loop serving it
+    """
+
+    def __init__(self, resources, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.resources = frozenset(resources)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def offer(self, event):
+        # Runs on the subscriber's loop
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class Broker:
+    """
+    In-process fan-out of events to the subscribers of this worker
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._sequence = itertools.count(1)
+
+    def subscribe(self, resources):
+        subscriber = Subscriber(resources)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def deliver(self, event):
+        """
+        Hand an event to every subscriber allowed to see its resource.
+        Safe to call from any thread.
+        """
+        event = dict(event, seq=next(self._sequence))
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if event['resource'] in subscriber.resources:
+                try:
+                    subscriber.loop.call_soon_threadsafe(subscriber.offer, event)
+                except RuntimeError:
+                    # Loop already closed; the connection is gone
+                    self.unsubscribe(subscriber)
+
+
+class LocalBackend:
+    """
+    Delivers events to this worker's broker only
+    """
+
+    def __init__(self, broker, **options):
+        self.broker = broker
+
+    def publish(self, event):
+        self.broker.deliver(event)
+
+
+class RedisBackend:
+    """
+    Publishes events on a Redis channel that every worker listens to, so
+    subscribers see changes made through any worker. Requires the `redis` package.
+    """
+
+    def __init__(self, broker, url='redis://localhost:6379/0', channel='api_app.events'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('RedisBackend requires the "redis" package')
+        self.broker = broker
+        self.channel = channel
+        self.client = redis.Redis.from_url(url)
+        self._listener = None
+
+    def publish(self, event):
+        self.client.publish(self.channel, json.dumps(event, default=str))
+
+    def start(self):
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, name='event-listener', daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            try:
+                self.broker.deliver(json.loads(message['data']))
+            except Exception as e:
+                logger.error("Event delivery failed", extra={'error': str(e)})
+
+
+broker = Broker()
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = getattr(settings, 'EVENTS_BACKEND', {})
+                backend_class = import_string(config.get('BACKEND', 'api_app.events.LocalBackend'))
+                backend = backend_class(broker, **config.get('OPTIONS', {}))
+                if hasattr(backend, 'start'):
+                    backend.start()
+                _backend = backend
+    return _backend
+
+
+def has_listeners():
+    """
+    False when no subscriber anywhere can receive events, so publishing can be skipped
+    """
+    backend = get_backend()
+    return not isinstance(backend, LocalBackend) or broker.subscriber_count() > 0
+
+
+def publish(resource, action, object_id, data=None):
+    """
+    Publish a change event, e.g. publish('patient', 'updated', 42, {...})
+    """
+    try:
+        get_backend().publish({
+            'resource': resource,
+            'action': action,
+            'id': object_id,
+            'data': data,
+        })
+    except Exception as e:
+        # Never fail the write because the feed is unavailable
+        logger.error("Event publish failed", extra={'resource': resource, 'error': str(e)})
+
+
+def format_sse(event):
+    payload = json.dumps({'id': event['id'], 'data': event['data']}, default=str)
+    return f"id: {event['seq']}\nevent: {event['resource']}.{event['action']}\ndata: {payload}\n\n"
@@ -0,0 +1,193 @@
+"""
+Per-object JSON fragment cache: list responses are stitched from each
+object's rendered JSON, cached by primary key and version, so only rows
+that changed are serialized again
+"""
+import json
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import QuerySet
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from api_app import metrics
+
+# Above this many misses, re-read the whole list instead of filtering by id
+MAX_MISS_IDS = 500
+
+# Bookkeeping per cached fragment (key, version, OrderedDict node), in bytes
+ENTRY_OVERHEAD = 200
+
+
+class FragmentCache:
+    """
+    LRU of rendered fragments, bounded by the bytes they hold. Holds one
+    version per object: a newer version replaces the old one.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys_versions):
+        """
+        {key: fragment} for every (key, version) whose cached version matches
+        """
+        found = {}
+        with self._lock:
+            for key, version in keys_versions:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[1]
+            self.hits += len(found)
+            self.misses += len(keys_versions) - len(found)
+        return found
+
+    def set_many(self, items):
+        """
+        Store (key, version, fragment) items, evicting least recently used
+        """
+        with self._lock:
+            for key, version, fragment in items:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.size -= len(old[1]) + ENTRY_OVERHEAD
+                self._entries[key] = (version, fragment)
+                self.size += len(fragment) + ENTRY_OVERHEAD
+            while self.size > self.max_bytes and self._entries:
+                _, (_, fragment) = self._entries.popitem(last=False)
+                self.size -= len(fragment) + ENTRY_OVERHEAD
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = getattr(settings, 'FRAGMENT_CACHE', {})
+                _cache = FragmentCache(config.get('max_bytes', 64 * 1024 * 1024))
+    return _cache
+
+
+def enabled():
+    return getattr(settings, 'FRAGMENT_CACHE', {}).get('enabled', True)
+
+
+class FragmentList:
+    """
+    Response data made of already rendered JSON objects, in order.
+    FragmentJSONRenderer joins them; other renderers see decoded dicts.
+    """
+
+    def __init__(self, ids, fragments):
+        self.ids = ids
+        self.fragments = fragments
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        # Used by DRF's JSON encoder when a FragmentList is nested in other data
+        return [json.loads(fragment) for fragment in self.fragments]
+
+
+class FragmentJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that writes a FragmentList as a JSON array of its fragments
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, FragmentList):
+            return b'[' + b','.join(data.fragments) + b']'
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+class FragmentCacheMixin:
+    """
+    Viewset mixin building JSON list responses from cached per-object
+    fragments. An object's fragment is reused while its
+    `fragment_version_fields` are unchanged, so the serializer must depend
+    on the object alone (not on the request).
+
+    For a queryset, the list first reads only primary keys and versions,
+    then loads full rows for the misses.
+    """
+    fragment_version_fields = ('change_seq', 'updated_at')
+    renderer_classes = [
+        FragmentJSONRenderer if renderer is JSONRenderer else renderer
+        for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+    ]
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serialize_list(page))
+        return Response(self.serialize_list(queryset))
+
+    def serialize_list(self, objects):
+        """
+        FragmentList for JSON responses, serializer data otherwise
+        """
+        renderer = getattr(self.request, 'accepted_renderer', None)
+        if not enabled() or (renderer is not None and not isinstance(renderer, FragmentJSONRenderer)):
+            return self.get_serializer(objects, many=True).data
+
+        cache = get_cache()
+        prefix = self.get_serializer_class().__qualname__
+        if isinstance(objects, QuerySet):
+            rows = list(objects.values_list('pk', *self.fragment_version_fields))
+            keys = [((prefix, row[0]), row[1:]) for row in rows]
+            found = cache.get_many(keys)
+            loaded = self._load(objects, [key[1] for key, _ in keys if key not in found])
+        else:
+            objects = list(objects)
+            keys = [((prefix, obj.pk), self._version(obj)) for obj in objects]
+            found = cache.get_many(keys)
+            loaded = [obj for obj, (key, _) in zip(objects, keys) if key not in found]
+
+        if loaded:
+            with metrics.phase('serialize'):
+                data = self.get_serializer(loaded, many=True).data
+                renderer = FragmentJSONRenderer()
+                rendered = [
+                    ((prefix, obj.pk), self._version(obj), renderer.render(item))
+                    for obj, item in zip(loaded, data)
+                ]
+            cache.set_many(rendered)
+            found.update((key, fragment) for key, _, fragment in rendered)
+        # A row deleted between the two queries has no fragment and is left out
+        keys = [key for key, _ in keys if key in found]
+        return FragmentList([key[1] for key in keys], [found[key] for key in keys])
+
+    def _version(self, obj):
+        return tuple(getattr(obj, field) for field in self.fragment_version_fields)
+
+    def _load(self, queryset, ids):
+        if not ids:
+            return []
+        # Fragments are matched by key, so skip the list's ordering
+        if len(ids) <= MAX_MISS_IDS:
+            return list(queryset.filter(pk__in=ids).order_by())
+        wanted = set(ids)
+        return [obj for obj in queryset.order_by() if obj.pk in wanted]
@@ -0,0 +1,200 @@
+"""
+Liveness and readiness probes answered before Django's middleware and URL
+resolution. Readiness reports dependency checks (databases, signing keys,
+Keycloak) that a background thread runs on a schedule, so a probe only
+reads cached results and never touches the database or the IdP itself.
+"""
+import json
+import os
+import threading
+import time
+import requests
+from django.conf import settings
+from django.db import connections
+import logging
+
+logger = logging.getLogger(__name__)
+
+_JSON_HEADERS = [('Content-Type', 'application/json'), ('Cache-Control', 'no-store')]
+
+
+def _config():
+    return getattr(settings, 'HEALTH_CHECKS', {})
+
+
+def check_databases():
+    """
+    SELECT 1 on every configured database
+    """
+    failed = []
+    for connection in connections.all():
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except Exception as e:
+            failed.append(f'{connection.alias}: {e}')
+            # Reconnect on the next round
+            connection.close()
+    return not failed, '; '.join(failed) or f'{len(connections.all())} ok'
+
+
+def check_signing_keys():
+    """
+    Realm signing keys are loaded and younger than jwks_max_age. Refreshes
+    them when their TTL has run out, as token checks would.
+    """
+    from keycloak_config import get_signing_keys, signing_keys_age
+
+    try:
+        get_signing_keys()
+    except Exception as e:
+        logger.warning(f"Signing key refresh failed: {e}")
+    age = signing_keys_age()
+    if age is None:
+        return False, 'never fetched'
+    return age < _config().get('jwks_max_age', 7200), f'{age:.0f}s old'
+
+
+def check_keycloak():
+    """
+    The realm endpoint answers
+    """
+    from keycloak_config import KEYCLOAK_CONFIG
+
+    url = f"{KEYCLOAK_CONFIG['server_url']}/realms/{KEYCLOAK_CONFIG['realm_name']}"
+    try:
+        response = requests.get(url, timeout=_config().get('timeout', 2), verify=KEYCLOAK_CONFIG['verify'])
+    except requests.RequestException as e:
+        return False, str(e)
+    return response.status_code == 200, f'HTTP {response.status_code}'
+
+
+# name -> (check, HEALTH_CHECKS key of its interval)
+CHECKS = {
+    'database': (check_databases, 'interval'),
+    'signing_keys': (check_signing_keys, 'keycloak_interval'),
+    'keycloak': (check_keycloak, 'keycloak_interval'),
+}
+
+
+class HealthMonitor:
+    """
+    Runs CHECKS on a daemon thread and keeps the readiness response ready to
+    send. Results older than `stale_after` rounds make the worker unready,
+    so a stuck checker is noticed.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.ready = False
+        self.body = b'{"status":"starting"}'
+        self._last_round = None
+        self._next_run = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def ensure_started(self):
+        # Threads do not survive fork: a preloaded server's workers start their own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._next_run = {}
+                self._stopping = threading.Event()
+                threading.Thread(target=self._run, args=(self._stopping,), name='health-monitor', daemon=True).start()
+
+    def stop(self):
+        """
+        End the checker thread after its current round
+        """
+        self._stopping.set()
+
+    def _run(self, stopping):
+        while True:
+            self.run_checks()
+            if stopping.wait(_config().get('interval', 5)):
+                return
+
+    def run_checks(self):
+        now = time.monotonic()
+        for name, (check, interval) in CHECKS.items():
+            if now < self._next_run.get(name, 0):
+                continue
+            started = time.perf_counter()
+            try:
+                ok, detail = check()
+            except Exception as e:
+                ok, detail = False, str(e)
+            previous = self.results.get(name)
+            self.results[name] = {'ok': ok, 'detail': detail, 'ms': round((time.perf_counter() - started) * 1000, 1)}
+            self._next_run[name] = now + _config().get(interval, 5)
+            # Details (hostnames, driver errors) go to the log, once per change
+            if not ok and (previous is None or previous['ok'] or previous['detail'] != detail):
+                logger.warning(f"Readiness check {name} failed: {detail}")
+            elif ok and previous is not None and not previous['ok']:
+                logger.info(f"Readiness check {name} recovered: {detail}")
+        self.ready = all(result['ok'] for result in self.results.values())
+        # The probe is unauthenticated: only ok/fail per check
+        checks = {name: 'ok' if result['ok'] else 'fail' for name, result in self.results.items()}
+        self.body = json.dumps({'status': 'ready' if self.ready else 'unready', 'checks': checks}).encode()
+        self._last_round = time.monotonic()
+
+    def readiness(self):
+        """
+        (ready, body) from the last round of checks
+        """
+        self.ensure_started()
+        if self._last_round is None:
+            return False, self.body
+        limit = _config().get('interval', 5) * _config().get('stale_after', 3)
+        if time.monotonic() - self._last_round > limit:
+            return False, b'{"status":"stale","detail":"health checks are not running"}'
+        return self.ready, self.body
+
+
+monitor = HealthMonitor()
+
+
+def probe(path):
+    """
+    (status, body) for a probe path, or None for any other path
+    """
+    config = _config()
+    if path == config.get('liveness_path', '/health/'):
+        return 200, b'{"status":"ok"}'
+    if path == config.get('readiness_path', '/ready/'):
+        ready, body = monitor.readiness()
+        return (200 if ready else 503), body
+    return None
+
+
+def wsgi_app(application):
+    """
+    Wrap a WSGI application so probes are answered before it runs
+    """
+    def app(environ, start_response):
+        result = probe(environ.get('PATH_INFO', ''))
+        if result is None:
+            return application(environ, start_response)
+        status, body = result
+        start_response('200 OK' if status == 200 else '503 Service Unavailable', _JSON_HEADERS + [('Content-Length', str(len(body)))])
+        return [body]
+    return app
+
+
+def asgi_app(application):
+    """
+    Wrap an ASGI application so probes are answered before it runs
+    """
+    headers = [(name.lower().encode(), value.encode()) for name, value in _JSON_HEADERS]
+
+    async def app(scope, receive, send):
+        result = probe(scope.get('path', '')) if scope['type'] == 'http' else None
+        if result is None:
+            return await application(scope, receive, send)
+        status, body = result
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers + [(b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+    return app
@@ -0,0 +1,144 @@
+"""
+Non-blocking structured logging: records are queued by the request thread and
+formatted, redacted and written by a background thread.
+
+Configured through settings.LOGGING; this module must only import the stdlib
+because it is loaded while Django configures logging.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import traceback
+from logging.handlers import QueueHandler, QueueListener
+
+REDACTED = '[REDACTED]'
+
+# Field names whose values are never written out
+SECRET_KEYS = re.compile(r'pass(word)?|secret|token|authorization|credential|cookie', re.IGNORECASE)
+
+# JWTs that end up inside free-form messages
+JWT_PATTERN = re.compile(r'eyJ[\w-]+\.[\w-]+\.[\w-]*')
+
+# Opaque bearer tokens, e.g. an Authorization header quoted in an exception
+BEARER_PATTERN = re.compile(r'(Bearer\s+)[^\s\'",]+', re.IGNORECASE)
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def redact_text(text):
+    """
+    Free-form text (messages, tracebacks) with tokens replaced
+    """
+    return BEARER_PATTERN.sub(rf'\1{REDACTED}', JWT_PATTERN.sub(REDACTED, text))
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if SECRET_KEYS.search(str(key)) else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    # Objects such as the request are written as their repr, which can carry the query string
+    return redact_text(str(value))
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line with the message, `extra` fields and secrets redacted
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': redact_text(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS:
+                entry[key] = REDACTED if SECRET_KEYS.search(key) else redact(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            # Exception messages can quote headers, URLs and payloads
+            entry['exc'] = redact_text(record.exc_text)
+        if record.stack_info:
+            entry['stack'] = redact_text(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let through only a fraction of records at or below `level` (DEBUG by default)
+    """
+
+    def __init__(self, rate=0.01, level='DEBUG'):
+        super().__init__()
+        self.rate = rate
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+
+    def filter(self, record):
+        return record.levelno > self.level or random.random() < self.rate
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Queue handler owning a bounded queue and a listener thread that writes to
+    `stream`. When the queue is full records are dropped (and counted) rather
+    than blocking the request.
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.dropped = 0
+        self.listener = None
+        self.start()
+        atexit.register(self.stop)
+        # A forked worker does not inherit the listener thread
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def setFormatter(self, fmt):
+        # Formatting happens in the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        """
+        Merge args and exception text only; the target formats the record later
+        """
+        message = record.getMessage()
+        record = copy.copy(record)
+        record.msg = message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
@@ -0,0 +1,47 @@
+"""
+Move patients nobody has updated for a while to the archive table
+"""
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from api_app.archive import archive_batches, archive_cutoff
+from api_app.models import Patient
+
+
+class Command(BaseCommand):
+    help = 'Archive patients not updated for --days days, in batches; the API still serves them'
+
+    def add_arguments(self, parser):
+        config = getattr(settings, 'PATIENT_ARCHIVE', {})
+        parser.add_argument('--days', type=int, default=config.get('inactive_days', 3 * 365), help='Archive patients not updated for this many days')
+        parser.add_argument('--batch-size', type=int, default=config.get('batch_size', 1000), help='Patients examined per transaction')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the patients that would be archived')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to archive; each patient shard keeps its own archive')
+        parser.add_argument('--vacuum', action='store_true', help='VACUUM afterwards to compact the hot table (SQLite; locks the database)')
+
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['days'])
+        using = options['database']
+        connection = connections[using]
+        if options['dry_run']:
+            count = Patient.objects.using(using).filter(updated_at__lt=cutoff).count()
+            self.stdout.write(f'{count} patients last updated before {cutoff:%Y-%m-%d} would be archived')
+            return
+
+        archived = 0
+        for last, count in archive_batches(cutoff, options['batch_size'], using):
+            archived += count
+            self.stdout.write(f'\rthrough patient {last}: {archived} archived', ending='')
+            self.stdout.flush()
+            time.sleep(options['pause'])
+        self.stdout.write('')
+
+        with connection.cursor() as cursor:
+            if options['vacuum'] and connection.vendor == 'sqlite':
+                cursor.execute('VACUUM')
+            # Refresh planner statistics and the admin's estimated counts
+            if connection.vendor in ('sqlite', 'postgresql'):
+                cursor.execute('ANALYZE')
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} patients last updated before {cutoff:%Y-%m-%d}'))
@@ -0,0 +1,137 @@
+"""
+Compare sync viewsets and the async read path under ASGI with a mix of fast
+and slow clients
+"""
+import json
+import os
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Drives backend.asgi in-process. Slow clients trickle their request in and
+# read the response slowly; fast clients do neither.
+CHILD = r'''
+import asyncio, json, os, statistics, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+from backend.asgi import application
+
+PATH = os.environ['BENCH_PATH']
+TOKEN = os.environ['BENCH_TOKEN']
+DURATION = float(os.environ['BENCH_DURATION'])
+SLOW_DELAY = float(os.environ['BENCH_SLOW_DELAY'])
+in_flight = 0
+peak = 0
+
+async def request(slow):
+    global in_flight, peak
+    path, _, query = PATH.partition('?')
+    headers = [(b'host', b'localhost')]
+    if TOKEN:
+        headers.append((b'authorization', f'Bearer {TOKEN}'.encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': headers, 'client': ('127.0.0.1', 1), 'server': ('localhost', 80),
+    }
+    sent = False
+    status = None
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.sleep(3600)
+            return {'type': 'http.disconnect'}
+        if slow:
+            await asyncio.sleep(SLOW_DELAY)
+        sent = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif slow:
+            await asyncio.sleep(SLOW_DELAY)
+
+    in_flight += 1
+    peak = max(peak, in_flight)
+    started = time.perf_counter()
+    try:
+        await application(scope, receive, send)
+    finally:
+        in_flight -= 1
+    return time.perf_counter() - started, status
+
+async def client(slow, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        latency, status = await request(slow)
+        if status != 200:
+            errors.append(status)
+        latencies.append(latency)
+
+async def main():
+    fast, slow, errors = [], [], []
+    await request(False)
+    deadline = time.perf_counter() + DURATION
+    await asyncio.gather(
+        *(client(False, deadline, fast, errors) for _ in range(int(os.environ['BENCH_FAST']))),
+        *(client(True, deadline, slow, errors) for _ in range(int(os.environ['BENCH_SLOW']))),
+    )
+    print(json.dumps({'fast': fast, 'slow': slow, 'errors': len(errors), 'peak': peak}))
+
+asyncio.run(main())
+'''
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark sync viewsets against the async read path under ASGI with fast and slow clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/hospital/', help='Endpoint to request')
+        parser.add_argument('--token', default='', help='Bearer token sent with each request')
+        parser.add_argument('--fast', type=int, default=50, help='Concurrent fast clients')
+        parser.add_argument('--slow', type=int, default=50, help='Concurrent slow clients')
+        parser.add_argument('--slow-delay', type=float, default=0.2, help='Seconds a slow client takes to send and to read')
+        parser.add_argument('--threads', type=int, default=4, help='ASGI_THREADS for the sync thread pool')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per mode')
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'mode':<8}{'req/s':>9}{'fast p50 ms':>13}{'fast p95 ms':>13}{'fast p99 ms':>13}"
+            f"{'slow p50 ms':>13}{'peak in-flight':>16}{'errors':>8}"
+        )
+        for mode, async_reads in (('sync', '0'), ('async', '1')):
+            result = self._run(async_reads, options)
+            fast, slow = result['fast'], result['slow']
+            rate = (len(fast) + len(slow)) / options['duration']
+            self.stdout.write(
+                f"{mode:<8}{rate:>9.1f}{percentile(fast, 0.5) * 1000:>13.1f}{percentile(fast, 0.95) * 1000:>13.1f}"
+                f"{percentile(fast, 0.99) * 1000:>13.1f}{percentile(slow, 0.5) * 1000:>13.1f}"
+                f"{result['peak']:>16}{result['errors']:>8}"
+            )
+
+    def _run(self, async_reads, options):
+        env = dict(
+            os.environ,
+            DJANGO_ASYNC_READS=async_reads,
+            ASGI_THREADS=str(options['threads']),
+            BENCH_PATH=options['path'],
+            BENCH_TOKEN=options['token'],
+            BENCH_FAST=str(options['fast']),
+            BENCH_SLOW=str(options['slow']),
+            BENCH_SLOW_DELAY=str(options['slow_delay']),
+            BENCH_DURATION=str(options['duration']),
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD], cwd=settings.BASE_DIR, env=env,
+            capture_output=True, text=True, check=True,
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
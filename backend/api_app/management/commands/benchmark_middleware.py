@@ -0,0 +1,71 @@
+"""
+Compare per-request overhead of the full middleware chain and the stateless
+API chain, calling both WSGI handlers in-process on the same request
+"""
+import io
+import statistics
+import time
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from api_app.stateless import StatelessWSGIHandler
+
+
+def _environ(path, token):
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'localhost',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': False, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+    if token:
+        environ['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    return environ
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the full middleware chain against the stateless bearer-token chain'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/hospital/', help='Endpoint to request')
+        parser.add_argument('--token', default='', help='Bearer token sent with each request')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per chain')
+        parser.add_argument('--warmup', type=int, default=50, help='Untimed requests per chain first')
+
+    def handle(self, *args, **options):
+        handlers = {'full': WSGIHandler(), 'stateless': StatelessWSGIHandler()}
+        statuses = {}
+        latencies = {name: [] for name in handlers}
+
+        def call(name):
+            status = []
+            body = handlers[name](_environ(options['path'], options['token']), lambda s, headers: status.append(s))
+            b''.join(body)
+            body.close()
+            statuses[name] = status[0]
+
+        # Identical requests share responses under single-flight only when concurrent; keep it off anyway
+        with override_settings(COALESCE={'enabled': False}):
+            for name in handlers:
+                for _ in range(options['warmup']):
+                    call(name)
+            # Alternate so both chains see the same drift (caches, GC)
+            for _ in range(options['requests']):
+                for name in handlers:
+                    started = time.perf_counter()
+                    call(name)
+                    latencies[name].append(time.perf_counter() - started)
+
+        self.stdout.write(f"GET {options['path']}: full {statuses['full']}, stateless {statuses['stateless']}")
+        self.stdout.write(f"{'chain':<12}{'median us':>12}{'mean us':>12}{'p99 us':>12}")
+        medians = {}
+        for name, values in latencies.items():
+            values.sort()
+            medians[name] = statistics.median(values) * 1e6
+            p99 = values[min(len(values) - 1, int(len(values) * 0.99))] * 1e6
+            self.stdout.write(f"{name:<12}{medians[name]:>12.1f}{statistics.mean(values) * 1e6:>12.1f}{p99:>12.1f}")
+        saved = medians['full'] - medians['stateless']
+        self.stdout.write(self.style.SUCCESS(
+            f"Stateless chain saves {saved:.1f}us per request ({saved / medians['full'] * 100:.0f}% of the median)"
+        ))
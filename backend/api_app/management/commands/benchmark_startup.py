@@ -0,0 +1,77 @@
+"""
+Measure worker import time and time to first fast response, with and without prewarm
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+CHILD = r'''
+import json, os, sys, time
+started = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+from backend.wsgi import application
+imported = time.perf_counter()
+from django.test import Client
+headers = {'HTTP_HOST': 'localhost'}
+if os.environ.get('BENCH_TOKEN'):
+    headers['HTTP_AUTHORIZATION'] = 'Bearer ' + os.environ['BENCH_TOKEN']
+client = Client(**headers)
+latencies = []
+for _ in range(int(os.environ['BENCH_REQUESTS'])):
+    sent = time.perf_counter()
+    client.get(os.environ['BENCH_PATH'])
+    latencies.append(time.perf_counter() - sent)
+print(json.dumps({'import': imported - started, 'latencies': latencies}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Benchmark worker startup: import time and time to first fast response'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/hospital/', help='Endpoint to request')
+        parser.add_argument('--token', default='', help='Bearer token sent with each request')
+        parser.add_argument('--runs', type=int, default=3, help='Fresh processes per mode')
+        parser.add_argument('--requests', type=int, default=20, help='Requests per process')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'mode':<12}{'import ms':>12}{'first req ms':>14}{'steady ms':>12}{'first fast ms':>15}")
+        for mode, prewarm in (('cold', '0'), ('prewarmed', '1')):
+            runs = [self._run(prewarm, options) for _ in range(options['runs'])]
+            row = {key: statistics.median(run[key] for run in runs) * 1000 for key in runs[0]}
+            self.stdout.write(
+                f"{mode:<12}{row['import']:>12.1f}{row['first']:>14.1f}{row['steady']:>12.1f}{row['first_fast']:>15.1f}"
+            )
+
+    def _run(self, prewarm, options):
+        env = dict(
+            os.environ,
+            DJANGO_PREWARM=prewarm,
+            BENCH_PATH=options['path'],
+            BENCH_TOKEN=options['token'],
+            BENCH_REQUESTS=str(options['requests']),
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD], cwd=settings.BASE_DIR, env=env,
+            capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        latencies = result['latencies']
+        steady = statistics.median(latencies[len(latencies) // 2:])
+
+        # Time from process start until a response comes back within 2x steady latency
+        elapsed = result['import']
+        for latency in latencies:
+            elapsed += latency
+            if latency <= steady * 2:
+                break
+        return {
+            'import': result['import'],
+            'first': latencies[0],
+            'steady': steady,
+            'first_fast': elapsed,
+        }
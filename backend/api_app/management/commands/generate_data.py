@@ -0,0 +1,220 @@
+"""
+Fill the database with deterministic synthetic hospitals and patients
+"""
+import itertools
+import multiprocessing
+import os
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+from api_app.models import Patient, ArchivedPatient, Hospital, allocate_change_seqs
+
+# Rows per generation chunk. Each chunk has its own RNG seeded from the seed
+# and chunk number, so output does not depend on the number of workers.
+CHUNK_SIZE = 50000
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+    'Christopher', 'Lisa', 'Daniel', 'Nancy', 'Matthew', 'Betty', 'Anthony', 'Margaret', 'Mark', 'Sandra',
+    'Donald', 'Ashley', 'Steven', 'Kimberly', 'Paul', 'Emily', 'Andrew', 'Donna', 'Joshua', 'Michelle',
+    'Kenneth', 'Carol', 'Kevin', 'Amanda', 'Brian', 'Dorothy', 'George', 'Melissa', 'Timothy', 'Deborah',
+    'Ronald', 'Stephanie', 'Edward', 'Rebecca', 'Jason', 'Sharon', 'Jeffrey', 'Laura', 'Ryan', 'Cynthia',
+    'Jacob', 'Kathleen', 'Gary', 'Amy', 'Nicholas', 'Angela', 'Eric', 'Shirley', 'Jonathan', 'Anna',
+    'Stephen', 'Brenda', 'Larry', 'Pamela', 'Justin', 'Emma', 'Scott', 'Nicole', 'Brandon', 'Helen',
+    'Priya', 'Arjun', 'Wei', 'Mei', 'Carlos', 'Sofia', 'Mohammed', 'Fatima', 'Hiroshi', 'Yuki',
+    'Olumide', 'Amara', 'Ivan', 'Olga', 'Mateo', 'Lucia', 'Ahmed', 'Aisha', 'Raj', 'Ananya',
+]
+
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark', 'Ramirez', 'Lewis', 'Robinson',
+    'Walker', 'Young', 'Allen', 'King', 'Wright', 'Scott', 'Torres', 'Nguyen', 'Hill', 'Flores',
+    'Green', 'Adams', 'Nelson', 'Baker', 'Hall', 'Rivera', 'Campbell', 'Mitchell', 'Carter', 'Roberts',
+    'Gomez', 'Phillips', 'Evans', 'Turner', 'Diaz', 'Parker', 'Cruz', 'Edwards', 'Collins', 'Reyes',
+    'Stewart', 'Morris', 'Morales', 'Murphy', 'Cook', 'Rogers', 'Gutierrez', 'Ortiz', 'Morgan', 'Cooper',
+    'Patel', 'Sharma', 'Singh', 'Kumar', 'Chen', 'Wang', 'Li', 'Zhang', 'Kim', 'Park',
+    'Tanaka', 'Suzuki', 'Okafor', 'Adeyemi', 'Ivanov', 'Petrov', 'Silva', 'Santos', 'Khan', 'Ali',
+    'Mueller', 'Schmidt', 'Rossi', 'Russo', 'Dubois', 'Moreau', 'Novak', 'Kowalski', 'Jensen', 'Larsen',
+]
+
+# Approximate population frequencies (percent)
+BLOOD_GROUPS = {
+    'O+': 37.4, 'A+': 35.7, 'B+': 8.5, 'AB+': 3.4,
+    'O-': 6.6, 'A-': 6.3, 'B-': 1.5, 'AB-': 0.6,
+}
+
+CITIES = [
+    'Springfield', 'Riverside', 'Fairview', 'Madison', 'Georgetown', 'Franklin', 'Clinton', 'Arlington',
+    'Salem', 'Greenville', 'Bristol', 'Oxford', 'Ashland', 'Burlington', 'Manchester', 'Milton',
+]
+# Shard keys (Patient.hospital_group); rebalance_shards moves each group's
+# patients to its shard after generation
+HOSPITAL_GROUPS = ['north', 'south', 'east', 'west', 'central']
+HOSPITAL_KINDS = ['General Hospital', 'Medical Center', 'Regional Hospital', 'Community Hospital', "Children's Hospital", 'Clinic']
+STREETS = ['Main St', 'Oak Ave', 'Maple Dr', 'Cedar Ln', 'Park Rd', 'Elm St', 'Hill Rd', 'Lake Blvd']
+
+
+def _zipf_weights(count, exponent=1.1):
+    """
+    Cumulative weights so the first names in a list are the most common
+    """
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+FIRST_WEIGHTS = _zipf_weights(len(FIRST_NAMES))
+LAST_WEIGHTS = _zipf_weights(len(LAST_NAMES))
+BLOOD_VALUES = list(BLOOD_GROUPS)
+BLOOD_WEIGHTS = list(itertools.accumulate(BLOOD_GROUPS.values()))
+
+
+def _chunks(total, first_id):
+    """
+    (chunk number, first id, row count) for every chunk of `total` rows
+    """
+    return [
+        (number, first_id + start, min(CHUNK_SIZE, total - start))
+        for number, start in enumerate(range(0, total, CHUNK_SIZE))
+    ]
+
+
+def _patients(rng, first_id, count, now):
+    last_names = rng.choices(LAST_NAMES, cum_weights=LAST_WEIGHTS, k=count)
+    first_names = rng.choices(FIRST_NAMES, cum_weights=FIRST_WEIGHTS, k=count)
+    bloods = rng.choices(BLOOD_VALUES, cum_weights=BLOOD_WEIGHTS, k=count)
+    groups = rng.choices(HOSPITAL_GROUPS, k=count)
+    return [
+        (first_id + i, first_names[i], last_names[i], bloods[i], now, groups[i])
+        for i in range(count)
+    ]
+
+
+def _hospitals(rng, first_id, count, now):
+    rows = []
+    for i in range(count):
+        city = rng.choice(CITIES)
+        name = f'{city} {rng.choice(HOSPITAL_KINDS)} {first_id + i}'
+        # Log-normal bed counts: most hospitals are small, a few are very large
+        capacity = min(3000, max(10, int(rng.lognormvariate(5.0, 0.8))))
+        rows.append((
+            first_id + i,
+            name,
+            f'{rng.randint(1, 9999)} {rng.choice(STREETS)}, {city}',
+            f'555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}',
+            f"info{first_id + i}@{city.lower()}-health.example" if rng.random() < 0.8 else None,
+            capacity,
+            now,
+            now,
+        ))
+    return rows
+
+
+# Model, columns filled by the builder (change_seq is appended per batch), builder
+BUILDERS = {
+    'patient': (Patient, ['patient_id', 'first_name', 'last_name', 'blood', 'updated_at', 'hospital_group'], _patients),
+    'hospital': (Hospital, ['hospital_id', 'name', 'address', 'phone', 'email', 'capacity', 'created_at', 'updated_at'], _hospitals),
+}
+
+
+def _insert_sql(model, columns):
+    quote = connection.ops.quote_name
+    names = ', '.join(quote(column) for column in columns + ['change_seq'])
+    placeholders = ', '.join(['%s'] * (len(columns) + 1))
+    return f'INSERT INTO {quote(model._meta.db_table)} ({names}) VALUES ({placeholders})'
+
+
+def _insert_chunk(task):
+    """
+    Generate and insert one chunk; runs in a worker process.
+
+    Rows are written with executemany() rather than bulk_create(): at tens of
+    millions of rows, building model instances costs more than the inserts.
+    """
+    resource, seed, batch_size, (number, first_id, count) = task
+    model, columns, build = BUILDERS[resource]
+    rng = random.Random(f'{seed}:{resource}:{number}')
+    rows = build(rng, first_id, count, connection.ops.adapt_datetimefield_value(timezone.now()))
+    sql = _insert_sql(model, columns)
+
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            # Workers take turns on the write lock; wait instead of failing
+            cursor.execute('PRAGMA busy_timeout = 600000')
+            cursor.execute('PRAGMA synchronous = OFF')
+
+    for start in range(0, count, batch_size):
+        batch = rows[start:start + batch_size]
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Rows still get change sequence numbers so delta sync sees them
+            seqs = allocate_change_seqs(len(batch))
+            cursor.executemany(sql, [row + (seq,) for row, seq in zip(batch, seqs)])
+    return count
+
+
+def _worker_init():
+    # Never reuse the parent's database connections after fork
+    for conn in connections.all():
+        conn.close()
+
+
+class Command(BaseCommand):
+    help = 'Create synthetic hospitals and patients (deterministic for a seed) for performance testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=1000000, help='Patients to create')
+        parser.add_argument('--hospitals', type=int, default=2000, help='Hospitals to create')
+        parser.add_argument('--seed', default='42', help='Seed; the same seed produces the same rows')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per insert transaction')
+
+    def handle(self, *args, **options):
+        connections.close_all()
+        for resource, model, total in (
+            ('hospital', Hospital, options['hospitals']),
+            ('patient', Patient, options['patients']),
+        ):
+            if total <= 0:
+                continue
+            # Continue after existing rows so repeated runs append
+            first_id = (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+            if model is Patient:
+                first_id = max(first_id, (ArchivedPatient.objects.aggregate(last=Max('pk'))['last'] or 0) + 1)
+            connections.close_all()
+            tasks = [
+                (resource, options['seed'], options['batch_size'], chunk)
+                for chunk in _chunks(total, first_id)
+            ]
+            self._run(resource, tasks, total, options['workers'])
+
+        with connection.cursor() as cursor:
+            # Refresh planner statistics (also used by the admin's estimated counts)
+            if connection.vendor in ('sqlite', 'postgresql'):
+                cursor.execute('ANALYZE')
+        self.stdout.write(self.style.SUCCESS('Done'))
+
+    def _run(self, resource, tasks, total, workers):
+        started = time.perf_counter()
+        done = 0
+        # Workers are forked so they inherit the configured Django setup
+        if workers > 1 and len(tasks) > 1 and hasattr(os, 'fork'):
+            with multiprocessing.get_context('fork').Pool(workers, initializer=_worker_init) as pool:
+                for count in pool.imap_unordered(_insert_chunk, tasks):
+                    done += count
+                    self._progress(resource, done, total, started)
+        else:
+            for task in tasks:
+                done += _insert_chunk(task)
+                self._progress(resource, done, total, started)
+        self.stdout.write('')
+
+    def _progress(self, resource, done, total, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'\r{resource}: {done}/{total} rows, {done / elapsed:,.0f} rows/s',
+            ending='',
+        )
+        self.stdout.flush()
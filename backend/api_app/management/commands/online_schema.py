@@ -0,0 +1,129 @@
+"""
+Run and estimate online schema changes: batched backfills and index builds
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.migrations.exceptions import AmbiguityError
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.operations import AddIndex
+from api_app.models import BackfillProgress
+from api_app.online_schema import (
+    AddNullableField, RunBackfill, estimate_backfill, estimate_index, migration_backfills, pending_rows, run_backfill,
+)
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    if seconds < 3600:
+        return f'{seconds / 60:.1f}min'
+    return f'{seconds / 3600:.1f}h'
+
+
+class Command(BaseCommand):
+    help = 'Run pending backfills in throttled batches, show their progress, or estimate a migration'
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest='subcommand', required=True)
+
+        backfill = subcommands.add_parser('backfill', help='Run the backfills of applied migrations, resuming where they stopped')
+        backfill.add_argument('--batch-size', type=int, help="Rows per transaction (default: the operation's batch_size)")
+        backfill.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+        backfill.add_argument('--dry-run', action='store_true', help='Estimate the duration without changing anything')
+        backfill.add_argument('--restart', action='store_true', help='Forget recorded progress and start from the first row')
+
+        subcommands.add_parser('status', help='Show the progress of every backfill')
+
+        estimate = subcommands.add_parser('estimate', help='Estimate how long each operation of a migration will take')
+        estimate.add_argument('app_label')
+        estimate.add_argument('migration_name', help='Migration name or unique prefix')
+        estimate.add_argument('--pause', type=float, default=0.1, help='Seconds between backfill batches')
+        estimate.add_argument('--database', default='default', help='Database to estimate against, e.g. a patient shard')
+
+    def handle(self, *args, **options):
+        getattr(self, options['subcommand'])(options)
+
+    def status(self, options):
+        backfills = migration_backfills()
+        if not backfills:
+            self.stdout.write('No backfills in applied migrations')
+        progress = {state.name: state for state in BackfillProgress.objects.all()}
+        for name, model, operation, using in backfills:
+            state = progress.get(name)
+            if state and state.completed_at:
+                detail = f'done, {state.rows} rows at {state.completed_at:%Y-%m-%d %H:%M}'
+            else:
+                after = state.last_pk if state else None
+                pending = pending_rows(model, operation.field_name, after, using)
+                detail = f'{state.rows if state else 0} rows done, {pending} pending after pk {after}'
+            self.stdout.write(f'{name} {operation.describe()}: {detail}')
+
+    def backfill(self, options):
+        for name, model, operation, using in migration_backfills():
+            batch_size = options['batch_size'] or operation.batch_size
+            if options['restart']:
+                BackfillProgress.objects.filter(name=name).delete()
+            state = BackfillProgress.objects.filter(name=name).first()
+            if state and state.completed_at:
+                continue
+            after = state.last_pk if state else None
+
+            if options['dry_run']:
+                rows, batches, seconds = estimate_backfill(
+                    model, operation.field_name, operation.value, batch_size, options['pause'], after, using,
+                )
+                self.stdout.write(f'{name} {operation.describe()}: {rows} rows in {batches} batches, about {_duration(seconds)}')
+                continue
+
+            self.stdout.write(f'{name} {operation.describe()}' + (f', resuming after pk {after}' if after else ''))
+
+            def progress(last, updated):
+                self.stdout.write(f'\r  through pk {last}', ending='')
+                self.stdout.flush()
+
+            state = run_backfill(
+                name, model, operation.field_name, operation.value, batch_size, options['pause'], using, progress,
+            )
+            self.stdout.write('')
+            self.stdout.write(self.style.SUCCESS(f'  {state.rows} rows backfilled'))
+
+    def estimate(self, options):
+        loader = MigrationLoader(connections[options['database']])
+        try:
+            migration = loader.get_migration_by_prefix(options['app_label'], options['migration_name'])
+        except (AmbiguityError, KeyError) as e:
+            raise CommandError(str(e))
+        key = (migration.app_label, migration.name)
+        if key in loader.applied_migrations:
+            self.stdout.write(f'{migration.app_label}.{migration.name} is already applied')
+        state = loader.project_state(key, at_end=False)
+        for operation in migration.operations:
+            self.stdout.write(f'{operation.describe()}: {self._estimate_operation(migration.app_label, operation, state, options)}')
+            operation.state_forwards(migration.app_label, state)
+
+    def _estimate_operation(self, app_label, operation, state, options):
+        connection = connections[options['database']]
+        if isinstance(operation, AddNullableField):
+            return 'metadata only, instant'
+        if isinstance(operation, (AddIndex, RunBackfill)):
+            model = state.apps.get_model(app_label, operation.model_name)
+            if not operation.allow_migrate_model(connection.alias, model):
+                return f'not run on {connection.alias}'
+            with connection.cursor() as cursor:
+                columns = {column.name for column in connection.introspection.get_table_description(cursor, model._meta.db_table)}
+        if isinstance(operation, AddIndex):
+            fields = [field.lstrip('-') for field in operation.index.fields]
+            if any(model._meta.get_field(field).column not in columns for field in fields):
+                return 'indexes a column added by this migration; estimate again once it exists'
+            rows, seconds = estimate_index(model, fields, connection.alias)
+            if connection.vendor == 'sqlite':
+                return f'{rows} rows, writers blocked for about {_duration(seconds)} (SQLite builds indexes under the write lock)'
+            return f'{rows} rows, about {_duration(seconds)}'
+        if isinstance(operation, RunBackfill):
+            if model._meta.get_field(operation.field_name).column not in columns:
+                return 'column added by this migration; run `online_schema backfill --dry-run` after migrate'
+            rows, batches, seconds = estimate_backfill(
+                model, operation.field_name, operation.value, operation.batch_size, options['pause'], using=connection.alias,
+            )
+            return f'{rows} rows in {batches} batches, about {_duration(seconds)}'
+        return 'not an online operation; may lock or rewrite the table'
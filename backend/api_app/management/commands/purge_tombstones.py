@@ -0,0 +1,28 @@
+"""
+Delete old delta-sync tombstones and record how far cursors stay valid
+"""
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from api_app.models import ChangeCounter, Tombstone
+
+
+class Command(BaseCommand):
+    help = 'Delete tombstones older than --days; clients with older cursors must resync in full'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Keep tombstones newer than this many days')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        with transaction.atomic():
+            expired = Tombstone.objects.filter(deleted_at__lt=cutoff)
+            purged_through = expired.aggregate(seq=Max('change_seq'))['seq']
+            if purged_through is None:
+                self.stdout.write('No tombstones to purge')
+                return
+            deleted, _ = expired.delete()
+            ChangeCounter.objects.filter(pk=1, purged_through__lt=purged_through).update(purged_through=purged_through)
+        self.stdout.write(self.style.SUCCESS(f'Purged {deleted} tombstones through change {purged_through}'))
@@ -0,0 +1,46 @@
+"""
+Move patients to the shard their hospital group maps to
+"""
+import time
+from django.core.management.base import BaseCommand
+from api_app.models import Tombstone
+from api_app.sharding import SHARD_KEY_FIELD, SHARDED_MODELS, move_batches, move_tombstones, shard_aliases, shard_for_key
+
+
+class Command(BaseCommand):
+    help = 'Move patients (hot and archived) and their tombstones whose hospital group maps to another shard, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per transaction')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would move without changing anything')
+
+    def handle(self, *args, **options):
+        total = 0
+        for source in shard_aliases():
+            # Tombstones count too: a group whose patients were all deleted still has deletions to sync
+            for model in SHARDED_MODELS + (Tombstone,):
+                rows = model._default_manager.using(source)
+                groups = rows.order_by().values_list(SHARD_KEY_FIELD, flat=True).distinct()
+                for group in groups:
+                    target = shard_for_key(group)
+                    if target == source:
+                        continue
+                    label = f'{model.__name__} group {group or "(none)"}: {source} -> {target}'
+                    if options['dry_run']:
+                        self.stdout.write(f'{label}: {rows.filter(**{SHARD_KEY_FIELD: group}).count()} rows')
+                        continue
+                    if model is Tombstone:
+                        batches = move_tombstones(group, source, target, options['batch_size'])
+                    else:
+                        batches = move_batches(model, group, source, target, options['batch_size'])
+                    moved = 0
+                    for count in batches:
+                        moved += count
+                        self.stdout.write(f'\r{label}: {moved} rows', ending='')
+                        self.stdout.flush()
+                        time.sleep(options['pause'])
+                    self.stdout.write('')
+                    total += moved
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'Moved {total} rows'))
@@ -0,0 +1,364 @@
+"""
+Opt-in memory profiling for leak hunting. With MEMORY_PROFILING['enabled'],
+tracemalloc traces allocations from startup, and snapshots are taken on
+demand (GET/POST /memory/ for admins, or the configured signal). Each
+snapshot is reduced to bytes and blocks per Python module, so diffs between
+snapshots show which modules keep growing. Registered in-process caches
+report their sizes next to them. When disabled, nothing is traced and the
+endpoint answers 404.
+"""
+import gc
+import itertools
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import Http404
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from api_app.authentication import TokenAuthentication
+from api_app.permissions import HasResourcePermission
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Allocations by the import system, tracemalloc and the snapshots kept here
+# are noise in a diff
+IGNORED_FILES = frozenset((
+    __file__,
+    tracemalloc.__file__,
+    '<frozen importlib._bootstrap>',
+    '<frozen importlib._bootstrap_external>',
+    '<unknown>',
+))
+
+GROUPINGS = ('module', 'caller')
+
+# name -> callable returning the size of an in-process cache
+_cache_sizes = {}
+
+
+def _config():
+    return getattr(settings, 'MEMORY_PROFILING', {})
+
+
+def enabled():
+    return _config().get('enabled', False)
+
+
+def register_cache(name, callback):
+    """
+    Report callback() as the size of cache `name` alongside every snapshot
+    """
+    _cache_sizes[name] = callback
+
+
+def cache_sizes():
+    sizes = {}
+    for name, callback in _cache_sizes.items():
+        try:
+            sizes[name] = callback()
+        except Exception as e:
+            sizes[name] = f'error: {e}'
+    # Sessions (cached_db) and admin row estimates live in the local-memory cache
+    for alias in settings.CACHES:
+        cache = caches[alias]
+        if isinstance(cache, LocMemCache):
+            sizes[f'django_cache.{alias}'] = len(cache._cache)
+    return sizes
+
+
+def object_counts():
+    """
+    Live instances of MEMORY_PROFILING['track_types'] (a full gc scan)
+    """
+    types = {}
+    for path in _config().get('track_types', ()):
+        try:
+            types[path] = import_string(path)
+        except ImportError:
+            continue
+    counts = dict.fromkeys(types, 0)
+    if not types:
+        return counts
+    for obj in gc.get_objects():
+        for path, cls in types.items():
+            if isinstance(obj, cls):
+                counts[path] += 1
+    return counts
+
+
+def resident_bytes():
+    """
+    Current RSS from /proc, or the peak RSS where /proc is unavailable
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _module_names():
+    names = {}
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if path:
+            names[path] = name
+    return names
+
+
+def summarize(snapshot):
+    """
+    {grouping: {module: [bytes, blocks]}} for a snapshot. 'module' charges
+    each allocation to the module that made it; 'caller' to the innermost
+    frame in project code, so e.g. requests objects built by the login view
+    count against api_app.views (needs MEMORY_PROFILING['frames'] > 1).
+    """
+    names = _module_names()
+    base = str(settings.BASE_DIR)
+    labels = {}
+
+    def label(filename):
+        found = labels.get(filename)
+        if found is None:
+            project = filename.startswith(base) and 'site-packages' not in filename
+            found = labels[filename] = (names.get(filename, filename), project)
+        return found
+
+    # One Statistic per distinct traceback. Ignored files are skipped here
+    # rather than with filter_traces(): its fnmatch per trace and filter
+    # takes seconds on a traced process.
+    sizes = {grouping: {} for grouping in GROUPINGS}
+    for stat in snapshot.statistics('traceback'):
+        # Tracebacks run from the oldest frame to the allocation; walk them
+        # from the allocation and stop at the first project frame
+        frames = reversed(stat.traceback)
+        filename = next(frames).filename
+        if filename in IGNORED_FILES:
+            continue
+        module, project = label(filename)
+        caller = module
+        while not project:
+            frame = next(frames, None)
+            if frame is None:
+                break
+            name, project = label(frame.filename)
+            if project:
+                caller = name
+        for grouping, name in (('module', module), ('caller', caller)):
+            values = sizes[grouping].get(name)
+            if values is None:
+                values = sizes[grouping][name] = [0, 0]
+            values[0] += stat.size
+            values[1] += stat.count
+    return sizes
+
+
+def diff(old, new, grouping='module', top=25):
+    """
+    Modules whose traced memory changed most between two snapshots
+    """
+    before, after = old['summary'][grouping], new['summary'][grouping]
+    rows = []
+    for module in before.keys() | after.keys():
+        old_size, old_count = before.get(module, (0, 0))
+        size, count = after.get(module, (0, 0))
+        if size != old_size or count != old_count:
+            rows.append({
+                'module': module,
+                'size': size,
+                'size_diff': size - old_size,
+                'count': count,
+                'count_diff': count - old_count,
+            })
+    rows.sort(key=lambda row: abs(row['size_diff']), reverse=True)
+    return {'from': old['id'], 'to': new['id'], 'seconds': round(new['taken_at'] - old['taken_at'], 1), 'modules': rows[:top]}
+
+
+class SnapshotStore:
+    """
+    The last MEMORY_PROFILING['max_snapshots'] module summaries of this worker
+    """
+
+    def __init__(self):
+        self._snapshots = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def take(self, label=''):
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('tracemalloc is not tracing')
+        started = time.perf_counter()
+        current, peak = tracemalloc.get_traced_memory()
+        entry = {
+            'id': next(self._ids),
+            'label': label,
+            'taken_at': time.time(),
+            'traced': current,
+            'traced_peak': peak,
+            'rss': resident_bytes(),
+            'caches': cache_sizes(),
+            'summary': summarize(tracemalloc.take_snapshot()),
+        }
+        entry['seconds'] = round(time.perf_counter() - started, 3)
+        with self._lock:
+            self._snapshots.append(entry)
+            while len(self._snapshots) > _config().get('max_snapshots', 10):
+                self._snapshots.popleft()
+        return entry
+
+    def all(self):
+        with self._lock:
+            return list(self._snapshots)
+
+    def get(self, snapshot_id):
+        return next((entry for entry in self.all() if entry['id'] == snapshot_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+snapshots = SnapshotStore()
+
+
+def describe(entry):
+    """
+    A snapshot without its per-module summary
+    """
+    return {key: value for key, value in entry.items() if key != 'summary'}
+
+
+def _log_snapshot():
+    try:
+        entry = snapshots.take(label='signal')
+    except Exception as e:
+        logger.warning(f"Memory snapshot failed: {e}")
+        return
+    taken = snapshots.all()
+    logger.info(f"Memory snapshot {entry['id']} (pid {os.getpid()}): {describe(entry)}")
+    if len(taken) > 1:
+        logger.info(f"Memory growth since snapshot {taken[0]['id']}: {diff(taken[0], entry, top=_config().get('top', 25))}")
+
+
+def _on_signal(signum, frame):
+    # Snapshotting takes locks the interrupted code may hold; do it on a thread
+    threading.Thread(target=_log_snapshot, name='memory-snapshot', daemon=True).start()
+
+
+def install_signal_handler():
+    """
+    Take and log a snapshot on MEMORY_PROFILING['signal']. Only the main
+    thread may set handlers, and gunicorn resets them in forked workers: with
+    --preload call this again from a post_fork hook.
+    """
+    name = _config().get('signal')
+    if not name or not hasattr(signal, name):
+        return False
+    try:
+        signal.signal(getattr(signal, name), _on_signal)
+    except ValueError:
+        logger.warning(f"Memory snapshots on {name} not installed: not in the main thread")
+        return False
+    return True
+
+
+def start():
+    """
+    Start tracing and install the signal handler if profiling is enabled
+    """
+    if not enabled():
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(_config().get('frames', 1))
+    install_signal_handler()
+    logger.info(f"Memory profiling enabled (pid {os.getpid()}, {tracemalloc.get_traceback_limit()} frames)")
+
+
+class MemoryProfileView(APIView):
+    """
+    GET reports RSS, traced memory, cache sizes, live object counts and the
+    growth across stored snapshots (?group=module|caller, ?top=,
+    ?from=&to= snapshot ids). POST takes a snapshot ({"label": ...}) and
+    returns its diff to the previous one; DELETE drops the stored snapshots.
+    Snapshots are per worker: the pid in each response tells them apart.
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [HasResourcePermission]
+    required_permission = 'system:profile'
+
+    def initial(self, request, *args, **kwargs):
+        if not enabled():
+            raise Http404
+        super().initial(request, *args, **kwargs)
+
+    def _options(self, request):
+        grouping = request.query_params.get('group', 'module')
+        try:
+            top = int(request.query_params.get('top', _config().get('top', 25)))
+        except ValueError:
+            top = None
+        if grouping not in GROUPINGS or not top or top < 1:
+            return None
+        return grouping, top
+
+    def get(self, request):
+        options = self._options(request)
+        if options is None:
+            return Response({'error': f'group must be one of {", ".join(GROUPINGS)} and top a positive integer'}, status=status.HTTP_400_BAD_REQUEST)
+        grouping, top = options
+        taken = snapshots.all()
+        report = {
+            'pid': os.getpid(),
+            'tracing': tracemalloc.is_tracing(),
+            'rss': resident_bytes(),
+            'traced': tracemalloc.get_traced_memory()[0],
+            'caches': cache_sizes(),
+            'objects': object_counts(),
+            'snapshots': [describe(entry) for entry in taken],
+            'growth': None,
+        }
+        if 'from' in request.query_params or 'to' in request.query_params:
+            try:
+                old = snapshots.get(int(request.query_params.get('from', taken[0]['id'] if taken else 0)))
+                new = snapshots.get(int(request.query_params.get('to', taken[-1]['id'] if taken else 0)))
+            except ValueError:
+                old = new = None
+            if old is None or new is None:
+                return Response({'error': 'Unknown snapshot id'}, status=status.HTTP_404_NOT_FOUND)
+            report['growth'] = diff(old, new, grouping, top)
+        elif len(taken) > 1:
+            report['growth'] = diff(taken[0], taken[-1], grouping, top)
+        return Response(report)
+
+    def post(self, request):
+        options = self._options(request)
+        if options is None:
+            return Response({'error': f'group must be one of {", ".join(GROUPINGS)} and top a positive integer'}, status=status.HTTP_400_BAD_REQUEST)
+        grouping, top = options
+        label = request.data.get('label', '') if isinstance(request.data, dict) else ''
+        previous = snapshots.all()
+        try:
+            entry = snapshots.take(str(label)[:100])
+        except RuntimeError as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response({
+            'pid': os.getpid(),
+            'snapshot': describe(entry),
+            'diff': diff(previous[-1], entry, grouping, top) if previous else None,
+        }, status=status.HTTP_201_CREATED)
+
+    def delete(self, request):
+        snapshots.clear()
+        return Response(status=status.HTTP_204_NO_CONTENT)
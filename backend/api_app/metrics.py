@@ -0,0 +1,224 @@
+"""
+Per-request phase timing, Server-Timing headers and Prometheus metrics
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Default Prometheus latency buckets (seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Buckets for the number of SQL queries issued by one request
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_current_timer = ContextVar('request_timer', default=None)
+
+
+class RequestTimer:
+    """
+    Accumulates the time spent in each phase of a single request. Shard and
+    batch fan-out threads share their request's timer, so updates are locked.
+    """
+
+    __slots__ = ('started', 'phases', 'queries', '_lock')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed, queries=0):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            self.queries += queries
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total):
+        """
+        Render the phases as a Server-Timing header value (durations in ms)
+        """
+        parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.phases.items()]
+        parts.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(parts)
+
+
+def current_timer():
+    """
+    Return the timer of the request being processed, or None
+    """
+    return _current_timer.get()
+
+
+def start_timer():
+    timer = RequestTimer()
+    return timer, _current_timer.set(timer)
+
+
+def stop_timer(token):
+    _current_timer.reset(token)
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a block of code as one phase of the current request.
+    Does nothing when no request is being timed.
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def query_counter(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting queries and DB time for the current request
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.add('db', time.perf_counter() - started, queries=1)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    connection_created receiver adding query_counter to every new
+    connection, including those opened by ORM worker threads under ASGI.
+    Inserted first: execute_wrapper() pops the last wrapper on exit, so one
+    appended by a connection opened inside that block would be popped instead.
+    """
+    if query_counter not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, query_counter)
+
+
+class Histogram:
+    """
+    Cumulative Prometheus-style histogram
+    """
+
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class MetricsRegistry:
+    """
+    In-process store of request metrics. Each worker process keeps its own
+    registry, so Prometheus should scrape every worker (or sum by instance).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._queries = {}
+        self._requests = {}
+        self._gauges = {}
+
+    def observe_request(self, endpoint, method, status_code, timer, total):
+        key = (endpoint, method)
+        with self._lock:
+            for name, seconds in timer.phases.items():
+                self._histogram(self._latency, key + (name,), LATENCY_BUCKETS).observe(seconds)
+            self._histogram(self._latency, key + ('total',), LATENCY_BUCKETS).observe(total)
+            self._histogram(self._queries, key, QUERY_BUCKETS).observe(timer.queries)
+            status_key = key + (str(status_code),)
+            self._requests[status_key] = self._requests.get(status_key, 0) + 1
+
+    def set_gauge(self, name, help_text, callback, kind='gauge'):
+        """
+        Register a callable whose value is sampled on every scrape. Use
+        kind='counter' for values that only grow.
+        """
+        with self._lock:
+            self._gauges[name] = (help_text, callback, kind)
+
+    def series_count(self):
+        """
+        Histograms and counters held, one per endpoint/method/phase/status seen
+        """
+        return len(self._latency) + len(self._queries) + len(self._requests)
+
+    def reset(self):
+        with self._lock:
+            self._latency.clear()
+            self._queries.clear()
+            self._requests.clear()
+
+    @staticmethod
+    def _histogram(store, key, buckets):
+        histogram = store.get(key)
+        if histogram is None:
+            histogram = store[key] = Histogram(buckets)
+        return histogram
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            lines.append('# HELP api_request_phase_seconds Time spent per request phase')
+            lines.append('# TYPE api_request_phase_seconds histogram')
+            for (endpoint, method, name), histogram in sorted(self._latency.items()):
+                labels = f'endpoint="{endpoint}",method="{method}",phase="{name}"'
+                lines.extend(_histogram_lines('api_request_phase_seconds', labels, histogram))
+
+            lines.append('# HELP api_request_queries Database queries per request')
+            lines.append('# TYPE api_request_queries histogram')
+            for (endpoint, method), histogram in sorted(self._queries.items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                lines.extend(_histogram_lines('api_request_queries', labels, histogram))
+
+            lines.append('# HELP api_requests_total Requests served')
+            lines.append('# TYPE api_requests_total counter')
+            for (endpoint, method, status_code), count in sorted(self._requests.items()):
+                lines.append(
+                    f'api_requests_total{{endpoint="{endpoint}",method="{method}",'
+                    f'status="{status_code}"}} {count}'
+                )
+            gauges = list(self._gauges.items())
+
+        for name, (help_text, callback, kind) in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {callback()}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _histogram_lines(metric, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        yield f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}'
+    yield f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}'
+    yield f'{metric}_sum{{{labels}}} {histogram.total:.6f}'
+    yield f'{metric}_count{{{labels}}} {histogram.count}'
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,127 @@
+"""
+Middleware for the API app
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from api_app import admission, metrics
+
+
+class MetricsMiddleware:
+    """
+    Middleware that times each request phase, counts DB queries, adds a
+    Server-Timing header and records the result in the metrics registry.
+    Should be the first entry in MIDDLEWARE so the total covers the whole stack.
+
+    Queries are counted by the wrapper metrics.install_query_counter() adds
+    to every connection, so those run by ORM worker threads under ASGI count too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'METRICS_ENABLED', True)
+        self.server_timing = getattr(settings, 'METRICS_SERVER_TIMING', True)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.enabled or request.path == '/metrics':
+            return self.get_response(request)
+
+        timer, token = metrics.start_timer()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.stop_timer(token)
+        return self._record(request, response, timer)
+
+    async def __acall__(self, request):
+        if not self.enabled or request.path == '/metrics':
+            return await self.get_response(request)
+
+        timer, token = metrics.start_timer()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.stop_timer(token)
+        return self._record(request, response, timer)
+
+    def _record(self, request, response, timer):
+        total = timer.elapsed()
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match else 'unmatched'
+        metrics.registry.observe_request(endpoint, request.method, response.status_code, timer, total)
+
+        if self.server_timing:
+            response['Server-Timing'] = timer.server_timing(total)
+        return response
+
+
+class AdmissionControlMiddleware:
+    """
+    Caps in-flight requests per worker (see api_app.admission). Over the cap,
+    requests queue by priority for a short deadline and are then shed with
+    503 and Retry-After. Place after MetricsMiddleware and CorsMiddleware,
+    so shed requests still show up in the metrics and carry CORS headers a
+    browser client can read. Every instance in a worker uses the same
+    controller, so the cap holds across handlers.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = getattr(settings, 'ADMISSION_CONTROL', {})
+        self.enabled = config.get('enabled', True)
+        self.exempt_paths = tuple(config.get('exempt_paths', ('/metrics', '/events/')))
+        self.expensive_paths = tuple(config.get('expensive_paths', ('/login/', '/refresh-token/', '/batch/')))
+        self.retry_after = str(config.get('retry_after', 1))
+        # Shared with the other handler's chain (api_app.stateless)
+        self.controller = admission.get_controller()
+
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _bypass(self, request):
+        return not self.enabled or request.path.startswith(self.exempt_paths)
+
+    def _shed(self):
+        response = JsonResponse({'error': 'Server busy, retry shortly'}, status=503)
+        response['Retry-After'] = self.retry_after
+        return response
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self._bypass(request):
+            return self.get_response(request)
+
+        priority = admission.classify(request, self.expensive_paths)
+        with metrics.phase('admission'):
+            admitted = self.controller.acquire(priority)
+        if not admitted:
+            return self._shed()
+        try:
+            return self.get_response(request)
+        finally:
+            self.controller.release(priority)
+
+    async def __acall__(self, request):
+        if self._bypass(request):
+            return await self.get_response(request)
+
+        priority = admission.classify(request, self.expensive_paths)
+        with metrics.phase('admission'):
+            admitted = await self.controller.aacquire(priority)
+        if not admitted:
+            return self._shed()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.controller.release(priority)
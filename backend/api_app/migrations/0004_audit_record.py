@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_app', '0003_change_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('actor', models.CharField(max_length=150)),
+                ('action', models.CharField(max_length=20)),
+                ('resource', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField(null=True)),
+                ('timestamp', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resource', 'object_id', 'timestamp'], name='api_app_aud_resourc_39c088_idx'), models.Index(fields=['actor', 'timestamp'], name='api_app_aud_actor_47bc56_idx'), models.Index(fields=['timestamp'], name='api_app_aud_timesta_f56b6d_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_app', '0005_admin_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='auditrecord',
+            name='api_app_aud_resourc_39c088_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='auditrecord',
+            name='api_app_aud_actor_47bc56_idx',
+        ),
+        migrations.AddIndex(
+            model_name='auditrecord',
+            index=models.Index(fields=['resource', 'object_id', '-id'], name='api_app_aud_resourc_9238bf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditrecord',
+            index=models.Index(fields=['actor', '-id'], name='api_app_aud_actor_09918e_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_app', '0007_backfill_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPatient',
+            fields=[
+                ('patient_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('first_name', models.CharField(max_length=50)),
+                ('last_name', models.CharField(max_length=50)),
+                ('blood', models.CharField(max_length=50)),
+                ('updated_at', models.DateTimeField()),
+                ('change_seq', models.BigIntegerField(default=0)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:05
+
+from django.db import migrations, models
+import api_app.online_schema
+
+
+class Migration(migrations.Migration):
+    # The index is built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ('api_app', '0008_archived_patient'),
+    ]
+
+    operations = [
+        api_app.online_schema.AddNullableField(
+            model_name='archivedpatient',
+            name='hospital_group',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        api_app.online_schema.AddNullableField(
+            model_name='patient',
+            name='hospital_group',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        api_app.online_schema.AddIndexOnline(
+            model_name='patient',
+            index=models.Index(fields=['hospital_group', 'patient_id'], name='api_app_pat_hospita_01f84b_idx'),
+        ),
+    ]
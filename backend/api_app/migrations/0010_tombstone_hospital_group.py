@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:46
+
+from django.db import migrations, models
+import api_app.online_schema
+
+
+class Migration(migrations.Migration):
+    # The index is built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ('api_app', '0009_patient_hospital_group'),
+    ]
+
+    operations = [
+        api_app.online_schema.AddNullableField(
+            model_name='tombstone',
+            name='hospital_group',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        api_app.online_schema.AddIndexOnline(
+            model_name='tombstone',
+            index=models.Index(fields=['resource', 'hospital_group', 'change_seq'], name='api_app_tom_resourc_b12b63_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:02
+
+import django.db.models.functions.text
+from django.db import migrations, models
+import api_app.online_schema
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ('api_app', '0010_tombstone_hospital_group'),
+    ]
+
+    operations = [
+        api_app.online_schema.AddIndexOnline(
+            model_name='hospital',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='api_app_hos_lower_name_idx'),
+        ),
+        api_app.online_schema.AddIndexOnline(
+            model_name='patient',
+            index=models.Index(django.db.models.functions.text.Lower('last_name'), django.db.models.functions.text.Lower('first_name'), name='api_app_pat_lower_name_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='api_app_pat_last_na_f5102d_idx',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:09
+
+from django.db import migrations, models
+import api_app.online_schema
+
+
+class Migration(migrations.Migration):
+    # The index is built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ('api_app', '0011_admin_lower_search_indexes'),
+    ]
+
+    operations = [
+        api_app.online_schema.AddNullableField(
+            model_name='auditrecord',
+            name='first_object_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        api_app.online_schema.AddNullableField(
+            model_name='auditrecord',
+            name='last_object_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        api_app.online_schema.AddNullableField(
+            model_name='auditrecord',
+            name='object_ranges',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        api_app.online_schema.AddIndexOnline(
+            model_name='auditrecord',
+            index=models.Index(fields=['resource', 'first_object_id', 'last_object_id'], name='api_app_aud_resourc_7c0b3f_idx'),
+        ),
+    ]
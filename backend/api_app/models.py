@@ -1,17 +1,90 @@
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import F
+from django.db.models.functions import Lower
 
 # Create your models here.
-class Patient(models.Model):
+class ChangeCounter(models.Model):
+    """
+    Single-row counter handing out the global change sequence
+    """
+    value = models.BigIntegerField(default=0)
+    # Tombstones up to this sequence have been purged
+    purged_through = models.BigIntegerField(default=0)
+
+
+def next_change_seq(using='default'):
+    """
+    Allocate the next change sequence number. Must run inside the transaction
+    that writes the change: the counter row stays locked until it commits, so
+    changes become visible in sequence order.
+    """
+    return allocate_change_seqs(1, using)[0]
+
+
+def allocate_change_seqs(count, using='default'):
+    """
+    Allocate `count` consecutive change sequence numbers in one update, with
+    the same transaction requirement as next_change_seq()
+    """
+    ChangeCounter.objects.using(using).filter(pk=1).update(value=F('value') + count)
+    last = ChangeCounter.objects.using(using).values_list('value', flat=True).get(pk=1)
+    return range(last - count + 1, last + 1)
+
+
+class ChangeTrackedModel(models.Model):
+    """
+    Stamps every save with a new change sequence number.
+    QuerySet.update() and bulk_create() bypass save() and are not tracked.
+    """
+    change_seq = models.BigIntegerField(default=0, db_index=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            self.change_seq = next_change_seq(using)
+            super().save(*args, **kwargs)
+
+
+class Patient(ChangeTrackedModel):
     patient_id = models.BigAutoField(primary_key=True)
     first_name= models.CharField(max_length=50)
     last_name= models.CharField(max_length=50)
     blood= models.CharField(max_length=50)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Shard key: patients are stored in their hospital group's database
+    # (api_app.sharding). Null means the default group.
+    hospital_group = models.CharField(max_length=50, null=True, blank=True)
 
     def __str__(self):
         return self.first_name
 
+    class Meta:
+        indexes = [
+            # Admin prefix search (api_app.admin.prefix_range)
+            models.Index(Lower('last_name'), Lower('first_name'), name='api_app_pat_lower_name_idx'),
+            models.Index(fields=['hospital_group', 'patient_id']),
+        ]
+
+
+class ArchivedPatient(models.Model):
+    """
+    Patient moved out of the hot table by api_app.archive, with the same
+    columns. Only the primary key is indexed.
+    """
+    patient_id = models.BigIntegerField(primary_key=True)
+    first_name = models.CharField(max_length=50)
+    last_name = models.CharField(max_length=50)
+    blood = models.CharField(max_length=50)
+    updated_at = models.DateTimeField()
+    change_seq = models.BigIntegerField(default=0)
+    hospital_group = models.CharField(max_length=50, null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
 
-class Hospital(models.Model):
+
+class Hospital(ChangeTrackedModel):
     hospital_id = models.BigAutoField(primary_key=True)
     name = models.CharField(max_length=100)
     address = models.TextField()
@@ -26,4 +99,73 @@ class Hospital(models.Model):
 
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['name']),
+            models.Index(Lower('name'), name='api_app_hos_lower_name_idx'),
+        ]
+
+
+class Tombstone(models.Model):
+    """
+    Record of a deleted object so delta sync clients can drop it
+    """
+    resource = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    change_seq = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+    # Shard key of a deleted patient, so a group's change feed and
+    # rebalancing pick only its own tombstones
+    hospital_group = models.CharField(max_length=50, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource', 'change_seq']),
+            models.Index(fields=['resource', 'hospital_group', 'change_seq']),
+        ]
+
+
+class BackfillProgress(models.Model):
+    """
+    How far a batched backfill has got, so it can resume after the last batch
+    """
+    name = models.CharField(max_length=200, unique=True)
+    last_pk = models.BigIntegerField(null=True)
+    rows = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True)
+
+
+class AuditRecord(models.Model):
+    """
+    Append-only record of one user action (one request), written in batches
+    by api_app.audit. A single object is stored in object_id; the objects of
+    a list as inclusive id ranges, bounded by first/last_object_id.
+    """
+    actor = models.CharField(max_length=150)
+    action = models.CharField(max_length=20)
+    resource = models.CharField(max_length=20)
+    # Null for multi-object actions and when a list returned no rows
+    object_id = models.BigIntegerField(null=True)
+    # [[first, last], ...] of a multi-object action, in id order
+    object_ranges = models.JSONField(null=True, blank=True)
+    first_object_id = models.BigIntegerField(null=True, blank=True)
+    last_object_id = models.BigIntegerField(null=True, blank=True)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Lookups are listed newest first, so the id order comes from the index
+            models.Index(fields=['resource', 'object_id', '-id']),
+            # Multi-object records whose id span contains a looked-up id
+            models.Index(fields=['resource', 'first_object_id', 'last_object_id']),
+            models.Index(fields=['actor', '-id']),
+            models.Index(fields=['timestamp']),
+        ]
 
+    def covers(self, object_id):
+        """
+        Whether the action touched `object_id`
+        """
+        if self.object_ranges is None:
+            return self.object_id == object_id
+        return any(first <= object_id <= last for first, last in self.object_ranges)
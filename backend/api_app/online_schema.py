@@ -0,0 +1,271 @@
+"""
+Online schema changes for large tables: migration operations that add
+nullable columns and build indexes without long locks, and backfills that
+run in small throttled batches keyed on the primary key, resumable from the
+last batch committed
+"""
+import math
+import time
+from django.db import NotSupportedError, connections, router, transaction
+from django.db.migrations.operations import AddField, AddIndex
+from django.db.migrations.operations.base import Operation
+from django.db.models import F, NOT_PROVIDED
+from django.utils import timezone
+from api_app.models import BackfillProgress, allocate_change_seqs
+
+# Backfills on tables this small run during migrate
+INLINE_BACKFILL_ROWS = 10000
+
+# Rows read and sorted to estimate an index build
+INDEX_SAMPLE_ROWS = 100000
+
+
+class AddNullableField(AddField):
+    """
+    AddField restricted to columns every backend adds without rewriting the
+    table: nullable, no default, not unique. Populate it with RunBackfill.
+    """
+
+    def __init__(self, model_name, name, field, preserve_default=True):
+        if not field.null:
+            raise ValueError(f'{model_name}.{name} must be null=True to be added online')
+        if field.has_default() or getattr(field, 'db_default', NOT_PROVIDED) is not NOT_PROVIDED:
+            raise ValueError(f'{model_name}.{name} must not have a default; backfill it instead')
+        if field.unique or field.primary_key:
+            raise ValueError(f'{model_name}.{name} must not be unique to be added online')
+        super().__init__(model_name, name, field, preserve_default)
+
+    def describe(self):
+        return f'Add nullable field {self.name} to {self.model_name} (no table rewrite)'
+
+
+class AddIndexOnline(AddIndex):
+    """
+    AddIndex that does not block writers where the backend allows it:
+    CREATE INDEX CONCURRENTLY on PostgreSQL (the migration must set
+    atomic = False) and LOCK=NONE on MySQL. SQLite has no online index
+    build, so the index is built in one statement holding the write lock;
+    `online_schema estimate` reports for how long.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            if schema_editor.atomic_migration:
+                raise NotSupportedError('AddIndexOnline needs a non-atomic migration (atomic = False) on PostgreSQL')
+            schema_editor.add_index(model, self.index, concurrently=True)
+        elif vendor == 'mysql':
+            schema_editor.execute(f'{self.index.create_sql(model, schema_editor)} ALGORITHM=INPLACE LOCK=NONE')
+        else:
+            schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if schema_editor.connection.vendor == 'postgresql' and not schema_editor.atomic_migration:
+            schema_editor.remove_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, self.index)
+
+    def describe(self):
+        return f'Create index {self.index.name} on {self.model_name} without blocking writers where supported'
+
+
+class RunBackfill(Operation):
+    """
+    Set `field_name` to `value` (an expression such as Upper('last_name'))
+    on rows where it is still null.
+
+    During migrate this only runs for tables under INLINE_BACKFILL_ROWS
+    rows (new and test databases); larger tables are left for
+    `manage.py online_schema backfill`, which runs every pending backfill in
+    throttled batches.
+    """
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, field_name, value, batch_size=1000):
+        self.model_name = model_name
+        self.field_name = field_name
+        self.value = value
+        self.batch_size = batch_size
+
+    def deconstruct(self):
+        kwargs = {
+            'model_name': self.model_name,
+            'field_name': self.field_name,
+            'value': self.value,
+        }
+        if self.batch_size != 1000:
+            kwargs['batch_size'] = self.batch_size
+        return self.__class__.__qualname__, [], kwargs
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        using = schema_editor.connection.alias
+        if not self.allow_migrate_model(using, model):
+            return
+        if pending_rows(model, self.field_name, None, using) <= INLINE_BACKFILL_ROWS:
+            for _ in backfill_batches(model, self.field_name, self.value, self.batch_size, using=using):
+                pass
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def describe(self):
+        return f'Backfill {self.model_name}.{self.field_name}'
+
+    @property
+    def migration_name_fragment(self):
+        return f'backfill_{self.model_name.lower()}_{self.field_name.lower()}'
+
+
+def pending_rows(model, field_name, after, using='default'):
+    """
+    Rows still to backfill after primary key `after`
+    """
+    queryset = model._default_manager.using(using).filter(**{f'{field_name}__isnull': True})
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    return queryset.count()
+
+
+def backfill_batches(model, field_name, value, batch_size, after=None, using='default', on_batch=None):
+    """
+    Update rows in primary key order, one short transaction per batch,
+    yielding (last primary key, rows updated) after each commit. `on_batch`
+    is called inside the batch's transaction to record progress atomically.
+
+    Rows still get change sequence numbers so delta sync clients receive the
+    new values.
+    """
+    manager = model._default_manager.using(using)
+    tracked = any(field.name == 'change_seq' for field in model._meta.concrete_fields)
+    while True:
+        keys = manager.order_by('pk').values_list('pk', flat=True)
+        if after is not None:
+            keys = keys.filter(pk__gt=after)
+        keys = list(keys[:batch_size])
+        if not keys:
+            return
+        first, last = keys[0], keys[-1]
+        with transaction.atomic(using=using):
+            updates = {field_name: value}
+            if tracked:
+                # One sequence number per key in the range, in key order
+                seqs = allocate_change_seqs(last - first + 1, using)
+                updates['change_seq'] = F('pk') + (seqs[0] - first)
+            updated = manager.filter(
+                pk__gte=first, pk__lte=last, **{f'{field_name}__isnull': True}
+            ).update(**updates)
+            if on_batch:
+                on_batch(last, updated)
+        after = last
+        yield last, updated
+
+
+def run_backfill(name, model, field_name, value, batch_size=1000, pause=0.1, using='default', progress=None):
+    """
+    Run a backfill to completion, resuming after the last committed batch
+    recorded for `name`. Sleeps `pause` seconds between batches so other
+    writers get the lock.
+
+    Progress is kept in the default database. Backfills of a shard record
+    it after each batch commits; a batch interrupted in between is redone,
+    which only touches the rows it left null.
+    """
+    state, _ = BackfillProgress.objects.get_or_create(name=name)
+    if state.completed_at:
+        return state
+
+    def record(last, updated):
+        BackfillProgress.objects.filter(pk=state.pk).update(last_pk=last, rows=F('rows') + updated)
+
+    # In the batch's own transaction when both live in the same database
+    on_batch = record if using == 'default' else None
+    for last, updated in backfill_batches(model, field_name, value, batch_size, state.last_pk, using, on_batch):
+        if on_batch is None:
+            record(last, updated)
+        if progress:
+            progress(last, updated)
+        time.sleep(pause)
+
+    BackfillProgress.objects.filter(pk=state.pk).update(completed_at=timezone.now())
+    state.refresh_from_db()
+    return state
+
+
+def estimate_backfill(model, field_name, value, batch_size=1000, pause=0.1, after=None, using='default'):
+    """
+    (rows, batches, seconds) for a backfill, timing one batch in a
+    transaction that is rolled back
+    """
+    rows = pending_rows(model, field_name, after, using)
+    if not rows:
+        return 0, 0, 0.0
+    started = time.perf_counter()
+    with transaction.atomic(using=using):
+        for _ in backfill_batches(model, field_name, value, batch_size, after, using):
+            break
+        transaction.set_rollback(True, using=using)
+    batches = math.ceil(rows / batch_size)
+    return rows, batches, batches * (time.perf_counter() - started + pause)
+
+
+def estimate_index(model, fields, using='default'):
+    """
+    (rows, seconds) for building an index on `fields`, timing a read and
+    sort of up to INDEX_SAMPLE_ROWS rows and scaling by n log n
+    """
+    from api_app.admin import estimated_row_count
+
+    rows = estimated_row_count(model, using)
+    if not rows:
+        return 0, 0.0
+    ordering = [field.lstrip('-') for field in fields]
+    sample = list(
+        model._default_manager.using(using).order_by('pk').values_list('pk', flat=True)[INDEX_SAMPLE_ROWS - 1:INDEX_SAMPLE_ROWS]
+    )
+    queryset = model._default_manager.using(using).order_by(*ordering).values_list(*ordering)
+    if sample:
+        queryset = queryset.filter(pk__lte=sample[0])
+    started = time.perf_counter()
+    sampled = len(list(queryset.iterator(chunk_size=10000)))
+    elapsed = time.perf_counter() - started
+    if sampled < 2:
+        return rows, elapsed
+    scale = (rows * math.log(max(rows, 2))) / (sampled * math.log(sampled))
+    return rows, elapsed * max(scale, 1)
+
+
+def migration_backfills():
+    """
+    (name, model, operation, database) for every RunBackfill in a migration
+    applied to the default database or a patient shard. Names of shard
+    backfills end in @<alias>.
+    """
+    from django.apps import apps
+    from django.db.migrations.loader import MigrationLoader
+    from api_app.sharding import shard_aliases
+
+    backfills = []
+    for using in shard_aliases():
+        loader = MigrationLoader(connections[using])
+        for key in sorted(loader.applied_migrations):
+            migration = loader.graph.nodes.get(key)
+            if migration is None:
+                continue
+            for index, operation in enumerate(migration.operations):
+                if isinstance(operation, RunBackfill):
+                    model = apps.get_model(key[0], operation.model_name)
+                    if router.allow_migrate_model(using, model):
+                        name = f'{key[0]}.{key[1]}.{index}'
+                        backfills.append((name if using == 'default' else f'{name}@{using}', model, operation, using))
+    return backfills
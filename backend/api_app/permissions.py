@@ -2,6 +2,35 @@
 Custom permissions for role-based access control
 """
 from rest_framework import permissions
+from api_app import metrics
+from keycloak_config import PERMISSIONS
+
+
+def compile_permission_table(permissions_map):
+    """
+    Flatten {resource: {action: [roles]}} into {(resource, action): frozenset(roles)}
+    """
+    return {
+        (resource, action): frozenset(roles)
+        for resource, actions in permissions_map.items()
+        for action, roles in actions.items()
+    }
+
+
+PERMISSION_TABLE = compile_permission_table(PERMISSIONS)
+
+
+def has_resource_permission(token_payload, required_permission):
+    """
+    Check a "resource:action" permission against the roles in a token payload
+    """
+    try:
+        resource, action = required_permission.split(':')
+    except ValueError:
+        return False
+    user_roles = token_payload.get('realm_access', {}).get('roles', [])
+    required_roles = PERMISSION_TABLE.get((resource, action), frozenset())
+    return not required_roles.isdisjoint(user_roles)
 
 class HasRolePermission(permissions.BasePermission):
     """
@@ -31,6 +60,10 @@ class HasResourcePermission(permissions.BasePermission):
     """
     
     def has_permission(self, request, view):
+        with metrics.phase('permission'):
+            return self._has_permission(request, view)
+
+    def _has_permission(self, request, view):
         # Check if user is authenticated
         if not request.user.is_authenticated:
             return False
@@ -40,32 +73,5 @@ class HasResourcePermission(permissions.BasePermission):
         if not required_permission:
             return True  # No permission requirement, allow access
             
-        # Parse required permission (format: "resource:action")
-        try:
-            resource, action = required_permission.split(':')
-        except ValueError:
-            return False
-            
-        # Get user roles from token payload
-        token_payload = getattr(request, 'token_payload', {})
-        user_roles = token_payload.get('realm_access', {}).get('roles', [])
-        
-        # Define permission mappings
-        permissions = {
-            'patient': {
-                'view': ['admin', 'doctor', 'nurse', 'receptionist', 'viewer'],
-                'create': ['admin', 'doctor', 'nurse', 'receptionist'],
-                'update': ['admin', 'doctor', 'nurse'],
-                'delete': ['admin', 'doctor']
-            },
-            'hospital': {
-                'view': ['admin', 'doctor', 'nurse', 'receptionist', 'viewer'],
-                'create': ['admin'],
-                'update': ['admin'],
-                'delete': ['admin']
-            }
-        }
-        
-        # Check if user has required permission
-        required_roles = permissions.get(resource, {}).get(action, [])
-        return any(role in user_roles for role in required_roles) 
\ No newline at end of file
+        # Check the "resource:action" permission against the token's roles
+        return has_resource_permission(getattr(request, 'token_payload', {}), required_permission)
\ No newline at end of file
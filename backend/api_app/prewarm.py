@@ -0,0 +1,57 @@
+"""
+Worker prewarm: pay one-off startup costs before the worker takes traffic.
+
+Database connections are not opened here: Django's connections are per
+thread, so one opened on the importing thread is never used by a request
+thread. The permission table is compiled when api_app.permissions is
+imported.
+"""
+import os
+import time
+from django.urls import get_resolver
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _prefetch_signing_keys():
+    from keycloak_config import get_signing_keys
+    get_signing_keys()
+
+
+def _warm_orm_and_serializers():
+    from api_app.models import Patient, Hospital
+    from api_app.serializers import PatientSerializer, HospitalSerializer
+
+    get_resolver().url_patterns
+    for model, serializer_class in ((Patient, PatientSerializer), (Hospital, HospitalSerializer)):
+        # Compile the list query and build the serializer fields once
+        str(model.objects.all().query)
+        serializer_class(context={'request': None}).fields
+
+
+STEPS = [
+    ('signing_keys', _prefetch_signing_keys),
+    ('orm_serializers', _warm_orm_and_serializers),
+]
+
+
+def prewarm():
+    """
+    Run every prewarm step, returning {step: seconds}. A failing step (for
+    example Keycloak being unreachable) is logged and does not stop startup.
+    """
+    timings = {}
+    for name, step in STEPS:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f"Prewarm step {name} failed: {e}")
+        timings[name] = time.perf_counter() - started
+    logger.info(f"Worker prewarmed: {timings}")
+    return timings
+
+
+def prewarm_enabled():
+    return os.environ.get('DJANGO_PREWARM', '1') not in ('0', 'false', 'False')
@@ -0,0 +1,188 @@
+"""
+Query budgets and N+1 detection for viewsets
+"""
+import re
+import traceback
+from collections import Counter
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+from django.urls import reverse
+import logging
+
+logger = logging.getLogger(__name__)
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+_NUMBER = re.compile(r'\b\d+\b')
+
+# Frames from these locations are skipped when looking for the offending call site
+_LIBRARY_MARKERS = ('site-packages', 'dist-packages', '/django/', '/rest_framework/', __file__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised in strict mode when a view issues more queries than its budget
+    """
+
+
+def query_budget(max_queries):
+    """
+    Decorator to declare the query budget of a custom viewset action
+    """
+    def decorator(func):
+        func.query_budget = max_queries
+        return func
+    return decorator
+
+
+def sql_shape(sql):
+    """
+    Normalize SQL so that queries differing only by parameters compare equal
+    """
+    return _NUMBER.sub('?', _IN_LIST.sub('IN (...)', sql))
+
+
+def _call_site():
+    """
+    Return the innermost application frame of the current stack
+    """
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        if not any(marker in frame.filename for marker in _LIBRARY_MARKERS):
+            return f'{frame.filename}:{frame.lineno} in {frame.name}'
+    return 'unknown'
+
+
+class QueryTracker:
+    """
+    Database execute wrapper counting queries and spotting repeated SQL shapes
+    """
+
+    def __init__(self, repeat_threshold=None):
+        self.repeat_threshold = repeat_threshold or getattr(settings, 'QUERY_BUDGET_REPEAT_THRESHOLD', 3)
+        self.count = 0
+        self.shapes = Counter()
+        self.call_sites = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        shape = sql_shape(sql)
+        self.shapes[shape] += 1
+        # Only walk the stack once per repeated shape to keep tracking cheap
+        if self.shapes[shape] == self.repeat_threshold:
+            self.call_sites[shape] = _call_site()
+        return execute(sql, params, many, context)
+
+    def track(self):
+        """
+        Context manager installing the tracker on every database connection
+        """
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+        return stack
+
+    def repeated(self):
+        """
+        Return (shape, count, call_site) for every SQL shape seen at least repeat_threshold times
+        """
+        return [
+            (shape, count, self.call_sites.get(shape, 'unknown'))
+            for shape, count in self.shapes.most_common()
+            if count >= self.repeat_threshold
+        ]
+
+    def report(self, label, budget):
+        lines = [f'{label} issued {self.count} queries (budget {budget})']
+        for shape, count, call_site in self.repeated():
+            lines.append(f'  N+1 suspect x{count} at {call_site}: {shape}')
+        return '\n'.join(lines)
+
+
+def is_strict():
+    """
+    Budgets raise when QUERY_BUDGET_STRICT is set; tests turn it on explicitly
+    """
+    return bool(getattr(settings, 'QUERY_BUDGET_STRICT', False))
+
+
+class QueryBudgetMixin:
+    """
+    Viewset mixin enforcing per-action query budgets.
+
+    Budgets are declared with a `query_budgets` dict keyed by action name,
+    or with the @query_budget decorator on custom actions.
+    """
+    query_budgets = {}
+    # Queries the authentication step issued (user provisioning on first
+    # sight); not part of the action's budget
+    auth_queries = 0
+
+    def get_query_budget(self):
+        handler = getattr(self, self.action, None) if self.action else None
+        budget = getattr(handler, 'query_budget', None)
+        if budget is None:
+            budget = self.query_budgets.get(self.action)
+        return budget
+
+    def dispatch(self, request, *args, **kwargs):
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', True):
+            return super().dispatch(request, *args, **kwargs)
+
+        tracker = self.query_tracker = QueryTracker()
+        with tracker.track():
+            response = super().dispatch(request, *args, **kwargs)
+
+        budget = self.get_query_budget()
+        if budget is not None and tracker.count - self.auth_queries > budget:
+            enforce_budget(tracker.report(f'{self.__class__.__name__}.{self.action}', budget + self.auth_queries))
+        return response
+
+    def perform_authentication(self, request):
+        tracker = getattr(self, 'query_tracker', None)
+        before = tracker.count if tracker else 0
+        super().perform_authentication(request)
+        if tracker:
+            self.auth_queries = tracker.count - before
+
+
+def enforce_budget(message):
+    """
+    Raise or log an over-budget report depending on is_strict()
+    """
+    if is_strict():
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def assert_router_query_budgets(router, client, actions=('list', 'retrieve')):
+    """
+    Test helper: request every registered router endpoint and fail if one
+    has no budget or goes over it. `client` must be authenticated.
+    """
+    from django.test.utils import override_settings
+
+    failures = []
+    for prefix, viewset, basename in router.registry:
+        budgets = getattr(viewset, 'query_budgets', {})
+        for action in actions:
+            if action not in budgets:
+                failures.append(f'{viewset.__name__}.{action} has no query budget')
+                continue
+            if action == 'list':
+                url = reverse(f'{basename}-list')
+            else:
+                obj = viewset.queryset.order_by().first()
+                if obj is None:
+                    continue
+                url = reverse(f'{basename}-detail', args=[obj.pk])
+
+            try:
+                with override_settings(QUERY_BUDGET_STRICT=True):
+                    response = client.get(url)
+            except QueryBudgetExceeded as e:
+                failures.append(f'GET {url}: {e}')
+                continue
+            if response.status_code >= 400:
+                failures.append(f'GET {url} returned {response.status_code}')
+    if failures:
+        raise QueryBudgetExceeded('\n'.join(failures))
@@ -0,0 +1,219 @@
+"""
+Query plan checks for viewsets: capture the SQL of each endpoint, run
+EXPLAIN QUERY PLAN on SQLite and report full table scans and temp B-tree
+sorts on large tables, with the index that would avoid them
+"""
+import re
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.urls import reverse
+
+# Tables with fewer rows than this are not reported
+DEFAULT_MIN_ROWS = 10000
+
+_MAIN_TABLE = re.compile(r'\bFROM "(\w+)"')
+_CLAUSES = re.compile(r' (WHERE|GROUP BY|ORDER BY|LIMIT|OFFSET) ')
+_CONDITION = re.compile(r'"(\w+)"\."(\w+)" (=|>=|<=|>|<|IN\b|BETWEEN\b|LIKE\b|GLOB\b|IS\b)')
+_ORDER_COLUMN = re.compile(r'"(\w+)"\."(\w+)" (ASC|DESC)')
+# SQLite 3.36+ prints "SCAN t", older versions "SCAN TABLE t"
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(.*)$')
+_TEMP_SORT = re.compile(r'^USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT)')
+
+
+class QueryPlanRegression(AssertionError):
+    """
+    Raised when an endpoint's queries scan or sort a large table without an index
+    """
+
+
+class PlanCapture:
+    """
+    Database execute wrapper recording every SELECT with its parameters.
+
+    With `row_limit`, SELECTs return at most that many rows so endpoints can
+    be exercised against a large database without reading it all; the plan
+    is still taken from the original statement.
+    """
+
+    def __init__(self, row_limit=None):
+        self.row_limit = row_limit
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many and sql.lstrip().upper().startswith('SELECT'):
+            self.queries.append((sql, params))
+            if self.row_limit is not None:
+                sql = f'SELECT * FROM ({sql}) LIMIT {int(self.row_limit)}'
+        return execute(sql, params, many, context)
+
+
+def explain(sql, params, using='default'):
+    """
+    EXPLAIN QUERY PLAN detail lines for one statement
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def _split_clauses(sql):
+    """
+    {'WHERE': ..., 'ORDER BY': ...} for the outermost query
+    """
+    clauses = {}
+    parts = _CLAUSES.split(sql)
+    for keyword, text in zip(parts[1::2], parts[2::2]):
+        clauses.setdefault(keyword, text)
+    return clauses
+
+
+def _field_names(model, columns):
+    by_column = {field.column: field.name for field in model._meta.concrete_fields}
+    names = []
+    for column, descending in columns:
+        name = by_column.get(column, column)
+        name = f'-{name}' if descending else name
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def suggest_index(sql, table, sort):
+    """
+    The index a query on `table` is missing: equality columns first, then
+    the sort columns for a temp B-tree sort, or the first range column for a
+    scan. Returns a description, or None if nothing in the query could use one.
+    """
+    model = next((m for m in apps.get_models() if m._meta.db_table == table), None)
+    clauses = _split_clauses(sql)
+    equality, ranges = [], []
+    for alias, column, operator in _CONDITION.findall(clauses.get('WHERE', '')):
+        if alias == table:
+            (equality if operator in ('=', 'IN', 'IS') else ranges).append((column, False))
+    if sort:
+        ordering = [
+            (column, direction == 'DESC')
+            for alias, column, direction in _ORDER_COLUMN.findall(clauses.get('ORDER BY', ''))
+            if alias == table
+        ]
+        columns = equality + ordering
+    else:
+        columns = equality + ranges[:1]
+    if not columns:
+        return None
+    if model is None:
+        return f'index on {table} ({", ".join(column for column, _ in columns)})'
+    fields = ', '.join(repr(name) for name in _field_names(model, columns))
+    return f'models.Index(fields=[{fields}]) on {model.__name__}'
+
+
+def find_problems(sql, plan, table_sizes, min_rows=DEFAULT_MIN_ROWS):
+    """
+    Full table scans and temp B-tree sorts in `plan` on tables with at least
+    `min_rows` rows. A scan of a query without a WHERE clause reads the whole
+    table by design and is not reported.
+    """
+    match = _MAIN_TABLE.search(sql)
+    main_table = match.group(1) if match else None
+    has_where = 'WHERE' in _split_clauses(sql)
+    problems = []
+    for detail in plan:
+        scan = _SCAN.match(detail)
+        if scan and 'USING' not in scan.group(2):
+            table, sort = scan.group(1), False
+            if not has_where and table == main_table:
+                continue
+        elif _TEMP_SORT.match(detail) and main_table:
+            table, sort = main_table, True
+        else:
+            continue
+        rows = table_sizes(table)
+        if rows < min_rows:
+            continue
+        suggestion = suggest_index(sql, table, sort)
+        problems.append(
+            f'{detail} ({rows} rows); '
+            + (f'missing {suggestion}' if suggestion else 'no index applies, the query needs a filter')
+        )
+    return problems
+
+
+def _table_sizes(using):
+    from api_app.admin import estimated_row_count
+
+    models = {model._meta.db_table: model for model in apps.get_models()}
+    sizes = {}
+
+    def size(table):
+        if table not in sizes:
+            model = models.get(table)
+            sizes[table] = estimated_row_count(model, using) if model else 0
+        return sizes[table]
+    return size
+
+
+def endpoint_urls(router, actions=('list', 'retrieve')):
+    """
+    (label, url) for the list, retrieve and GET list actions of every router
+    endpoint, plus each query string in a viewset's `plan_filters`
+    """
+    for prefix, viewset, basename in router.registry:
+        if 'list' in actions:
+            list_url = reverse(f'{basename}-list')
+            yield f'{viewset.__name__}.list', list_url
+            for query in getattr(viewset, 'plan_filters', ()):
+                yield f'{viewset.__name__}.list?{query}', f'{list_url}?{query}'
+        if 'retrieve' in actions:
+            obj = viewset.queryset.order_by().first()
+            if obj is not None:
+                yield f'{viewset.__name__}.retrieve', reverse(f'{basename}-detail', args=[obj.pk])
+        for extra in viewset.get_extra_actions():
+            if not extra.detail and 'get' in extra.mapping:
+                yield f'{viewset.__name__}.{extra.__name__}', reverse(f'{basename}-{extra.url_name}')
+
+
+def check_router_query_plans(router, client, min_rows=DEFAULT_MIN_ROWS, row_limit=None, using='default'):
+    """
+    Request every endpoint with `client` (authenticated) and return
+    (label, sql, problems) for each query with plan problems
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        raise ImproperlyConfigured(f'Query plan checks use EXPLAIN QUERY PLAN and need SQLite, not {connection.vendor}')
+    table_sizes = _table_sizes(using)
+    results = []
+    for label, url in endpoint_urls(router):
+        capture = PlanCapture(row_limit)
+        with connection.execute_wrapper(capture):
+            response = client.get(url)
+        if response.status_code >= 400:
+            results.append((label, url, [f'GET {url} returned {response.status_code}']))
+            continue
+        seen = set()
+        for sql, params in capture.queries:
+            if sql in seen:
+                continue
+            seen.add(sql)
+            problems = find_problems(sql, explain(sql, params, using), table_sizes, min_rows)
+            if problems:
+                results.append((label, sql, problems))
+    return results
+
+
+def format_report(results):
+    lines = []
+    for label, sql, problems in results:
+        lines.append(f'{label}: {sql}')
+        lines.extend(f'  {problem}' for problem in problems)
+    return '\n'.join(lines)
+
+
+def assert_router_query_plans(router, client, min_rows=DEFAULT_MIN_ROWS):
+    """
+    Test helper: fail if any router endpoint scans or sorts a table of at
+    least `min_rows` rows without an index. `client` must be authenticated.
+    """
+    results = check_router_query_plans(router, client, min_rows)
+    if results:
+        raise QueryPlanRegression(format_report(results))
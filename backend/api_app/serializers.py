@@ -1,12 +1,44 @@
 from rest_framework import serializers
-from api_app.models import Patient, Hospital
+from api_app.models import Patient, Hospital, AuditRecord
+from api_app import metrics
 
-class PatientSerializer(serializers.HyperlinkedModelSerializer):
+class TimedListSerializer(serializers.ListSerializer):
+    """
+    List serializer that records its work as the 'serialize' request phase
+    """
+    @property
+    def data(self):
+        with metrics.phase('serialize'):
+            return super().data
+
+class TimedSerializerMixin:
+    """
+    Records serializer output as the 'serialize' request phase
+    """
+    @property
+    def data(self):
+        with metrics.phase('serialize'):
+            return super().data
+
+class PatientSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Patient
-        fields = ['patient_id','last_name','first_name','blood'] 
+        fields = ['patient_id','last_name','first_name','blood','hospital_group']
+        list_serializer_class = TimedListSerializer
+
+    def create(self, validated_data):
+        # Saved from the instance so the shard router sees its hospital group
+        patient = Patient(**validated_data)
+        patient.save()
+        return patient
 
-class HospitalSerializer(serializers.HyperlinkedModelSerializer):
+class HospitalSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Hospital
-        fields = ['hospital_id', 'name', 'address', 'phone', 'email', 'capacity', 'created_at', 'updated_at'] 
\ No newline at end of file
+        fields = ['hospital_id', 'name', 'address', 'phone', 'email', 'capacity', 'created_at', 'updated_at']
+        list_serializer_class = TimedListSerializer
+
+class AuditRecordSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AuditRecord
+        fields = ['id', 'actor', 'action', 'resource', 'object_id', 'object_ranges', 'timestamp']
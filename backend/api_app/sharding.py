@@ -0,0 +1,411 @@
+"""
+Hospital-keyed sharding: each patient lives in the database of its hospital
+group. Lists for one group read one database; other lists read every
+database in parallel and merge by primary key.
+
+Every shard hands out patient ids from its own range (shard index shifted
+by SHARD_ID_BITS), so ids stay unique across databases and a retrieve goes
+straight to the shard that created the row. A row moved by rebalancing is
+found by asking the other shards.
+"""
+import contextvars
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured, ValidationError as DjangoValidationError
+from django.db import connections, transaction
+from django.db.models.constants import OnConflict
+from django.http import Http404
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from api_app.models import Patient, ArchivedPatient, ChangeCounter, Tombstone, allocate_change_seqs
+
+# Low bits of an id left to each shard's sequence; 2**40 ids per shard keeps
+# ids of the first 8192 shards below 2**53, exact in JavaScript
+SHARD_ID_BITS = 40
+
+SHARD_KEY_FIELD = 'hospital_group'
+
+# Models stored per shard; anything else only exists in 'default'
+SHARDED_MODELS = (Patient, ArchivedPatient)
+
+# Tables every shard needs: the sharded models and the delta sync bookkeeping
+# their writes update
+SHARD_TABLES = {'patient', 'archivedpatient', 'changecounter', 'tombstone'}
+
+# Backends ensure_id_range can move the patient id sequence on
+ID_RANGE_VENDORS = ('sqlite', 'postgresql')
+
+
+def shard_aliases():
+    """
+    Database aliases holding patients, 'default' first
+    """
+    return getattr(settings, 'SHARDING', {}).get('shards', ['default'])
+
+
+def is_sharded():
+    return len(shard_aliases()) > 1
+
+
+def shard_for_key(key):
+    """
+    Database alias for a hospital group: the SHARDING['groups'] entry, else
+    a stable hash over the shards. Patients without a group live in 'default'.
+    """
+    aliases = shard_aliases()
+    if not key:
+        return aliases[0]
+    alias = getattr(settings, 'SHARDING', {}).get('groups', {}).get(key)
+    if alias is not None:
+        return alias
+    return aliases[zlib.crc32(key.encode()) % len(aliases)]
+
+
+def home_shard(pk):
+    """
+    Database alias whose id range contains `pk`
+    """
+    aliases = shard_aliases()
+    try:
+        index = int(pk) >> SHARD_ID_BITS
+    except (TypeError, ValueError):
+        return aliases[0]
+    return aliases[index] if 0 <= index < len(aliases) else aliases[0]
+
+
+class ShardRouter:
+    """
+    Database router sending patient writes to their group's shard. Reads
+    without an instance go to 'default'; viewsets pick the shard with
+    QuerySet.using(). Shards only get the tables patients need.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_instance(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_instance(model, hints.get('instance'))
+
+    def _db_for_instance(self, model, instance):
+        if model not in SHARDED_MODELS or instance is None:
+            return None
+        # A loaded row stays where it is until rebalance_shards moves it
+        return instance._state.db or shard_for_key(getattr(instance, SHARD_KEY_FIELD))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db and obj2._state.db:
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == 'default' or db not in shard_aliases():
+            return None
+        return app_label == 'api_app' and (model_name is None or model_name in SHARD_TABLES)
+
+
+def ensure_id_range(using):
+    """
+    Move a shard's patient id sequence to the start of its range. Safe to
+    repeat: a sequence already past the start is left alone.
+    """
+    index = shard_aliases().index(using)
+    if index == 0:
+        return
+    start = index << SHARD_ID_BITS
+    connection = connections[using]
+    table = Patient._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+            elif row[0] < start:
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                'SELECT setval(pg_get_serial_sequence(%s, %s), GREATEST(%s, (SELECT COALESCE(MAX({pk}), 0) FROM {table})))'.format(
+                    pk=connection.ops.quote_name(Patient._meta.pk.column), table=connection.ops.quote_name(table),
+                ),
+                [table, Patient._meta.pk.column, start],
+            )
+        else:
+            raise ImproperlyConfigured(f'Shard {using!r} uses {connection.vendor}: id ranges need one of {", ".join(ID_RANGE_VENDORS)}')
+
+
+def check_shard_vendors(app_configs=None, **kwargs):
+    """
+    System check: every shard after the first needs an id range, so catch
+    unsupported backends before migrate gets to them
+    """
+    errors = []
+    for alias in shard_aliases()[1:]:
+        vendor = connections[alias].vendor
+        if vendor not in ID_RANGE_VENDORS:
+            errors.append(checks.Error(
+                f'Shard {alias!r} uses {vendor}, which has no patient id range support',
+                hint=f'Use one of {", ".join(ID_RANGE_VENDORS)} for shards, or remove {alias!r} from SHARDING["shards"]',
+                id='api_app.E001',
+            ))
+    return errors
+
+
+def set_id_ranges(sender, using, **kwargs):
+    """
+    post_migrate receiver: give every shard its id range once its tables exist
+    """
+    if sender.name == 'api_app' and using in shard_aliases():
+        ensure_id_range(using)
+
+
+def merge_by_pk(*streams):
+    """
+    Merge streams sorted by primary key, dropping repeats: a row being moved
+    between shards can briefly exist in both
+    """
+    last = None
+    for obj in heapq.merge(*streams, key=attrgetter('pk')):
+        if obj.pk != last:
+            last = obj.pk
+            yield obj
+
+
+def _run_in_thread(context, func, arg):
+    try:
+        return context.run(func, arg)
+    finally:
+        # Worker threads open their own connections; don't leak them
+        connections.close_all()
+
+
+def fan_out(func, querysets):
+    """
+    [func(queryset) for each queryset], run in parallel threads when there
+    are several. Threads share the request's metrics context.
+    """
+    if len(querysets) == 1:
+        return [func(querysets[0])]
+    max_workers = min(len(querysets), getattr(settings, 'SHARDING', {}).get('max_workers', 8))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(_run_in_thread, contextvars.copy_context(), func, queryset)
+            for queryset in querysets
+        ]
+        return [future.result() for future in futures]
+
+
+def _insert_sql(model, connection, columns):
+    quote = connection.ops.quote_name
+    ignore = connection.ops.on_conflict_suffix_sql(model._meta.concrete_fields, OnConflict.IGNORE, None, None)
+    return (
+        f'{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} {quote(model._meta.db_table)} '
+        f'({", ".join(quote(model._meta.get_field(name).column) for name in columns)}) '
+        f'VALUES ({", ".join(["%s"] * len(columns))}){ignore}'
+    )
+
+
+def delete_rows(model, using, pks):
+    """
+    DELETE rows by primary key in one statement, without the post_delete
+    handlers: a moved row is not a deletion for delta sync
+    """
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote(model._meta.db_table)} WHERE {quote(model._meta.pk.column)} IN ({", ".join(["%s"] * len(pks))})',
+            pks,
+        )
+
+
+def advance_counter(source, target):
+    """
+    Raise the target's change counter and purge mark to at least the
+    source's. Run inside the target transaction of each move, so rows and
+    tombstones moved there get sequences above any cursor the source handed
+    out, and cursors the source would reject stay rejected.
+    """
+    counter = ChangeCounter.objects.using(source).filter(pk=1).values_list('value', 'purged_through').first()
+    if counter is None:
+        return
+    value, purged_through = counter
+    counters = ChangeCounter.objects.using(target).filter(pk=1)
+    counters.filter(value__lt=value).update(value=value)
+    counters.filter(purged_through__lt=purged_through).update(purged_through=purged_through)
+
+
+def move_tombstones(key, source, target, batch_size=1000):
+    """
+    Move the tombstones of hospital group `key` from `source` to `target`
+    with new change sequences there, yielding the tombstones moved per
+    batch, so clients of a moved group still see its deletions. An
+    interrupted move can leave a tombstone in both, which only repeats a
+    deletion.
+    """
+    tombstones = Tombstone.objects.using(source).filter(**{SHARD_KEY_FIELD: key})
+    while True:
+        batch = list(tombstones.order_by('change_seq')[:batch_size])
+        if not batch:
+            return
+        with transaction.atomic(using=target):
+            advance_counter(source, target)
+            seqs = allocate_change_seqs(len(batch), target)
+            Tombstone.objects.using(target).bulk_create([
+                Tombstone(resource=tombstone.resource, object_id=tombstone.object_id, change_seq=seq,
+                          deleted_at=tombstone.deleted_at, hospital_group=key)
+                for seq, tombstone in zip(seqs, batch)
+            ])
+        with transaction.atomic(using=source):
+            delete_rows(Tombstone, source, [tombstone.pk for tombstone in batch])
+        yield len(batch)
+
+
+def move_batches(model, key, source, target, batch_size=1000):
+    """
+    Move the rows of hospital group `key` from database `source` to
+    `target`, `batch_size` rows at a time, yielding the rows moved per batch.
+
+    Each batch is inserted into the target (skipping rows already there)
+    and committed before it is deleted from the source, so an interrupted
+    move leaves duplicates that the next run clears, never lost rows. Moved
+    rows get new change sequence numbers from the target, above every
+    sequence the source has handed out (advance_counter()).
+    """
+    columns = [field.attname for field in model._meta.concrete_fields]
+    seq_index = columns.index('change_seq')
+    pk_index = columns.index(model._meta.pk.attname)
+    rows = model._default_manager.using(source).filter(**{SHARD_KEY_FIELD: key})
+    connection = connections[target]
+    sql = _insert_sql(model, connection, columns)
+    fields = [model._meta.get_field(name) for name in columns]
+    while True:
+        batch = list(rows.order_by('pk').values_list(*columns)[:batch_size])
+        if not batch:
+            return
+        with transaction.atomic(using=target), connection.cursor() as cursor:
+            advance_counter(source, target)
+            seqs = allocate_change_seqs(len(batch), target)
+            cursor.executemany(sql, [
+                [
+                    seq if index == seq_index else field.get_db_prep_save(value, connection)
+                    for index, (field, value) in enumerate(zip(fields, row))
+                ]
+                for seq, row in zip(seqs, batch)
+            ])
+        with transaction.atomic(using=source):
+            delete_rows(model, source, [row[pk_index] for row in batch])
+        yield len(batch)
+
+
+class ShardMixin:
+    """
+    Patient viewset mixin routing queries by hospital group. With
+    ?hospital_group= a list reads that group's shard only; without it, it
+    reads all shards in parallel. Retrieve and writes go to the id's home
+    shard, then to the others if the row was moved. The change feed needs
+    ?hospital_group= since change sequences are per database.
+    """
+    shard_key_field = SHARD_KEY_FIELD
+    shard_queries = 0
+
+    def shard_key(self):
+        return self.request.GET.get(self.shard_key_field) or None
+
+    def get_query_budget(self):
+        budget = super().get_query_budget()
+        return budget + self.shard_queries if budget is not None else None
+
+    def tombstone_filters(self):
+        filters = super().tombstone_filters()
+        key = self.shard_key()
+        return {**filters, self.shard_key_field: key} if key is not None else filters
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        if lookup is not None:
+            return queryset.using(home_shard(lookup)) if is_sharded() else queryset
+        key = self.shard_key()
+        if self.action == 'changes':
+            if key is None and is_sharded():
+                raise ValidationError({self.shard_key_field: 'Required: change sequences are kept per shard'})
+        elif self.action == 'list':
+            # The order a cross-shard list is merged in, so one shard or many read the same
+            queryset = queryset.order_by('pk')
+        if key is not None:
+            return queryset.using(shard_for_key(key)).filter(**{self.shard_key_field: key})
+        return queryset
+
+    def shard_querysets(self, queryset):
+        """
+        One queryset per database a list has to read
+        """
+        if not is_sharded() or self.shard_key() is not None:
+            return [queryset]
+        return [queryset.using(alias) for alias in shard_aliases()]
+
+    def lookup_databases(self, lookup):
+        """
+        Databases to search for an object, its home shard first
+        """
+        home = home_shard(lookup)
+        return [home] + [alias for alias in shard_aliases() if alias != home]
+
+    def _list_shards(self, queryset):
+        querysets = self.shard_querysets(queryset)
+        self.shard_queries += len(querysets) - 1
+        shards = fan_out(lambda shard: list(shard.order_by('pk')), querysets)
+        return list(merge_by_pk(*shards))
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if len(self.shard_querysets(queryset)) == 1:
+            return super().list(request, *args, **kwargs)
+        objects = self._list_shards(queryset)
+        page = self.paginate_queryset(objects)
+        if page is not None:
+            objects = page
+        data = self.serialize_list(objects) if hasattr(self, 'serialize_list') else self.get_serializer(objects, many=True).data
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def _find_moved(self, lookup):
+        queryset = self.filter_queryset(super().get_queryset()).filter(**{self.lookup_field: lookup})
+        others = [queryset.using(alias) for alias in self.lookup_databases(lookup)[1:]]
+        self.shard_queries += len(others)
+        found = [obj for obj in fan_out(lambda queryset: queryset.first(), others) if obj is not None]
+        return found[0] if found else None
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            if not is_sharded():
+                raise
+            try:
+                obj = self._find_moved(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+            except (ValueError, TypeError, DjangoValidationError):
+                obj = None
+            if obj is None:
+                raise
+            self.check_object_permissions(self.request, obj)
+            return obj
+
+    async def alist_objects(self):
+        queryset = self.get_queryset()
+        if len(self.shard_querysets(queryset)) == 1:
+            return await super().alist_objects()
+        return await sync_to_async(self._list_shards)(self.filter_queryset(queryset))
+
+    async def aget_missing_object(self, lookup):
+        if is_sharded():
+            obj = await sync_to_async(self._find_moved)(lookup)
+            if obj is not None:
+                return obj
+        return await super().aget_missing_object(lookup)
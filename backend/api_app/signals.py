@@ -0,0 +1,48 @@
+"""
+Model signal handlers publishing change events
+"""
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from api_app.models import Patient, Hospital, Tombstone, next_change_seq
+from api_app.serializers import PatientSerializer, HospitalSerializer
+from api_app import events
+
+SERIALIZERS = {
+    Patient: ('patient', PatientSerializer),
+    Hospital: ('hospital', HospitalSerializer),
+}
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=Hospital)
+def publish_saved(sender, instance, created, using, **kwargs):
+    if not events.has_listeners():
+        return
+    resource, serializer_class = SERIALIZERS[sender]
+    data = serializer_class(instance, context={'request': None}).data
+    action = 'created' if created else 'updated'
+    transaction.on_commit(lambda: events.publish(resource, action, instance.pk, data), using=using)
+
+
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Hospital)
+def record_tombstone(sender, instance, using, **kwargs):
+    # Runs inside the delete's transaction, keeping sequence order
+    resource, _ = SERIALIZERS[sender]
+    Tombstone.objects.using(using).create(
+        resource=resource,
+        object_id=instance.pk,
+        change_seq=next_change_seq(using),
+        hospital_group=getattr(instance, 'hospital_group', None),
+    )
+
+
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Hospital)
+def publish_deleted(sender, instance, using, **kwargs):
+    if not events.has_listeners():
+        return
+    resource, _ = SERIALIZERS[sender]
+    object_id = instance.pk
+    transaction.on_commit(lambda: events.publish(resource, 'deleted', object_id), using=using)
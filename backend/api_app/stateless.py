@@ -0,0 +1,106 @@
+"""
+Stateless API mode: bearer-token requests to the API go through a second
+Django handler built from STATELESS_API['middleware'], with no session,
+CSRF, messages or Keycloak middleware. DRF views authenticate the token
+themselves, so none of that work is needed for them. Other requests
+(admin, browser sessions, CORS preflights) use the full MIDDLEWARE chain.
+"""
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+
+
+def _config():
+    return getattr(settings, 'STATELESS_API', {})
+
+
+def enabled():
+    return _config().get('enabled', True)
+
+
+class StatelessHandlerMixin:
+    """
+    Handler loading STATELESS_API['middleware'] instead of MIDDLEWARE
+    """
+
+    def load_middleware(self, is_async=False):
+        # BaseHandler reads settings.MIDDLEWARE; swap it while this handler
+        # is built (once, at startup, before any request is served)
+        full = settings.MIDDLEWARE
+        settings.MIDDLEWARE = _config().get('middleware', full)
+        try:
+            super().load_middleware(is_async)
+        finally:
+            settings.MIDDLEWARE = full
+
+
+class StatelessWSGIHandler(StatelessHandlerMixin, WSGIHandler):
+    pass
+
+
+class StatelessASGIHandler(StatelessHandlerMixin, ASGIHandler):
+    pass
+
+
+def _excluded_prefixes():
+    return tuple(_config().get('exclude_prefixes', ('/admin/', '/static/', '/media/')))
+
+
+def is_stateless(path, authorization, query_string, excluded):
+    """
+    Whether a request can skip the session middleware: an API path carrying
+    a bearer token (in the header, or ?access_token= for EventSource).
+    TokenAuthentication verifies the token either way.
+    """
+    if path.startswith(excluded):
+        return False
+    if authorization[:7].lower() == 'bearer ':
+        return True
+    return 'access_token=' in query_string and any(
+        pair.startswith('access_token=') for pair in query_string.split('&')
+    )
+
+
+def wsgi_app(full, stateless):
+    excluded = _excluded_prefixes()
+
+    def app(environ, start_response):
+        if is_stateless(environ.get('PATH_INFO', ''), environ.get('HTTP_AUTHORIZATION', ''), environ.get('QUERY_STRING', ''), excluded):
+            return stateless(environ, start_response)
+        return full(environ, start_response)
+    return app
+
+
+def asgi_app(full, stateless):
+    excluded = _excluded_prefixes()
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'http':
+            authorization = next((value for name, value in scope.get('headers', ()) if name == b'authorization'), b'')
+            if is_stateless(scope.get('path', ''), authorization.decode('latin-1'), scope.get('query_string', b'').decode('latin-1'), excluded):
+                return await stateless(scope, receive, send)
+        return await full(scope, receive, send)
+    return app
+
+
+def get_wsgi_application():
+    """
+    django.core.wsgi.get_wsgi_application() routing bearer API requests
+    through the stateless handler
+    """
+    django.setup(set_prefix=False)
+    if not enabled():
+        return WSGIHandler()
+    return wsgi_app(WSGIHandler(), StatelessWSGIHandler())
+
+
+def get_asgi_application():
+    """
+    django.core.asgi.get_asgi_application() routing bearer API requests
+    through the stateless handler
+    """
+    django.setup(set_prefix=False)
+    if not enabled():
+        return ASGIHandler()
+    return asgi_app(ASGIHandler(), StatelessASGIHandler())
@@ -0,0 +1,69 @@
+"""
+Delta sync: return only what changed since a client's cursor
+"""
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from api_app.models import ChangeCounter, Tombstone
+from api_app.query_budget import query_budget
+
+DEFAULT_CHANGES_LIMIT = 500
+MAX_CHANGES_LIMIT = 5000
+
+
+class DeltaSyncMixin:
+    """
+    Adds GET /<resource>/changes/?since=<cursor>&limit=<n> to a viewset.
+
+    Returns objects saved and ids deleted after the cursor, in change order,
+    with the cursor to send next time. Omit `since` for a full initial sync.
+    A cursor older than purged tombstones gets 410 and must resync in full.
+    """
+    resource_name = None
+
+    def tombstone_filters(self):
+        """
+        Extra Tombstone filters matching get_queryset(), e.g. its shard key
+        """
+        return {}
+
+    @query_budget(5)
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        try:
+            since = int(request.query_params.get('since', -1))
+            limit = min(int(request.query_params.get('limit', DEFAULT_CHANGES_LIMIT)), MAX_CHANGES_LIMIT)
+        except ValueError:
+            return Response({'error': 'since and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({'error': 'limit must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Sharded viewsets route the queryset; the counter and tombstones live beside it
+        queryset = self.get_queryset()
+        using = queryset.db
+        if since >= 0:
+            purged_through = ChangeCounter.objects.using(using).values_list('purged_through', flat=True).filter(pk=1).first() or 0
+            if since < purged_through:
+                return Response({'error': 'Cursor expired, resync from scratch'}, status=status.HTTP_410_GONE)
+
+        objects = list(queryset.filter(change_seq__gt=since).order_by('change_seq')[:limit])
+        tombstones = list(
+            Tombstone.objects.using(using).filter(resource=self.resource_name, change_seq__gt=since, **self.tombstone_filters())
+            .order_by('change_seq').values_list('change_seq', 'object_id')[:limit]
+        )
+
+        # Merge both streams in sequence order and cut at the limit
+        changes = sorted(
+            [(obj.change_seq, obj, None) for obj in objects] +
+            [(seq, None, object_id) for seq, object_id in tombstones],
+            key=lambda change: change[0],
+        )[:limit]
+
+        changed = [obj for _, obj, _ in changes if obj is not None]
+        deleted = [object_id for _, obj, object_id in changes if obj is None]
+        return Response({
+            'results': self.get_serializer(changed, many=True).data,
+            'deleted': deleted,
+            'cursor': str(changes[-1][0] if changes else since),
+            'has_more': len(changes) == limit,
+        })
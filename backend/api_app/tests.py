@@ -1,3 +1,1071 @@
-from django.test import TestCase
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import threading
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.db import connections
+from django.db.models import Value
+from django.test import AsyncRequestFactory, Client, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.datastructures import CaseInsensitiveMapping
+from jwcrypto import jwk, jwt
+import keycloak_config
+import keycloak_provisioning
+from keycloak_config import KEYCLOAK_CONFIG
+from api_app import admission, audit, batch, coalesce, fragments, health, memory, metrics, sharding, stateless
+from api_app.admin import PatientAdmin
+from api_app.admission import EXPENSIVE, READ, WRITE, AdmissionController
+from api_app.authentication import TokenAuthentication
+from api_app.log import REDACTED, JSONFormatter
+from api_app.archive import archived_fields
+from api_app.models import ArchivedPatient, AuditRecord, BackfillProgress, ChangeCounter, Hospital, Patient, Tombstone
+from api_app.online_schema import RunBackfill, estimate_backfill, pending_rows, run_backfill
+from api_app.query_budget import QueryBudgetExceeded, assert_router_query_budgets
+from api_app.query_plans import assert_router_query_plans, explain, find_problems
+from api_app.urls import router
+from api_app.views import HospitalViewSet, PatientViewSet
 
-# Create your tests here.
+# Enough rows that an unindexed scan or sort of a table is reported
+SEED_ROWS = 300
+
+_realm_key = jwk.JWK.generate(kty='RSA', size=2048, kid='test')
+
+
+def signed_token(username='admin1', roles=('admin',), lifetime=3600, key=_realm_key):
+    """
+    Access token signed with the test realm key, or with `key` to forge one
+    """
+    now = int(time.time())
+    token = jwt.JWT(
+        header={'alg': 'RS256', 'kid': key.key_id},
+        claims={
+            'preferred_username': username,
+            'realm_access': {'roles': list(roles)},
+            'azp': KEYCLOAK_CONFIG['client_id'],
+            'iat': now,
+            'exp': now + lifetime,
+        },
+    )
+    token.make_signed_token(key)
+    return token.serialize()
+
+
+class ApiTestMixin:
+    """
+    Serves the test realm key as the cached JWKS, so tokens verify without
+    Keycloak. Query budgets raise; audit is off, as its writer thread
+    outlives the test database.
+    """
+
+    def setUp(self):
+        super().setUp()
+        overrides = override_settings(QUERY_BUDGET_STRICT=True, AUDIT_LOG={**settings.AUDIT_LOG, 'enabled': False})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        keys = jwk.JWKSet()
+        keys.add(jwk.JWK(**json.loads(_realm_key.export_public())))
+        for name, value in (('_signing_keys', keys), ('_signing_keys_fetched', time.time())):
+            patcher = mock.patch.object(keycloak_config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Row estimates and throttle counters must not leak between tests
+        for cache in caches.all():
+            cache.clear()
+
+    def client_for(self, roles=('admin',)):
+        return Client(HTTP_AUTHORIZATION=f'Bearer {signed_token(roles=roles)}')
+
+
+def seed(rows=SEED_ROWS):
+    Hospital.objects.bulk_create([Hospital(name=f'Hospital {i}', address=f'{i} Main Road', phone='020-5550100') for i in range(rows)])
+    Patient.objects.bulk_create([
+        Patient(first_name=f'First {i}', last_name=f'Last {i}', blood='A+', hospital_group=('north', 'south')[i % 2])
+        for i in range(rows)
+    ])
+
+
+class RouterQueryPlanTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        seed()
+
+    def test_router_endpoints_use_indexes(self):
+        assert_router_query_plans(router, self.client_for(), min_rows=SEED_ROWS // 2)
+
+    def test_command_leaves_no_writes_or_audit_records(self):
+        token = signed_token(username='plan-checker')
+        # The command's client sends Host: localhost
+        audit_on = override_settings(AUDIT_LOG={**settings.AUDIT_LOG, 'enabled': True}, ALLOWED_HOSTS=['localhost'])
+        with audit_on, mock.patch.object(audit, 'get_buffer') as buffer:
+            call_command('check_query_plans', token=token, min_rows=SEED_ROWS // 2, stdout=io.StringIO())
+        buffer.assert_not_called()
+        self.assertFalse(User.objects.filter(username='plan-checker').exists())
+
+    def test_unindexed_filter_is_reported(self):
+        sql, params = Patient.objects.filter(blood='A+').query.sql_with_params()
+        problems = find_problems(sql, explain(sql, params), lambda table: SEED_ROWS, min_rows=SEED_ROWS // 2)
+        self.assertEqual(len(problems), 1)
+        self.assertIn("models.Index(fields=['blood']) on Patient", problems[0])
+
+
+class RouterQueryBudgetTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        seed()
+
+    def test_router_endpoints_stay_within_budgets(self):
+        assert_router_query_budgets(router, self.client_for())
+
+    def test_over_budget_patient_list_fails(self):
+        with mock.patch.dict(PatientViewSet.query_budgets, {'list': 0}):
+            with self.assertLogs('django.request', 'ERROR'), self.assertRaisesRegex(QueryBudgetExceeded, r'GET /patient/: PatientViewSet\.list issued'):
+                assert_router_query_budgets(router, self.client_for())
+
+    def test_over_budget_hospital_retrieve_fails(self):
+        with mock.patch.dict(HospitalViewSet.query_budgets, {'retrieve': 0}):
+            with self.assertLogs('django.request', 'ERROR'), self.assertRaisesRegex(QueryBudgetExceeded, r'GET /hospital/\d+/: HospitalViewSet\.retrieve issued'):
+                assert_router_query_budgets(router, self.client_for())
+
+    def test_missing_budget_fails(self):
+        budgets = {action: budget for action, budget in HospitalViewSet.query_budgets.items() if action != 'list'}
+        with mock.patch.object(HospitalViewSet, 'query_budgets', budgets):
+            with self.assertRaisesRegex(QueryBudgetExceeded, 'HospitalViewSet.list has no query budget'):
+                assert_router_query_budgets(router, self.client_for())
+
+
+class EventStreamTests(ApiTestMixin, TestCase):
+    async def read_events(self, response):
+        return [chunk.decode() async for chunk in response.streaming_content]
+
+    async def test_forged_token_is_rejected(self):
+        forger = jwk.JWK.generate(kty='RSA', size=2048, kid=_realm_key.key_id)
+        with self.assertLogs('django.request', 'WARNING'):
+            response = await self.async_client.get('/events/', {'access_token': signed_token(key=forger)})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_stream_ends_when_the_token_expires(self):
+        response = await self.async_client.get('/events/', {'access_token': signed_token(lifetime=1)})
+        self.assertEqual(response.status_code, 200)
+        chunks = await asyncio.wait_for(self.read_events(response), 5)
+        self.assertEqual(chunks[-1], 'event: expired\ndata: {}\n\n')
+
+
+class MemorySummaryTests(TestCase):
+    def test_allocations_are_charged_to_module_and_caller(self):
+        tracemalloc.start(8)
+        self.addCleanup(tracemalloc.stop)
+        decoded = json.loads(json.dumps([f'item {i}' for i in range(1000)]))
+        summary = memory.summarize(tracemalloc.take_snapshot())
+        decoder_bytes, decoder_blocks = summary['module']['json.decoder']
+        self.assertGreaterEqual(decoder_blocks, len(decoded))
+        # The decoder allocated them, on behalf of this test
+        self.assertNotIn('json.decoder', summary['caller'])
+        self.assertGreaterEqual(summary['caller']['api_app.tests'][0], decoder_bytes)
+        self.assertNotIn('api_app.memory', summary['module'])
+
+
+class LogRedactionTests(TestCase):
+    def test_tokens_are_redacted_from_exceptions_and_extras(self):
+        token = signed_token()
+        try:
+            raise ValueError(f'Rejected Authorization: Bearer {token[:20]} ({token})')
+        except ValueError:
+            record = logging.LogRecord('api_app', logging.ERROR, __file__, 0, 'Token check failed', None, sys.exc_info())
+        record.request = f"<ASGIRequest: GET '/events/?access_token={token}'>"
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertNotIn(token[:20], json.dumps(entry))
+        self.assertIn(f'Bearer {REDACTED}', entry['exc'])
+        self.assertEqual(entry['request'], f"<ASGIRequest: GET '/events/?access_token={REDACTED}'>")
+
+
+def wsgi_get(application, path, token=None, query='', **headers):
+    """
+    (status, headers, body) of a GET sent straight to a WSGI application,
+    with extra environ entries from `headers` (HTTP_ORIGIN=...)
+    """
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'testserver',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+    if token:
+        environ['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    environ.update(headers)
+    started = []
+    body = application(environ, lambda status, headers: started.append((int(status.split()[0]), CaseInsensitiveMapping(dict(headers)))))
+    content = b''.join(body)
+    if hasattr(body, 'close'):
+        body.close()
+    return started[0][0], started[0][1], content
+
+
+class StatelessRoutingTests(TestCase):
+    excluded = ('/admin/', '/static/')
+
+    def test_bearer_header_routes_api_paths(self):
+        self.assertTrue(stateless.is_stateless('/hospital/', 'Bearer abc', '', self.excluded))
+        self.assertTrue(stateless.is_stateless('/hospital/', 'bearer abc', '', self.excluded))
+        self.assertFalse(stateless.is_stateless('/admin/', 'Bearer abc', '', self.excluded))
+        self.assertFalse(stateless.is_stateless('/hospital/', 'Basic abc', '', self.excluded))
+        self.assertFalse(stateless.is_stateless('/hospital/', '', '', self.excluded))
+
+    def test_access_token_must_be_an_exact_query_pair(self):
+        self.assertTrue(stateless.is_stateless('/events/', '', 'access_token=abc', self.excluded))
+        self.assertTrue(stateless.is_stateless('/events/', '', 'a=1&access_token=abc', self.excluded))
+        self.assertFalse(stateless.is_stateless('/events/', '', 'my_access_token=abc', self.excluded))
+        self.assertFalse(stateless.is_stateless('/events/', '', 'q=access_token=abc', self.excluded))
+
+    def test_wsgi_app_picks_the_handler(self):
+        calls = []
+        full = lambda environ, start_response: calls.append('full') or []
+        bearer = lambda environ, start_response: calls.append('stateless') or []
+        app = stateless.wsgi_app(full, bearer)
+        app({'PATH_INFO': '/hospital/', 'HTTP_AUTHORIZATION': 'Bearer abc'}, None)
+        app({'PATH_INFO': '/admin/', 'HTTP_AUTHORIZATION': 'Bearer abc'}, None)
+        app({'PATH_INFO': '/hospital/'}, None)
+        self.assertEqual(calls, ['stateless', 'full', 'full'])
+
+
+class StatelessHandlerTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        Hospital.objects.create(name='General', address='1 Main Road', phone='020-5550100')
+        self.full = WSGIHandler()
+        self.stateless = stateless.StatelessWSGIHandler()
+
+    def test_verified_token_is_served_without_a_session(self):
+        status, headers, body = wsgi_get(self.stateless, '/hospital/', signed_token())
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)[0]['name'], 'General')
+        self.assertNotIn('Cookie', headers.get('Vary', ''))
+        self.assertNotIn('Set-Cookie', headers)
+
+    def test_forged_token_is_rejected(self):
+        forger = jwk.JWK.generate(kty='RSA', size=2048, kid=_realm_key.key_id)
+        with self.assertLogs('django.request', 'WARNING'):
+            status, _, _ = wsgi_get(self.stateless, '/hospital/', signed_token(key=forger))
+        self.assertEqual(status, 401)
+
+    def test_both_chains_share_one_admission_controller(self):
+        controller = admission.get_controller()
+        shed = controller.shed
+        with mock.patch.multiple(controller, max_in_flight=0, max_queue=0):
+            for handler in (self.full, self.stateless):
+                status, headers, _ = wsgi_get(handler, '/hospital/', signed_token(), HTTP_ORIGIN='https://app.example')
+                self.assertEqual(status, 503)
+                self.assertEqual(headers['Retry-After'], '1')
+                # Readable by the browser client that sent it
+                self.assertEqual(headers['Access-Control-Allow-Origin'], 'https://app.example')
+        self.assertEqual(controller.shed, shed + 2)
+
+
+class AdminChangelistTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        seed()
+        self.client.force_login(User.objects.create_superuser('staff', password='unused'))
+
+    def changelist(self, **params):
+        response = self.client.get('/admin/api_app/patient/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def test_cursor_pages_by_primary_key(self):
+        first = self.changelist()
+        ids = [patient.pk for patient in first.result_list]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(len(ids), first.list_per_page)
+        second = self.changelist(after=first.next_cursor)
+        following = [patient.pk for patient in second.result_list]
+        self.assertLess(following[0], ids[-1])
+        self.assertEqual(following, sorted(following, reverse=True))
+
+    def test_column_sort_parameter_is_ignored(self):
+        cl = self.changelist(o='2', after=str(Patient.objects.order_by('-pk')[50].pk))
+        ids = [patient.pk for patient in cl.result_list]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+    def test_search_is_a_case_insensitive_prefix(self):
+        self.assertEqual(len(self.changelist(q='LAST 12').result_list), 11)
+        self.assertEqual([patient.first_name for patient in self.changelist(q='last 12, first 120').result_list], ['First 120'])
+        self.assertEqual(len(self.changelist(q='ast 12').result_list), 0)
+
+    def test_search_uses_the_expression_index(self):
+        queryset, _ = PatientAdmin(Patient, None).get_search_results(None, Patient.objects.order_by('-pk'), 'last 12, first')
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('USING INDEX api_app_pat_lower_name_idx', ' '.join(explain(sql, params)))
+
+
+SHARDS = {'shards': ['default', 'shard_test'], 'groups': {'north': 'shard_test', 'south': 'default'}, 'max_workers': 8}
+
+
+@override_settings(SHARDING=SHARDS)
+class ShardingTests(ApiTestMixin, TransactionTestCase):
+    # Committed rows, so the threads reading shards in parallel see them
+    databases = {'default', 'shard_test'}
+
+    def setUp(self):
+        super().setUp()
+        # The flush between tests removes the counter row its migration created
+        for alias in self.databases:
+            ChangeCounter.objects.using(alias).get_or_create(pk=1)
+        sharding.ensure_id_range('shard_test')
+
+    def patient(self, group, name='Patient', using=None):
+        """
+        Saved like the API saves one: routed by group unless `using` is given
+        """
+        patient = Patient(first_name=name, last_name='Last', blood='A+', hospital_group=group)
+        patient.save(using=using)
+        return patient
+
+    def test_backfill_runs_on_every_shard(self):
+        self.patient(None)
+        self.patient(None, using='shard_test')
+        key = ('api_app', '0099_backfill_patient_hospital_group')
+        loader = mock.Mock(applied_migrations={key}, graph=mock.Mock(nodes={
+            key: mock.Mock(operations=[RunBackfill('patient', 'hospital_group', Value('south'))]),
+        }))
+        with mock.patch('django.db.migrations.loader.MigrationLoader', return_value=loader):
+            call_command('online_schema', 'backfill', '--pause', '0', stdout=io.StringIO())
+
+        for alias in self.databases:
+            self.assertFalse(Patient.objects.using(alias).filter(hospital_group__isnull=True).exists())
+        progress = BackfillProgress.objects.filter(completed_at__isnull=False)
+        name = 'api_app.0099_backfill_patient_hospital_group.0'
+        self.assertEqual(dict(progress.values_list('name', 'rows')), {name: 1, f'{name}@shard_test': 1})
+
+    def test_router_sends_patients_to_their_group(self):
+        router = sharding.ShardRouter()
+        self.assertEqual(router.db_for_write(Patient, instance=Patient(hospital_group='north')), 'shard_test')
+        self.assertEqual(router.db_for_write(Patient, instance=Patient(hospital_group=None)), 'default')
+        self.assertIsNone(router.db_for_write(Hospital, instance=Hospital()))
+        self.assertIsNone(router.db_for_read(Patient))
+        self.assertTrue(router.allow_migrate('shard_test', 'api_app', 'patient'))
+        self.assertFalse(router.allow_migrate('shard_test', 'api_app', 'hospital'))
+
+    def test_each_shard_allocates_ids_from_its_range(self):
+        north = self.patient('north')
+        south = self.patient('south')
+        self.assertEqual(north._state.db, 'shard_test')
+        self.assertEqual(north.pk >> sharding.SHARD_ID_BITS, 1)
+        self.assertEqual(sharding.home_shard(north.pk), 'shard_test')
+        self.assertEqual(sharding.home_shard(south.pk), 'default')
+        # Repeating it leaves a sequence already in the range alone
+        sharding.ensure_id_range('shard_test')
+        again = self.patient('north')
+        self.assertEqual(again.pk, north.pk + 1)
+
+    def test_fan_out_keeps_order_and_context(self):
+        request_id = contextvars.ContextVar('request_id')
+        request_id.set('r1')
+        self.assertEqual(sharding.fan_out(lambda n: (n, request_id.get()), [1, 2, 3]), [(1, 'r1'), (2, 'r1'), (3, 'r1')])
+        self.assertEqual(sharding.fan_out(lambda n: n * 2, [4]), [8])
+
+    def test_lists_are_ordered_by_id_across_and_within_shards(self):
+        for i in range(4):
+            for group in ('south', 'north'):
+                self.patient(group, f'{group} {i}')
+        client = self.client_for()
+        everyone = [patient['patient_id'] for patient in client.get('/patient/').json()]
+        self.assertEqual(len(everyone), 8)
+        self.assertEqual(everyone, sorted(everyone))
+        north = [patient['patient_id'] for patient in client.get('/patient/', {'hospital_group': 'north'}).json()]
+        self.assertEqual(north, sorted(everyone)[4:])
+
+    def test_rebalance_moves_rows_and_tombstones_without_new_deletions(self):
+        moved = [self.patient('north', using='default') for _ in range(3)]
+        moved.pop().delete()
+        ChangeCounter.objects.using('default').filter(pk=1).update(value=1000)
+        call_command('rebalance_shards', batch_size=2, pause=0, stdout=io.StringIO())
+        self.assertFalse(Patient.objects.using('default').filter(hospital_group='north').exists())
+        self.assertFalse(Tombstone.objects.using('default').exists())
+        self.assertEqual(sorted(Patient.objects.using('shard_test').values_list('pk', flat=True)), [patient.pk for patient in moved])
+        self.assertEqual(Tombstone.objects.using('shard_test').count(), 1)
+        self.assertGreater(min(Patient.objects.using('shard_test').values_list('change_seq', flat=True)), 1000)
+
+
+@override_settings(AUTH_THROTTLES={**settings.AUTH_THROTTLES, 'login_ip': {'rate': '30/min', 'burst': 10}, 'login_username': {'rate': '5/min', 'burst': 5}})
+class LoginThrottleTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rejected = mock.Mock(status_code=401, text='', **{'json.return_value': {'error': 'invalid_grant'}})
+        patcher = mock.patch('api_app.views.requests.post', return_value=rejected)
+        self.keycloak = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Every attempt that gets through logs its outcome
+        quiet = mock.patch.object(logging.getLogger('api_app.views'), 'disabled', True)
+        quiet.start()
+        self.addCleanup(quiet.stop)
+
+    def login(self, username='alice'):
+        return self.client.post('/login/', {'username': username, 'password': 'wrong'}, content_type='application/json')
+
+    def test_empty_bucket_is_rejected_before_keycloak(self):
+        with self.assertLogs('django.request', 'WARNING'):
+            statuses = [self.login().status_code for _ in range(6)]
+        self.assertEqual(statuses, [401] * 5 + [429])
+        self.assertEqual(self.keycloak.call_count, 5)
+
+    def test_retry_after_is_the_time_to_the_next_token(self):
+        now = time.time()
+        with mock.patch('time.time', return_value=now), self.assertLogs('django.request', 'WARNING'):
+            responses = [self.login() for _ in range(6)]
+        self.assertEqual(responses[-1].status_code, 429)
+        self.assertEqual(responses[-1]['Retry-After'], '12')
+
+    def test_tokens_refill_over_time(self):
+        now = time.time()
+        with self.assertLogs('django.request', 'WARNING'):
+            with mock.patch('time.time', return_value=now):
+                for _ in range(6):
+                    self.login()
+            # One token is back after one interval (60 s / 5), and only one
+            with mock.patch('time.time', return_value=now + 12):
+                self.assertEqual(self.login().status_code, 401)
+                self.assertEqual(self.login().status_code, 429)
+            # Other usernames have their own bucket
+            self.assertEqual(self.login('bob').status_code, 401)
+        self.assertEqual(self.keycloak.call_count, 7)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def test_reads_are_served_before_earlier_writes(self):
+        controller = AdmissionController(max_in_flight=1)
+        self.assertTrue(controller.acquire(WRITE))
+        with controller._lock:
+            write = controller._try_enter(WRITE)
+            read = controller._try_enter(READ)
+        controller.release(WRITE)
+        self.assertTrue(read.admitted)
+        self.assertFalse(write.admitted)
+        controller.release(READ)
+        self.assertTrue(write.admitted)
+        self.assertEqual(controller.in_flight, 1)
+
+    def test_expensive_requests_get_their_share_of_slots_and_queue(self):
+        controller = AdmissionController(max_in_flight=4, max_queue=4, expensive_share=0.25)
+        self.assertTrue(controller.acquire(EXPENSIVE))
+        with controller._lock:
+            queued = controller._try_enter(EXPENSIVE)
+            # The expensive share of the queue (one place) is taken
+            self.assertIs(controller._try_enter(EXPENSIVE), False)
+        self.assertFalse(queued.admitted)
+        self.assertTrue(controller.acquire(READ))
+        self.assertTrue(controller.acquire(WRITE))
+        self.assertEqual((controller.in_flight, controller.expensive_in_flight, controller.shed), (3, 1, 1))
+        controller.release(EXPENSIVE)
+        self.assertTrue(queued.admitted)
+
+    def test_waiters_give_up_at_the_deadline(self):
+        controller = AdmissionController(max_in_flight=1, queue_timeout=0.01)
+        self.assertTrue(controller.acquire(READ))
+        self.assertFalse(controller.acquire(READ))
+        self.assertEqual((controller.shed, controller.timeouts, controller.queue_depth()), (1, 1, 0))
+        # A slot freed meanwhile is not handed to the waiter that left
+        controller.release(READ)
+        self.assertEqual(controller.in_flight, 0)
+
+    def test_full_queue_is_shed_at_once(self):
+        controller = AdmissionController(max_in_flight=0, max_queue=0, queue_timeout=5)
+        started = time.monotonic()
+        self.assertFalse(controller.acquire(READ))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual((controller.shed, controller.timeouts), (1, 0))
+
+    async def test_async_waiter_is_woken_by_release(self):
+        controller = AdmissionController(max_in_flight=1, queue_timeout=5)
+        self.assertTrue(controller.acquire(READ))
+        waiting = asyncio.ensure_future(controller.aacquire(READ))
+        await asyncio.sleep(0.01)
+        self.assertEqual(controller.queue_depth(), 1)
+        controller.release(READ)
+        self.assertTrue(await asyncio.wait_for(waiting, 1))
+        self.assertEqual(controller.in_flight, 1)
+
+
+class ListSink:
+    def __init__(self, fail=0):
+        self.events = []
+        self.fail = fail
+        self.closed = False
+
+    def write(self, events):
+        if self.fail:
+            self.fail -= 1
+            raise OSError('disk full')
+        self.events.extend(events)
+
+    def close(self):
+        self.closed = True
+
+
+class AuditBufferTests(SimpleTestCase):
+    def test_without_the_writer_thread_records_flush_inline(self):
+        sink = ListSink()
+        buffer = audit.AuditBuffer(sink)
+        buffer.record('alice', 'retrieve', 'patient', [1])
+        self.assertEqual([event[:4] for event in sink.events], [('alice', 'retrieve', 'patient', [1])])
+        self.assertEqual((buffer.pending, buffer.written), ([], 1))
+
+    def test_a_full_batch_wakes_the_writer(self):
+        sink = ListSink()
+        buffer = audit.AuditBuffer(sink, batch_size=2, flush_interval=60)
+        buffer.start()
+        self.addCleanup(buffer.stop)
+        buffer.record('alice', 'list', 'patient', [1, 2])
+        buffer.record('alice', 'list', 'patient', [3])
+        deadline = time.monotonic() + 5
+        while buffer.written < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(sink.events), 2)
+
+    def test_stop_writes_what_is_buffered_and_closes_the_sink(self):
+        sink = ListSink()
+        buffer = audit.AuditBuffer(sink, flush_interval=60)
+        buffer.start()
+        buffer.record('alice', 'delete', 'patient', [4])
+        buffer.stop()
+        self.assertEqual(len(sink.events), 1)
+        self.assertTrue(sink.closed)
+
+    def test_failed_flush_keeps_events_in_order(self):
+        sink = ListSink(fail=1)
+        buffer = audit.AuditBuffer(sink)
+        buffer.pending = [('alice', 'retrieve', 'patient', [1], timezone.now())]
+        with self.assertLogs('api_app.audit', 'ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        buffer.record('bob', 'retrieve', 'patient', [2])
+        self.assertEqual([event[0] for event in sink.events], ['alice', 'bob'])
+        self.assertEqual((buffer.failed, buffer.written), (1, 2))
+
+
+class AuditSinkTests(ApiTestMixin, TestCase):
+    def events(self):
+        now = timezone.now()
+        return [
+            ('alice', 'list', 'patient', [5, 1, 2, 3, 3, 7], now),
+            ('alice', 'retrieve', 'patient', [9], now),
+            ('alice', 'list', 'patient', [], now),
+        ]
+
+    def test_id_ranges(self):
+        self.assertEqual(audit.id_ranges([5, 1, 2, 3, 3, 7]), [[1, 3], [5, 5], [7, 7]])
+        self.assertEqual(audit.id_ranges([]), [])
+
+    def test_database_sink_writes_one_row_per_event(self):
+        audit.DatabaseSink().write(self.events())
+        rows = list(AuditRecord.objects.order_by('id').values_list('object_id', 'object_ranges', 'first_object_id', 'last_object_id'))
+        self.assertEqual(rows, [
+            (None, [[1, 3], [5, 5], [7, 7]], 1, 7),
+            (9, None, None, None),
+            (None, None, None, None),
+        ])
+
+    def test_object_lookup_finds_lists_that_contained_the_id(self):
+        audit.DatabaseSink().write(self.events())
+        client = self.client_for()
+
+        def actions(object_id):
+            response = client.get('/audit/', {'resource': 'patient', 'object_id': object_id})
+            self.assertEqual(response.status_code, 200)
+            return [record['action'] for record in response.json()['results']]
+        self.assertEqual(actions(2), ['list'])
+        self.assertEqual(actions(9), ['retrieve'])
+        # Inside the list's span, but not one of its rows
+        self.assertEqual(actions(4), [])
+
+    def test_file_sink_appends_json_lines_and_rotates(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        sink = audit.FileSink(f'{directory.name}/audit.jsonl', max_bytes=200, fsync=False)
+        self.addCleanup(sink.close)
+        events = self.events()
+        sink.write(events[:1])
+        with open(sink.path) as stream:
+            self.assertEqual(json.loads(stream.readline())['object_ids'], [5, 1, 2, 3, 3, 7])
+        sink.write(events[1:])
+        files = sorted(os.listdir(directory.name))
+        self.assertEqual(len(files), 2)
+        lines = []
+        for name in files:
+            with open(f'{directory.name}/{name}') as stream:
+                lines += [json.loads(line) for line in stream]
+        self.assertEqual(len(lines), 3)
+
+
+class FragmentCacheTests(SimpleTestCase):
+    def test_least_recently_used_fragment_is_evicted(self):
+        cache = fragments.FragmentCache(max_bytes=3 * (fragments.ENTRY_OVERHEAD + 2))
+        cache.set_many([('a', 1, b'{}'), ('b', 1, b'{}'), ('c', 1, b'{}')])
+        cache.get_many([('a', 1)])
+        cache.set_many([('d', 1, b'{}')])
+        self.assertEqual(set(cache.get_many([(key, 1) for key in 'abcd'])), {'a', 'c', 'd'})
+        self.assertEqual(cache.evictions, 1)
+
+    def test_a_new_version_replaces_the_old_one(self):
+        cache = fragments.FragmentCache(max_bytes=10000)
+        cache.set_many([('a', 1, b'{"v":1}')])
+        cache.set_many([('a', 2, b'{"v":2}')])
+        self.assertEqual(cache.get_many([('a', 1)]), {})
+        self.assertEqual(cache.get_many([('a', 2)]), {'a': b'{"v":2}'})
+        self.assertEqual(cache.size, len(b'{"v":2}') + fragments.ENTRY_OVERHEAD)
+
+
+class FragmentListTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        fragments.get_cache().clear()
+        self.hospital = Hospital.objects.create(name='General', address='1 Main Road', phone='020-5550100')
+        Hospital.objects.create(name='Royal', address='2 Main Road', phone='020-5550101')
+        self.client = self.client_for()
+
+    def phones(self):
+        response = self.client.get('/hospital/')
+        self.assertEqual(response.status_code, 200)
+        return [hospital['phone'] for hospital in response.json()]
+
+    def test_unchanged_rows_are_served_from_the_cache(self):
+        self.phones()
+        cache = fragments.get_cache()
+        hits, misses = cache.hits, cache.misses
+        self.phones()
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (2, 0))
+
+    def test_save_bumps_the_version_and_refreshes_the_fragment(self):
+        self.assertEqual(self.phones(), ['020-5550100', '020-5550101'])
+        self.hospital.phone = '020-5550199'
+        self.hospital.save()
+        self.assertEqual(self.phones(), ['020-5550199', '020-5550101'])
+
+    def test_queryset_update_must_bump_a_version_field(self):
+        self.phones()
+        # update() skips save(): no new change_seq, and auto_now is not applied
+        Hospital.objects.filter(pk=self.hospital.pk).update(phone='020-5550199')
+        self.assertEqual(self.phones()[0], '020-5550100')
+        Hospital.objects.filter(pk=self.hospital.pk).update(updated_at=timezone.now())
+        self.assertEqual(self.phones()[0], '020-5550199')
+
+
+class CoalesceKeyTests(SimpleTestCase):
+    def key(self, roles, path='/hospital/'):
+        view = HospitalViewSet(action='list', required_permission='hospital:view')
+        request = SimpleNamespace(method='GET', get_full_path=lambda: path, token_payload={'realm_access': {'roles': list(roles)}})
+        return view.coalesce_key(request)
+
+    def test_callers_with_the_same_permissions_share_a_key(self):
+        self.assertEqual(self.key(['doctor']), self.key(['nurse', 'offline_access']))
+        self.assertNotEqual(self.key(['doctor']), self.key(['doctor'], '/hospital/?hospital_group=north'))
+
+    def test_callers_with_different_permissions_do_not(self):
+        self.assertNotEqual(self.key(['doctor']), self.key(['admin']))
+        self.assertNotEqual(self.key(['viewer']), self.key(['admin', 'viewer']))
+
+
+class CoalesceConcurrencyTests(ApiTestMixin, TransactionTestCase):
+    # Committed rows, so the request threads' connections see them
+    def setUp(self):
+        super().setUp()
+        seed(3)
+        self.tokens = [signed_token(username=f'doctor{i}', roles=('doctor',)) for i in range(4)]
+        # Provision the users up front, so the concurrent requests only read
+        for token in self.tokens:
+            self.assertEqual(Client(HTTP_AUTHORIZATION=f'Bearer {token}').get('/hospital/').status_code, 200)
+
+    def test_identical_gets_share_one_execution_and_are_each_audited(self):
+        leader_started, release_leader = threading.Event(), threading.Event()
+        serialize_list = fragments.FragmentCacheMixin.serialize_list
+        executions = []
+
+        def slow_serialize_list(view, objects):
+            executions.append(view.request.user.get_username())
+            leader_started.set()
+            release_leader.wait(5)
+            return serialize_list(view, objects)
+
+        responses = {}
+
+        def get(token):
+            try:
+                response = Client(HTTP_AUTHORIZATION=f'Bearer {token}').get('/patient/')
+                responses[token] = (response.status_code, response.content)
+            finally:
+                connections.close_all()
+
+        shared = coalesce.flights.shared
+        audit_on = override_settings(AUDIT_LOG={**settings.AUDIT_LOG, 'enabled': True})
+        with audit_on, mock.patch.object(audit, 'record') as record, \
+                mock.patch.object(fragments.FragmentCacheMixin, 'serialize_list', slow_serialize_list):
+            leader = threading.Thread(target=get, args=(self.tokens[0],))
+            leader.start()
+            self.assertTrue(leader_started.wait(5))
+            waiters = [threading.Thread(target=get, args=(token,)) for token in self.tokens[1:]]
+            for waiter in waiters:
+                waiter.start()
+            # Waiters block on the flight; give them time to join it
+            time.sleep(0.2)
+            release_leader.set()
+            for thread in [leader] + waiters:
+                thread.join(10)
+
+        self.assertEqual(executions, ['doctor0'])
+        self.assertEqual(coalesce.flights.shared - shared, 3)
+        self.assertEqual({status for status, _ in responses.values()}, {200})
+        self.assertEqual(len({content for _, content in responses.values()}), 1)
+        audited = sorted(call.args[0] for call in record.call_args_list)
+        self.assertEqual(audited, [f'doctor{i}' for i in range(4)])
+
+
+class BatchTests(ApiTestMixin, TransactionTestCase):
+    # Committed rows, so the fan-out threads' connections see them
+    def setUp(self):
+        super().setUp()
+        seed(3)
+        self.patients = list(Patient.objects.order_by('pk').values_list('pk', flat=True))
+        self.hospital = Hospital.objects.values_list('pk', flat=True).first()
+
+    def post(self, client, *specs):
+        return client.post('/batch/', {'requests': list(specs)}, content_type='application/json')
+
+    def test_consecutive_gets_run_in_parallel_and_writes_are_barriers(self):
+        reads = threading.Barrier(3, timeout=5)
+        run = batch._run
+        threads = []
+
+        def run_and_meet(parent, spec, viewsets):
+            threads.append((spec['method'], threading.get_ident()))
+            if spec['method'] == 'GET' and spec['path'] != '/patient/':
+                # Only returns once all three reads of the run are in flight
+                reads.wait()
+            return run(parent, spec, viewsets)
+
+        with mock.patch.object(batch, '_run', run_and_meet):
+            response = self.post(
+                self.client_for(),
+                {'method': 'GET', 'path': f'/patient/{self.patients[0]}/'},
+                {'method': 'GET', 'path': f'/patient/{self.patients[1]}/'},
+                {'method': 'GET', 'path': f'/hospital/{self.hospital}/'},
+                {'method': 'POST', 'path': '/patient/', 'body': {'first_name': 'New', 'last_name': 'Patient', 'blood': 'O-'}},
+                {'method': 'GET', 'path': '/patient/'},
+            )
+
+        self.assertEqual(response.status_code, 200)
+        responses = response.json()['responses']
+        self.assertEqual([sub['status'] for sub in responses], [200, 200, 200, 201, 200])
+        self.assertEqual([responses[0]['body']['patient_id'], responses[1]['body']['patient_id']], self.patients[:2])
+        self.assertEqual(len({ident for method, ident in threads[:3]}), 3)
+        # The read after the write sees it
+        self.assertIn('New', [patient['first_name'] for patient in responses[4]['body']])
+
+    def test_sub_requests_reuse_the_batch_authentication(self):
+        with mock.patch.object(TokenAuthentication, '_decode', autospec=True, side_effect=TokenAuthentication._decode) as decode:
+            response = self.post(
+                self.client_for(('viewer',)),
+                {'method': 'GET', 'path': f'/patient/{self.patients[0]}/'},
+                {'method': 'GET', 'path': f'/patient/{self.patients[1]}/'},
+                {'method': 'DELETE', 'path': f'/patient/{self.patients[0]}/'},
+            )
+
+        self.assertEqual(decode.call_count, 1)
+        # Sub-requests still check the batch caller's permissions
+        self.assertEqual([sub['status'] for sub in response.json()['responses']], [200, 200, 403])
+        self.assertTrue(Patient.objects.filter(pk=self.patients[0]).exists())
+
+    def test_rejects_invalid_batches(self):
+        client = self.client_for()
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.post(client).status_code, 400)
+            with override_settings(BATCH_MAX_REQUESTS=2):
+                self.assertEqual(self.post(client, *[{'method': 'GET', 'path': '/patient/'}] * 3).status_code, 400)
+            self.assertEqual(Client().post('/batch/', {'requests': []}, content_type='application/json').status_code, 401)
+        responses = self.post(client, {'method': 'TRACE', 'path': '/patient/'}, {'method': 'GET', 'path': '/batch/'}).json()['responses']
+        self.assertEqual([sub['status'] for sub in responses], [400, 404])
+
+
+class ProvisioningQueueTests(TestCase):
+    def fields(self, email):
+        return keycloak_provisioning.user_fields({'email': email, 'roles': ['doctor']})
+
+    def test_syncs_for_one_user_coalesce_into_one_write(self):
+        queue = keycloak_provisioning.ProvisioningQueue()
+        queue.enqueue('alice', self.fields('old@example.com'))
+        queue.enqueue('alice', self.fields('new@example.com'))
+        queue.enqueue('bob', self.fields('bob@example.com'))
+        self.assertEqual(len(queue.pending), 2)
+
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(User.objects.get(username='alice').email, 'new@example.com')
+        # A sync with the values just written is dropped
+        self.assertFalse(queue.enqueue('alice', self.fields('new@example.com')))
+        self.assertEqual(queue.pending, {})
+
+    def test_full_queue_is_flushed_by_the_enqueuing_request(self):
+        queue = keycloak_provisioning.ProvisioningQueue(batch_size=100, flush_interval=60, max_pending=2)
+        # Without a worker every sync is flushed inline
+        self.assertTrue(queue.enqueue('alice', self.fields('alice@example.com')))
+        queue.flush()
+        queue.start()
+        self.addCleanup(queue.stop)
+        self.assertFalse(queue.enqueue('bob', self.fields('bob@example.com')))
+        self.assertTrue(queue.enqueue('carol', self.fields('carol@example.com')))
+
+        User.objects.create(username='dave', email='old@example.com')
+        with mock.patch.object(keycloak_provisioning, 'get_queue', return_value=queue):
+            user = keycloak_provisioning.provision_user({'username': 'dave', 'email': 'new@example.com'})
+        self.assertEqual(user.email, 'new@example.com')
+        self.assertEqual(queue.pending, {})
+        self.assertEqual(User.objects.get(username='dave').email, 'new@example.com')
+
+    def test_restart_after_fork_replaces_the_thread_primitives(self):
+        queue = keycloak_provisioning.ProvisioningQueue(flush_interval=60)
+        queue.enqueue('alice', self.fields('alice@example.com'))
+        primitives = (queue._lock, queue._flush_lock, queue._wakeup, queue._stopping)
+        # As if forked while the parent was shutting its worker down
+        queue._stopping.set()
+
+        queue.restart_after_fork()
+        self.addCleanup(queue.stop)
+        for old, new in zip(primitives, (queue._lock, queue._flush_lock, queue._wakeup, queue._stopping)):
+            self.assertIsNot(old, new)
+        self.assertEqual(queue.pending, {})
+        self.assertTrue(queue._thread.is_alive())
+        self.assertFalse(queue._stopping.is_set())
+
+
+class LastNameFilter:
+    def filter_queryset(self, request, queryset, view):
+        if 'last_name' in request.GET:
+            return queryset.filter(last_name=request.GET['last_name'])
+        return queryset
+
+
+class AsyncReadTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        seed(4)
+        # Archive the first two patients
+        for patient in Patient.objects.order_by('pk')[:2]:
+            ArchivedPatient.objects.create(**{field: getattr(patient, field) for field in archived_fields()})
+            patient.delete()
+        with override_settings(ASYNC_READS=True):
+            self.list_view = PatientViewSet.as_view({'get': 'list'})
+            self.retrieve_view = PatientViewSet.as_view({'get': 'retrieve'})
+
+    def get(self, view, path, **kwargs):
+        request = AsyncRequestFactory().get(path, headers={'Authorization': f'Bearer {signed_token()}'})
+        return view(request, **kwargs)
+
+    async def test_budget_is_enforced_without_metrics_middleware(self):
+        self.assertIsNone(metrics.current_timer())
+        response = await self.get(self.list_view, '/patient/')
+        self.assertEqual(response.status_code, 200)
+        with mock.patch.dict(PatientViewSet.query_budgets, {'list': 0}):
+            with self.assertRaises(QueryBudgetExceeded):
+                await self.get(self.list_view, '/patient/')
+
+    async def test_filter_backends_apply_to_hot_and_archived_rows(self):
+        with mock.patch.object(PatientViewSet, 'filter_backends', [LastNameFilter]):
+            hot = await self.get(self.list_view, '/patient/?last_name=Last 3')
+            both = await self.get(self.list_view, '/patient/?last_name=Last 1&include_archived=1')
+            other = await sync_to_async(Patient.objects.get)(last_name='Last 2')
+            missing = await self.get(self.retrieve_view, f'/patient/{other.pk}/?last_name=Last 3', pk=str(other.pk))
+        self.assertEqual([patient['last_name'] for patient in json.loads(hot.content)], ['Last 3'])
+        self.assertEqual([patient['last_name'] for patient in json.loads(both.content)], ['Last 1'])
+        self.assertEqual(missing.status_code, 404)
+
+
+class BackfillTests(TestCase):
+    def setUp(self):
+        Patient.objects.bulk_create([Patient(first_name=f'First {i}', last_name='Last', blood='A+') for i in range(5)])
+        self.keys = list(Patient.objects.order_by('pk').values_list('pk', flat=True))
+
+    def test_interrupted_backfill_resumes_after_the_last_committed_batch(self):
+        batches = []
+
+        def interrupt_after_first_batch(last, updated):
+            batches.append(last)
+            if len(batches) == 1:
+                raise RuntimeError('interrupted')
+
+        with self.assertRaises(RuntimeError):
+            run_backfill('test.group', Patient, 'hospital_group', Value('north'), batch_size=2, pause=0, progress=interrupt_after_first_batch)
+        state = BackfillProgress.objects.get(name='test.group')
+        self.assertEqual((state.last_pk, state.rows, state.completed_at), (self.keys[1], 2, None))
+        self.assertEqual(pending_rows(Patient, 'hospital_group', None), 3)
+
+        state = run_backfill('test.group', Patient, 'hospital_group', Value('north'), batch_size=2, pause=0, progress=interrupt_after_first_batch)
+        self.assertEqual(batches, [self.keys[1], self.keys[3], self.keys[4]])
+        self.assertEqual(state.rows, 5)
+        self.assertIsNotNone(state.completed_at)
+        self.assertEqual(set(Patient.objects.values_list('hospital_group', flat=True)), {'north'})
+        # Every row got its own change sequence, so delta sync sends it
+        self.assertEqual(len(set(Patient.objects.values_list('change_seq', flat=True))), 5)
+
+    def test_estimate_rolls_back_its_sample_batch(self):
+        counter = ChangeCounter.objects.get(pk=1).value
+        rows, batches, seconds = estimate_backfill(Patient, 'hospital_group', Value('north'), batch_size=2, pause=0)
+        self.assertEqual((rows, batches), (5, 3))
+        self.assertGreater(seconds, 0)
+        self.assertEqual(pending_rows(Patient, 'hospital_group', None), 5)
+        self.assertEqual(ChangeCounter.objects.get(pk=1).value, counter)
+        self.assertEqual(estimate_backfill(Patient, 'first_name', Value('x')), (0, 0, 0.0))
+
+
+class FakeChecks:
+    """
+    Stand-in for health.CHECKS, with results set per test
+    """
+
+    def __init__(self, **results):
+        self.results = results
+        self.calls = []
+
+    def check(self, name):
+        def run():
+            self.calls.append(name)
+            result = self.results[name]
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return run
+
+    def table(self):
+        return {name: (self.check(name), 'interval') for name in self.results}
+
+
+@override_settings(HEALTH_CHECKS={**settings.HEALTH_CHECKS, 'interval': 0.01})
+class HealthMonitorTests(SimpleTestCase):
+    def monitor(self, checks):
+        patcher = mock.patch.object(health, 'CHECKS', checks.table())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        monitor = health.HealthMonitor()
+        # Checks run when the test calls them, not on a thread
+        monitor._pid = os.getpid()
+        return monitor
+
+    def test_body_shows_only_ok_or_fail(self):
+        checks = FakeChecks(database=(True, '2 ok'), keycloak=(False, 'db.internal:8080 refused'), signing_keys=RuntimeError('boom'))
+        monitor = self.monitor(checks)
+        self.assertEqual(monitor.readiness(), (False, b'{"status":"starting"}'))
+
+        with self.assertLogs('api_app.health', 'WARNING') as logs:
+            monitor.run_checks()
+        ready, body = monitor.readiness()
+        self.assertFalse(ready)
+        self.assertEqual(json.loads(body), {'status': 'unready', 'checks': {'database': 'ok', 'keycloak': 'fail', 'signing_keys': 'fail'}})
+        self.assertNotIn(b'internal', body)
+        self.assertEqual(len(logs.records), 2)
+
+        checks.results.update(keycloak=(True, 'HTTP 200'), signing_keys=(True, '10s old'))
+        with self.assertLogs('api_app.health', 'INFO') as logs:
+            monitor._next_run = {}
+            monitor.run_checks()
+        self.assertEqual(monitor.readiness(), (True, b'{"status": "ready", "checks": {"database": "ok", "keycloak": "ok", "signing_keys": "ok"}}'))
+        self.assertEqual(len(logs.records), 2)
+
+    def test_checks_wait_for_their_interval_and_results_go_stale(self):
+        checks = FakeChecks(database=(True, '2 ok'))
+        monitor = self.monitor(checks)
+        with override_settings(HEALTH_CHECKS={**settings.HEALTH_CHECKS, 'interval': 60}):
+            monitor.run_checks()
+            monitor.run_checks()
+            self.assertEqual(checks.calls, ['database'])
+            self.assertTrue(monitor.readiness()[0])
+            monitor._last_round -= 60 * settings.HEALTH_CHECKS['stale_after'] + 1
+            self.assertEqual(monitor.readiness(), (False, b'{"status":"stale","detail":"health checks are not running"}'))
+
+    def test_thread_runs_checks_until_stopped(self):
+        checks = FakeChecks(database=(True, '2 ok'))
+        monitor = self.monitor(checks)
+        monitor._pid = None
+        monitor.ensure_started()
+        monitor.ensure_started()
+        self.addCleanup(monitor.stop)
+        threads = [thread for thread in threading.enumerate() if thread.name == 'health-monitor']
+        self.assertEqual(len(threads), 1)
+        deadline = time.monotonic() + 5
+        while len(checks.calls) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(len(checks.calls), 3)
+        self.assertTrue(monitor.readiness()[0])
+
+        monitor.stop()
+        threads[0].join(5)
+        self.assertFalse(threads[0].is_alive())
+
+    def test_probes_are_answered_before_the_application(self):
+        monitor = self.monitor(FakeChecks(database=(False, 'locked')))
+        app = health.wsgi_app(lambda environ, start_response: start_response('204 No Content', []) or [])
+        responses = []
+
+        def get(path):
+            body = b''.join(app({'PATH_INFO': path}, lambda status, headers: responses.append((status, dict(headers)))))
+            return responses[-1][0], body
+
+        with mock.patch.object(health, 'monitor', monitor):
+            self.assertEqual(get('/health/'), ('200 OK', b'{"status":"ok"}'))
+            self.assertEqual(get('/ready/'), ('503 Service Unavailable', b'{"status":"starting"}'))
+            with self.assertLogs('api_app.health', 'WARNING'):
+                monitor.run_checks()
+            self.assertEqual(get('/ready/'), ('503 Service Unavailable', b'{"status": "unready", "checks": {"database": "fail"}}'))
+            self.assertEqual(responses[-1][1]['Cache-Control'], 'no-store')
+            self.assertEqual(get('/patient/'), ('204 No Content', b''))
+
+
+class MetricsAccessTests(ApiTestMixin, TestCase):
+    def get(self, remote_addr, roles=None):
+        # One user per role, so no claim change is queued for provisioning
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {signed_token(username=roles[0], roles=roles)}'} if roles else {}
+        return Client(REMOTE_ADDR=remote_addr, **headers).get('/metrics')
+
+    def test_scrapers_on_allowed_networks_need_no_token(self):
+        self.assertEqual(self.get('127.0.0.1').status_code, 200)
+        with override_settings(METRICS_ALLOWED_NETWORKS=['10.0.0.0/8']):
+            self.assertEqual(self.get('10.1.2.3').status_code, 200)
+            with self.assertLogs('django.request', 'WARNING'):
+                self.assertEqual(self.get('127.0.0.1').status_code, 401)
+
+    def test_other_callers_need_the_metrics_permission(self):
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.get('203.0.113.5').status_code, 401)
+            self.assertEqual(self.get('203.0.113.5', roles=('doctor',)).status_code, 403)
+        response = self.get('203.0.113.5', roles=('admin',))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE', response.content)
+
+
+class RequestTimerTests(SimpleTestCase):
+    def test_concurrent_updates_are_not_lost(self):
+        timer = metrics.RequestTimer()
+
+        def count_queries():
+            for _ in range(10000):
+                timer.add('db', 0.001, queries=1)
+
+        threads = [threading.Thread(target=count_queries) for _ in range(4)]
+        # Switch threads as often as possible to expose lost updates
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(timer.queries, 40000)
+        self.assertAlmostEqual(timer.phases['db'], 40.0, places=6)
@@ -0,0 +1,182 @@
+"""
+Token-bucket throttling for the Keycloak token endpoints
+"""
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+import jwt
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.files import locks
+from rest_framework import throttling
+
+# Default buckets: `rate` refills per period, `burst` is the bucket size
+DEFAULT_AUTH_THROTTLES = {
+    'login_ip': {'rate': '30/min', 'burst': 10},
+    'login_username': {'rate': '5/min', 'burst': 5},
+    'refresh_ip': {'rate': '60/min', 'burst': 20},
+    'refresh_username': {'rate': '20/min', 'burst': 10},
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """
+    Parse '<count>/<period>' into the number of seconds per token
+    """
+    count, period = rate.split('/')
+    return PERIODS[period[0]] / int(count)
+
+
+# Minimum seconds between directory scans of LockedFileBasedCache
+CULL_INTERVAL = 60
+
+
+class LockedFileBasedCache(FileBasedCache):
+    """
+    FileBasedCache for the throttle buckets: add(), incr() and update() hold
+    an exclusive lock on a file in the cache directory, so they are atomic
+    across the worker processes of one host, and the directory is scanned
+    for culling at most once per CULL_INTERVAL instead of on every write
+    """
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self._lock_path = os.path.join(self._dir, '.lock')
+        self._last_cull = 0.0
+
+    @contextmanager
+    def _locked(self):
+        self._createdir()
+        with open(self._lock_path, 'ab') as lock_file:
+            locks.lock(lock_file, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(lock_file)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked():
+            return super().add(key, value, timeout, version)
+
+    def incr(self, key, delta=1, version=None):
+        with self._locked():
+            return super().incr(key, delta, version)
+
+    def update(self, key, func, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Store and return func(current value, or None when missing) as one
+        atomic read-modify-write
+        """
+        with self._locked():
+            value = func(self.get(key, version=version))
+            self.set(key, value, timeout, version)
+            return value
+
+    def _cull(self):
+        now = time.monotonic()
+        if now - self._last_cull < CULL_INTERVAL:
+            return
+        self._last_cull = now
+        super()._cull()
+
+
+class TokenBucketThrottle(throttling.BaseThrottle):
+    """
+    Token bucket of `burst` tokens refilled one per `interval` seconds. The
+    bucket is (tokens, last refill) in the throttle cache, refilled and
+    spent in one cache.update() call, which LockedFileBasedCache runs under
+    its lock, so concurrent workers cannot overrun a limit. Rejected
+    requests never reach the view.
+    """
+    scope = None
+    cache_alias = 'throttle'
+
+    def __init__(self):
+        config = getattr(settings, 'AUTH_THROTTLES', DEFAULT_AUTH_THROTTLES)[self.scope]
+        self.interval = parse_rate(config['rate'])
+        self.burst = config['burst']
+        self.cache = caches[self.cache_alias]
+        self.retry_after = None
+
+    def get_cache_key(self, request, view):
+        """
+        Return the identity being throttled, or None to skip throttling
+        """
+        raise NotImplementedError('.get_cache_key() must be overridden')
+
+    def take(self, bucket, now):
+        """
+        (tokens, last refill, seconds to wait) after trying to spend one
+        token from `bucket`; a missing bucket is full
+        """
+        tokens, refilled = bucket[:2] if bucket else (self.burst, now)
+        tokens = min(self.burst, tokens + max(0.0, now - refilled) / self.interval)
+        if tokens >= 1:
+            return tokens - 1, now, 0.0
+        return tokens, now, (1 - tokens) * self.interval
+
+    def allow_request(self, request, view):
+        ident = self.get_cache_key(request, view)
+        if ident is None:
+            return True
+
+        now = time.time()
+        # An untouched bucket is full again after burst * interval seconds
+        timeout = int(self.burst * self.interval) + 1
+        _, _, wait = self.cache.update(f'throttle:{self.scope}:{ident}', lambda bucket: self.take(bucket, now), timeout)
+        if wait:
+            self.retry_after = wait
+            return False
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+def _digest(value):
+    return hashlib.sha256(value.encode()).hexdigest()[:32]
+
+
+class LoginIPThrottle(TokenBucketThrottle):
+    scope = 'login_ip'
+
+    def get_cache_key(self, request, view):
+        return self.get_ident(request)
+
+
+class LoginUsernameThrottle(TokenBucketThrottle):
+    scope = 'login_username'
+
+    def get_cache_key(self, request, view):
+        username = request.data.get('username')
+        if not username or not isinstance(username, str):
+            return None
+        return _digest(username.strip().lower())
+
+
+class RefreshIPThrottle(TokenBucketThrottle):
+    scope = 'refresh_ip'
+
+    def get_cache_key(self, request, view):
+        return self.get_ident(request)
+
+
+class RefreshUsernameThrottle(TokenBucketThrottle):
+    scope = 'refresh_username'
+
+    def get_cache_key(self, request, view):
+        refresh_token = request.data.get('refresh_token')
+        if not refresh_token or not isinstance(refresh_token, str):
+            return None
+        # Keycloak refresh tokens are JWTs; fall back to the token itself
+        try:
+            claims = jwt.decode(refresh_token, options={"verify_signature": False})
+            subject = claims.get('sub') or refresh_token
+        except jwt.InvalidTokenError:
+            subject = refresh_token
+        return _digest(subject)
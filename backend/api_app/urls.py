@@ -1,13 +1,20 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from api_app.views import PatientViewSet, HospitalViewSet, login_user, refresh_token
+from api_app.batch import batch
+from api_app.memory import MemoryProfileView
+from api_app.views import PatientViewSet, HospitalViewSet, AuditRecordViewSet, login_user, refresh_token, metrics_view, event_stream
 
 router = DefaultRouter()
 router.register(r'patient', PatientViewSet)
 router.register(r'hospital', HospitalViewSet)
+router.register(r'audit', AuditRecordViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
     path('login/', login_user, name='login'),
     path('refresh-token/', refresh_token, name='refresh-token'),
+    path('metrics', metrics_view, name='metrics'),
+    path('events/', event_stream, name='events'),
+    path('batch/', batch, name='batch'),
+    path('memory/', MemoryProfileView.as_view(), name='memory'),
 ]
\ No newline at end of file
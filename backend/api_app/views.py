@@ -1,30 +1,66 @@
+from django.conf import settings
 from django.shortcuts import render
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+import asyncio
+import ipaddress
+import time
 from rest_framework import viewsets, permissions, status
-from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.decorators import action, api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from api_app.models import Patient, Hospital
-from api_app.serializers import PatientSerializer, HospitalSerializer
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from api_app.models import Patient, Hospital, AuditRecord
+from api_app.serializers import PatientSerializer, HospitalSerializer, AuditRecordSerializer
+from api_app.archive import ArchiveMixin
+from api_app.audit import AuditMixin
+from api_app.coalesce import CoalesceMixin
+from api_app.fragments import FragmentCacheMixin
+from api_app.async_views import AsyncReadMixin
 from api_app.authentication import TokenAuthentication
-from api_app.permissions import HasResourcePermission
+from api_app.permissions import HasResourcePermission, PERMISSION_TABLE, has_resource_permission
+from api_app import metrics, events
+from api_app.query_budget import QueryBudgetMixin
+from api_app.sharding import ShardMixin
+from api_app.sync import DeltaSyncMixin
+from api_app.throttling import LoginIPThrottle, LoginUsernameThrottle, RefreshIPThrottle, RefreshUsernameThrottle
 from keycloak_config import KEYCLOAK_CONFIG
 import requests
 import json
 import jwt
+import logging
 
-class PatientViewSet(viewsets.ModelViewSet):
+logger = logging.getLogger(__name__)
+
+class PatientViewSet(CoalesceMixin, ArchiveMixin, ShardMixin, FragmentCacheMixin, AsyncReadMixin, AuditMixin, QueryBudgetMixin, DeltaSyncMixin, viewsets.ModelViewSet):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
+    resource_name = 'patient'
+    audit_resource = 'patient'
     authentication_classes = [TokenAuthentication]
     permission_classes = [HasResourcePermission]
+    # Includes the user lookup done by TokenAuthentication, the version read
+    # of cached lists and, for writes, the change sequence allocation
+    query_budgets = {
+        'list': 3,
+        'retrieve': 2,
+        'create': 5,
+        'update': 6,
+        'partial_update': 6,
+        'destroy': 7,
+    }
+    # Single-shard list checked by check_query_plans
+    plan_filters = ('hospital_group=north',)
     
     def get_permissions(self):
         """
         Set required permission based on action
         """
-        if self.action == 'list' or self.action == 'retrieve':
+        if self.action in ['list', 'retrieve', 'changes']:
             self.required_permission = 'patient:view'
         elif self.action == 'create':
             self.required_permission = 'patient:create'
@@ -34,17 +70,28 @@ class PatientViewSet(viewsets.ModelViewSet):
             self.required_permission = 'patient:delete'
         return super().get_permissions()
 
-class HospitalViewSet(viewsets.ModelViewSet):
+class HospitalViewSet(CoalesceMixin, FragmentCacheMixin, AsyncReadMixin, QueryBudgetMixin, DeltaSyncMixin, viewsets.ModelViewSet):
     queryset = Hospital.objects.all()
     serializer_class = HospitalSerializer
+    resource_name = 'hospital'
     authentication_classes = [TokenAuthentication]
     permission_classes = [HasResourcePermission]
+    # Includes the user lookup done by TokenAuthentication, the version read
+    # of cached lists and, for writes, the change sequence allocation
+    query_budgets = {
+        'list': 3,
+        'retrieve': 2,
+        'create': 5,
+        'update': 6,
+        'partial_update': 6,
+        'destroy': 7,
+    }
     
     def get_permissions(self):
         """
         Set required permission based on action
         """
-        if self.action == 'list' or self.action == 'retrieve':
+        if self.action in ['list', 'retrieve', 'changes']:
             self.required_permission = 'hospital:view'
         elif self.action == 'create':
             self.required_permission = 'hospital:create'
@@ -54,8 +101,61 @@ class HospitalViewSet(viewsets.ModelViewSet):
             self.required_permission = 'hospital:delete'
         return super().get_permissions()
 
+class AuditRecordViewSet(QueryBudgetMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Compliance lookups over the audit trail, newest first. Filters:
+    ?resource=, ?object_id= (also lists whose id ranges contain it),
+    ?actor=, ?action=, ?since=, ?until= (ISO datetimes) and ?before=<id> to
+    page past the last record seen.
+    """
+    queryset = AuditRecord.objects.all()
+    serializer_class = AuditRecordSerializer
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [HasResourcePermission]
+    required_permission = 'audit:view'
+    query_budgets = {
+        'list': 2,
+        'retrieve': 2,
+    }
+    page_size = 500
+    # Lookups checked by check_query_plans
+    plan_filters = ('resource=patient&object_id=1', 'actor=admin')
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        for field in ('resource', 'actor', 'action'):
+            if field in params:
+                queryset = queryset.filter(**{field: params[field]})
+        if 'object_id' in params:
+            object_id = int(params['object_id'])
+            queryset = queryset.filter(Q(object_id=object_id) | Q(first_object_id__lte=object_id, last_object_id__gte=object_id))
+        if 'since' in params:
+            queryset = queryset.filter(timestamp__gte=params['since'])
+        if 'until' in params:
+            queryset = queryset.filter(timestamp__lt=params['until'])
+        if 'before' in params:
+            queryset = queryset.filter(id__lt=params['before'])
+        return queryset.order_by('-id')
+
+    def list(self, request, *args, **kwargs):
+        try:
+            records = list(self.get_queryset()[:self.page_size])
+        except (ValueError, ValidationError):
+            return Response({'error': 'Invalid filter value'}, status=status.HTTP_400_BAD_REQUEST)
+        # The cursor follows the rows read; gaps in a list's ranges are dropped after it
+        before = records[-1].id if len(records) == self.page_size else None
+        if 'object_id' in request.query_params:
+            object_id = int(request.query_params['object_id'])
+            records = [record for record in records if record.covers(object_id)]
+        return Response({
+            'results': self.get_serializer(records, many=True).data,
+            'before': before,
+        })
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([LoginIPThrottle, LoginUsernameThrottle])
 def login_user(request):
     """
     Handle user login with username/password and return Keycloak token
@@ -64,7 +164,7 @@ def login_user(request):
         username = request.data.get('username')
         password = request.data.get('password')
         
-        print(f"🔐 Login attempt for username: {username}")
+        logger.info("Login attempt", extra={'username': username})
         
         if not username or not password:
             return Response({
@@ -77,7 +177,7 @@ def login_user(request):
         client_id = KEYCLOAK_CONFIG['client_id']
         client_secret = KEYCLOAK_CONFIG['client_secret_key']
         
-        print(f"🔐 Keycloak config - URL: {keycloak_url}, Realm: {realm}, Client: {client_id}")
+        logger.debug("Keycloak config", extra={'keycloak_url': keycloak_url, 'realm': realm, 'client_id': client_id})
         
         # Get token from Keycloak
         token_url = f"{keycloak_url}/realms/{realm}/protocol/openid-connect/token"
@@ -94,13 +194,11 @@ def login_user(request):
             'Content-Type': 'application/x-www-form-urlencoded'
         }
         
-        print(f"🔐 Making request to: {token_url}")
-        print(f"🔐 Payload: {payload}")
+        logger.debug("Requesting token", extra={'url': token_url, 'username': username})
         
         response = requests.post(token_url, data=payload, headers=headers)
         
-        print(f"🔐 Response status: {response.status_code}")
-        print(f"🔐 Response content: {response.text}")
+        logger.debug("Token response", extra={'status': response.status_code, 'username': username})
         
         if response.status_code == 200:
             token_data = response.json()
@@ -111,13 +209,11 @@ def login_user(request):
                 'Authorization': f"Bearer {token_data['access_token']}"
             }
             
-            print(f"🔐 Getting user info from: {userinfo_url}")
-            print(f"🔐 Userinfo headers: {userinfo_headers}")
+            logger.debug("Requesting userinfo", extra={'url': userinfo_url, 'username': username})
             
             userinfo_response = requests.get(userinfo_url, headers=userinfo_headers)
             
-            print(f"🔐 Userinfo response status: {userinfo_response.status_code}")
-            print(f"🔐 Userinfo response content: {userinfo_response.text}")
+            logger.debug("Userinfo response", extra={'status': userinfo_response.status_code, 'username': username})
             
             if userinfo_response.status_code == 200:
                 user_info = userinfo_response.json()
@@ -135,11 +231,10 @@ def login_user(request):
                 })
             else:
                 # If userinfo fails, try to extract user info from the token itself
-                print("🔐 Userinfo failed, extracting from token...")
+                logger.info("Userinfo failed, extracting user info from token", extra={'username': username})
                 try:
                     # Decode the token without verification to get user info
                     token_payload = jwt.decode(token_data['access_token'], options={"verify_signature": False})
-                    print(f"🔐 Token payload: {token_payload}")
                     
                     return Response({
                         'success': True,
@@ -153,7 +248,7 @@ def login_user(request):
                         }
                     })
                 except Exception as e:
-                    print(f"❌ Token decode failed: {e}")
+                    logger.warning("Token decode failed", extra={'username': username, 'error': str(e)})
                     return Response({
                         'error': 'Failed to get user information'
                     }, status=status.HTTP_401_UNAUTHORIZED)
@@ -164,19 +259,21 @@ def login_user(request):
                 error_detail = error_json.get('error_description', error_json.get('error', error_detail))
             except:
                 pass
-                
+            
+            logger.info("Login rejected by Keycloak", extra={'username': username, 'status': response.status_code})
             return Response({
                 'error': f'Invalid username or password: {error_detail}'
             }, status=status.HTTP_401_UNAUTHORIZED)
             
     except Exception as e:
-        print(f"❌ Login error: {str(e)}")
+        logger.exception("Login error")
         return Response({
             'error': f'Login failed: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([RefreshIPThrottle, RefreshUsernameThrottle])
 def refresh_token(request):
     """
     Refresh access token using refresh token
@@ -227,4 +324,80 @@ def refresh_token(request):
     except Exception as e:
         return Response({
             'error': f'Token refresh failed: {str(e)}'
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def _from_metrics_network(request):
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    networks = getattr(settings, 'METRICS_ALLOWED_NETWORKS', ['127.0.0.1/32', '::1/128'])
+    return any(address in ipaddress.ip_network(network) for network in networks)
+
+def metrics_view(request):
+    """
+    Expose request metrics in Prometheus text format to scrapers on
+    METRICS_ALLOWED_NETWORKS, or to callers with the system:metrics permission
+    """
+    if not _from_metrics_network(request):
+        auth = TokenAuthentication().authenticate(request)
+        if auth is None:
+            return JsonResponse({'error': 'Authentication required'}, status=401)
+        if not has_resource_permission(request.token_payload, 'system:metrics'):
+            return JsonResponse({'error': 'You do not have permission to read metrics'}, status=403)
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Seconds between SSE keep-alive comments
+EVENT_HEARTBEAT = 15
+
+async def event_stream(request):
+    """
+    Server-Sent Events feed of patient and hospital changes the caller may view.
+    Requires ASGI. EventSource cannot send headers, so the bearer token may
+    also be passed as ?access_token=. The token is verified like any other,
+    and the stream ends with an `expired` event when it expires.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'The event stream requires the ASGI server'}, status=501)
+
+    token = request.GET.get('access_token')
+    if token and 'HTTP_AUTHORIZATION' not in request.META:
+        request.META['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    auth = await sync_to_async(TokenAuthentication().authenticate)(request)
+    if auth is None:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+
+    roles = request.token_payload.get('realm_access', {}).get('roles', [])
+    resources = [
+        resource for resource in ('patient', 'hospital')
+        if not PERMISSION_TABLE.get((resource, 'view'), frozenset()).isdisjoint(roles)
+    ]
+    if not resources:
+        return JsonResponse({'error': 'Insufficient permissions'}, status=403)
+    expires = request.token_payload['exp']
+
+    async def stream():
+        subscriber = events.broker.subscribe(resources)
+        try:
+            yield 'retry: 3000\n\n'
+            while not subscriber.overflowed:
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    # The client reconnects with a refreshed token
+                    yield 'event: expired\ndata: {}\n\n'
+                    return
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), min(EVENT_HEARTBEAT, remaining))
+                except asyncio.TimeoutError:
+                    yield ': ping\n\n'
+                    continue
+                yield events.format_sse(event)
+            # Too slow to keep up: close so the client reconnects and refetches
+            yield 'event: overflow\ndata: {}\n\n'
+        finally:
+            events.broker.unsubscribe(subscriber)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
\ No newline at end of file
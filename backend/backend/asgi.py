@@ -9,8 +9,26 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+# Bearer-token API requests get a handler without session/CSRF middleware
+from api_app.stateless import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# Serve patient and hospital reads with the async ORM (see ASYNC_READS)
+os.environ.setdefault('DJANGO_ASYNC_READS', '1')
 
 application = get_asgi_application()
+
+# Warm signing keys and ORM state before the worker accepts traffic. With a
+# preloading server (gunicorn --preload) set DJANGO_PREWARM=0 and call
+# prewarm() from a post-fork hook instead, so each worker fetches its keys.
+from api_app.prewarm import prewarm, prewarm_enabled
+
+if prewarm_enabled():
+    prewarm()
+
+# Answer /health/ and /ready/ before the middleware stack; readiness checks
+# run on a background thread (restarted in each forked worker)
+from api_app import health
+
+application = health.asgi_app(application)
+health.monitor.ensure_started()
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,10 +44,14 @@ INSTALLED_APPS = [
     'corsheaders',
 ]
 
+# Allows (and echoes) every origin; CORS_ALLOWED_ORIGINS below applies only
+# once this is off. django-cors-headers is the only source of CORS headers.
 CORS_ORIGIN_ALLOW_ALL = True
 
 MIDDLEWARE = [
+    'api_app.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'api_app.middleware.AdmissionControlMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'keycloak_middleware.KeycloakMiddleware',
@@ -57,6 +62,21 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Stateless API mode (api_app.stateless): requests with a bearer token to
+# anything but exclude_prefixes run this chain instead of MIDDLEWARE, with
+# no session loads or saves, CSRF, messages or Keycloak middleware
+STATELESS_API = {
+    'enabled': os.environ.get('DJANGO_STATELESS_API', '1') == '1',
+    'middleware': [
+        'api_app.middleware.MetricsMiddleware',
+        'corsheaders.middleware.CorsMiddleware',
+        'api_app.middleware.AdmissionControlMiddleware',
+        'django.middleware.security.SecurityMiddleware',
+        'django.middleware.common.CommonMiddleware',
+    ],
+    'exclude_prefixes': ['/admin/', '/static/', '/media/'],
+}
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -88,6 +108,57 @@ DATABASES = {
     }
 }
 
+# Patient shards (api_app.sharding): PATIENT_SHARDS lists extra database
+# aliases, each a local SQLite file here; point them at real servers in
+# production. Create each with `manage.py migrate --database <alias>`.
+PATIENT_SHARDS = [alias.strip() for alias in os.environ.get('PATIENT_SHARDS', '').split(',') if alias.strip()]
+for alias in PATIENT_SHARDS:
+    DATABASES[alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'shard_{alias}.sqlite3',
+    }
+
+# Second patient database for the sharding tests; `manage.py test` creates it
+# in memory only for test cases that list it in `databases`
+if sys.argv[1:2] == ['test']:
+    DATABASES['shard_test'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'shard_test.sqlite3',
+    }
+
+# Hospital group -> database alias; PATIENT_SHARD_GROUPS='north=shard1,...'.
+# Groups not listed are spread over the shards by hash.
+SHARDING = {
+    'shards': ['default'] + PATIENT_SHARDS,
+    'groups': dict(
+        pair.strip().split('=', 1) for pair in os.environ.get('PATIENT_SHARD_GROUPS', '').split(',') if '=' in pair
+    ),
+    # Threads reading shards in parallel for one cross-shard list
+    'max_workers': 8,
+}
+
+DATABASE_ROUTERS = ['api_app.sharding.ShardRouter']
+
+
+# Cache
+# The throttle cache must be shared by all worker processes and needs an
+# atomic update() (read-modify-write of a token bucket): LockedFileBasedCache
+# provides that on a single host; across hosts, use a backend that implements
+# update() atomically, e.g. with a Redis script.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'throttle': {
+        'BACKEND': 'api_app.throttling.LockedFileBasedCache',
+        'LOCATION': BASE_DIR / '.cache' / 'throttle',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -144,6 +215,198 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # Reverse proxies in front of Django. Throttles key on the client IP,
+    # which X-Forwarded-For may only supply when this many proxies add it;
+    # with 0 the header is ignored and REMOTE_ADDR is used.
+    'NUM_PROXIES': int(os.environ.get('DJANGO_NUM_PROXIES', '0')),
+}
+
+# Request metrics (Server-Timing header and /metrics endpoint)
+METRICS_ENABLED = True
+METRICS_SERVER_TIMING = True
+# Networks that may scrape /metrics without a token (REMOTE_ADDR, not
+# X-Forwarded-For); other callers need the system:metrics permission
+METRICS_ALLOWED_NETWORKS = [
+    network.strip() for network in os.environ.get('METRICS_ALLOWED_NETWORKS', '127.0.0.1/32,::1/128').split(',') if network.strip()
+]
+
+# Query budgets: over-budget viewset actions log a warning, or raise when strict.
+# API tests override QUERY_BUDGET_STRICT; DJANGO_QUERY_BUDGET_STRICT=1 makes
+# a development server raise too.
+QUERY_BUDGET_ENABLED = True
+QUERY_BUDGET_STRICT = os.environ.get('DJANGO_QUERY_BUDGET_STRICT', '0') == '1'
+QUERY_BUDGET_REPEAT_THRESHOLD = 3
+
+# Token-bucket limits for login/ and refresh-token/ (rate refills per period, burst is the bucket size)
+AUTH_THROTTLES = {
+    'login_ip': {'rate': '30/min', 'burst': 10},
+    'login_username': {'rate': '5/min', 'burst': 5},
+    'refresh_ip': {'rate': '60/min', 'burst': 20},
+    'refresh_username': {'rate': '20/min', 'burst': 10},
+}
+
+# Logging
+# Records are queued by request threads and written as JSON lines by a
+# background thread; secrets are redacted and DEBUG records are sampled.
+
+LOG_LEVEL = os.environ.get('DJANGO_LOG_LEVEL', 'INFO')
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('DJANGO_LOG_DEBUG_SAMPLE_RATE', '0.01'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'api_app.log.JSONFormatter',
+        },
+    },
+    'filters': {
+        'sample_debug': {
+            '()': 'api_app.log.SamplingFilter',
+            'rate': LOG_DEBUG_SAMPLE_RATE,
+        },
+    },
+    'handlers': {
+        'queue': {
+            'class': 'api_app.log.BackgroundQueueHandler',
+            'stream': 'ext://sys.stdout',
+            'maxsize': 10000,
+            'formatter': 'json',
+            'filters': ['sample_debug'],
+        },
+    },
+    'root': {
+        'handlers': ['queue'],
+        'level': 'WARNING',
+    },
+    'loggers': {
+        'django': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'api_app': {
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+        'keycloak_middleware': {
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+        'keycloak_auth': {
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
+
+# Change feed (/events/). LocalBackend only reaches subscribers of the same
+# worker; use 'api_app.events.RedisBackend' with OPTIONS {'url': ...} across workers.
+EVENTS_BACKEND = {
+    'BACKEND': 'api_app.events.LocalBackend',
+    'OPTIONS': {},
+}
+
+# Batch endpoint (/batch/): sub-requests per batch and parallel reads
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_WORKERS = 4
+
+# Admission control: in-flight cap per worker, short priority queue, then 503.
+# Size max_in_flight to what the worker can serve concurrently (threads, or
+# DB connections under ASGI).
+ADMISSION_CONTROL = {
+    'enabled': True,
+    'max_in_flight': int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '16')),
+    'max_queue': int(os.environ.get('ADMISSION_MAX_QUEUE', '64')),
+    'queue_timeout': 2.0,
+    # Share of slots and queue that logins, token refreshes and batches may use
+    'expensive_share': 0.25,
+    'expensive_paths': ['/login/', '/refresh-token/', '/batch/'],
+    'exempt_paths': ['/metrics', '/events/'],
+    'retry_after': 1,
+}
+
+# Async list/retrieve for the patient and hospital viewsets. backend/asgi.py
+# turns this on; under WSGI it would only add a sync/async hop per request.
+ASYNC_READS = os.environ.get('DJANGO_ASYNC_READS', '0') == '1'
+
+# Write-behind User provisioning from Keycloak claims; 'sync' writes inline
+USER_PROVISIONING = {
+    'mode': os.environ.get('USER_PROVISIONING_MODE', 'write_behind'),
+    'batch_size': 200,
+    'flush_interval': 1.0,
+    'max_pending': 10000,
+}
+
+# Patient access audit trail, buffered and written by a background thread.
+# sink 'database' inserts AuditRecord rows; 'file' appends JSON lines to path
+AUDIT_LOG = {
+    'enabled': True,
+    'sink': os.environ.get('AUDIT_LOG_SINK', 'database'),
+    'path': os.environ.get('AUDIT_LOG_PATH', str(BASE_DIR / 'audit' / 'audit.log')),
+    'max_bytes': 100 * 1024 * 1024,
+    'batch_size': 500,
+    'flush_interval': 1.0,
+    'max_pending': 50000,
+}
+
+# Patient archival (manage.py archive_patients): patients not updated for
+# inactive_days move to the ArchivedPatient table in batches
+PATIENT_ARCHIVE = {
+    'inactive_days': int(os.environ.get('PATIENT_ARCHIVE_INACTIVE_DAYS', str(3 * 365))),
+    'batch_size': 1000,
+}
+
+# Per-object JSON fragments reused by patient and hospital lists while the
+# object's change_seq/updated_at are unchanged; LRU, per worker
+FRAGMENT_CACHE = {
+    'enabled': True,
+    'max_bytes': int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+}
+
+# Single-flight for patient and hospital list/retrieve: identical concurrent
+# GETs share one computation, each waiting at most max_wait seconds for it
+COALESCE = {
+    'enabled': True,
+    'max_wait': float(os.environ.get('COALESCE_MAX_WAIT', '5')),
+}
+
+# Load balancer probes served ahead of the middleware (api_app.health).
+# Readiness reports checks a background thread runs every interval seconds
+# (Keycloak and signing keys every keycloak_interval); results older than
+# stale_after intervals count as unready.
+HEALTH_CHECKS = {
+    'liveness_path': '/health/',
+    'readiness_path': '/ready/',
+    'interval': 5,
+    'keycloak_interval': 30,
+    'stale_after': 3,
+    'timeout': 2,
+    # Oldest acceptable realm signing keys, in seconds (twice the JWKS TTL)
+    'jwks_max_age': 7200,
+}
+
+# Opt-in tracemalloc profiling (api_app.memory): snapshots on demand via
+# /memory/ (admin) or `kill -<signal> <pid>`, diffed per module. Tracing
+# costs CPU and memory on every allocation, so keep it off unless hunting
+# a leak; frames > 1 lets ?group=caller charge library allocations to the
+# project code that made them.
+MEMORY_PROFILING = {
+    'enabled': os.environ.get('DJANGO_MEMORY_PROFILING', '0') == '1',
+    'frames': int(os.environ.get('MEMORY_PROFILING_FRAMES', '8')),
+    'signal': 'SIGUSR2',
+    'max_snapshots': 10,
+    'top': 25,
+    # Live instances counted (gc scan) on GET /memory/
+    'track_types': [
+        'requests.Session',
+        'requests.Response',
+        'django.contrib.sessions.backends.base.SessionBase',
+        'django.http.HttpRequest',
+    ],
 }
 
 # Session Configuration
@@ -151,6 +414,11 @@ SESSION_COOKIE_SECURE = False
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_AGE = 3600
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
+SESSION_SAVE_EVERY_REQUEST = False
+# Only a compact Keycloak claims digest is kept in the session, so it fits the
+# signed-cookie engine ('django.contrib.sessions.backends.signed_cookies') or a
+# cache-backed one ('django.contrib.sessions.backends.cache') as well
+SESSION_ENGINE = os.environ.get('DJANGO_SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
 
 # CORS Configuration for Keycloak
 CORS_ALLOWED_ORIGINS = [
@@ -9,8 +9,24 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 
 import os
 
-from django.core.wsgi import get_wsgi_application
+# Bearer-token API requests get a handler without session/CSRF middleware
+from api_app.stateless import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Warm signing keys and ORM state before the worker accepts traffic. With a
+# preloading server (gunicorn --preload) set DJANGO_PREWARM=0 and call
+# prewarm() from a post-fork hook instead, so each worker fetches its keys.
+from api_app.prewarm import prewarm, prewarm_enabled
+
+if prewarm_enabled():
+    prewarm()
+
+# Answer /health/ and /ready/ before the middleware stack; readiness checks
+# run on a background thread (restarted in each forked worker)
+from api_app import health
+
+application = health.wsgi_app(application)
+health.monitor.ensure_started()
@@ -1,14 +1,55 @@
 #!/usr/bin/env python3
 """
 Script to import Keycloak realm configuration
+
+By default a new realm is imported in one request, and an existing realm is
+synced incrementally: the current state is read, diffed against the config
+file, and only changed realm settings, roles, clients and users are applied,
+concurrently over one pooled HTTP session. The admin token is renewed as it
+expires, so long syncs keep working.
+
+Usage:
+    python import-keycloak-config.py [--dry-run] [--full] [--workers N]
 """
+import argparse
 import json
-import requests
 import sys
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+
+PAGE_SIZE = 500
+
+# Renew the admin token this many seconds before it expires (admin-cli
+# tokens live about 60s)
+TOKEN_REFRESH_MARGIN = 10
+
+# Top-level realm keys synced as sub-resources (or only on --full import)
+REALM_COLLECTION_KEYS = ('users', 'roles', 'clients', 'groups', 'defaultRoles', 'requiredActions')
+
+# Keys never compared for existing objects (write-only or synced separately)
+IGNORED_KEYS = ('id', 'credentials', 'realmRoles', 'protocolMappers')
+
+Change = namedtuple('Change', 'kind name action apply')
 
-def get_admin_token(keycloak_url, admin_username, admin_password):
-    """Get admin access token"""
+
+def make_session(workers):
+    """Create a pooled HTTP session sized for the number of workers"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_admin_token(session, keycloak_url, admin_username, admin_password):
+    """Get an admin token response (access_token, expires_in), or None"""
     token_url = f"{keycloak_url}/realms/master/protocol/openid-connect/token"
     data = {
         'grant_type': 'password',
@@ -16,16 +57,69 @@ def get_admin_token(keycloak_url, admin_username, admin_password):
         'username': admin_username,
         'password': admin_password
     }
-    
+
     try:
-        response = requests.post(token_url, data=data)
+        response = session.post(token_url, data=data)
         response.raise_for_status()
-        return response.json()['access_token']
+        return response.json()
     except requests.exceptions.RequestException as e:
         print(f"Error getting admin token: {e}")
         return None
 
-def check_keycloak_health(keycloak_url):
+class AdminTokenAuth(AuthBase):
+    """
+    Bearer auth for the admin API. Renews the short-lived admin token before
+    it expires, and retries a request once with a new token on 401.
+    """
+
+    def __init__(self, keycloak_url, admin_username, admin_password):
+        # Token requests use their own session, without this auth
+        self.token_session = requests.Session()
+        self.credentials = (keycloak_url, admin_username, admin_password)
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0.0
+
+    def renew(self, stale=None):
+        """
+        Return a current token, fetching a new one if this one is about to
+        expire or is `stale` (rejected). Concurrent callers share one fetch.
+        """
+        with self.lock:
+            fresh = self.token is not None and time.monotonic() < self.expires_at
+            if fresh and self.token != stale:
+                return self.token
+            response = get_admin_token(self.token_session, *self.credentials)
+            if response is None:
+                return None
+            self.token = response['access_token']
+            self.expires_at = time.monotonic() + response.get('expires_in', 60) - TOKEN_REFRESH_MARGIN
+            return self.token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f"Bearer {self.renew()}"
+        request.register_hook('response', self.retry_unauthorized)
+        return request
+
+    def retry_unauthorized(self, response, **kwargs):
+        if response.status_code != 401:
+            return response
+        stale = response.request.headers['Authorization'].split(' ', 1)[-1]
+        token = self.renew(stale)
+        if token is None or token == stale:
+            return response
+        # Release the connection before resending, as requests' digest auth does
+        response.content
+        response.close()
+        retry = response.request.copy()
+        retry.deregister_hook('response', self.retry_unauthorized)
+        retry.headers['Authorization'] = f"Bearer {token}"
+        resent = response.connection.send(retry, **kwargs)
+        resent.history.append(response)
+        resent.request = retry
+        return resent
+
+def check_keycloak_health(session, keycloak_url):
     """Check if Keycloak is ready using multiple endpoints"""
     health_endpoints = [
         f"{keycloak_url}/health",
@@ -33,34 +127,49 @@ def check_keycloak_health(keycloak_url):
         f"{keycloak_url}/realms/master",
         f"{keycloak_url}/"
     ]
-    
+
     for endpoint in health_endpoints:
         try:
-            response = requests.get(endpoint, timeout=5)
+            response = session.get(endpoint, timeout=5)
             if response.status_code in [200, 302, 404]:  # 404 is OK for some endpoints
                 print(f"✅ Keycloak is ready! (Endpoint: {endpoint})")
                 return True
         except requests.exceptions.RequestException:
             continue
-    
+
     return False
 
-def import_realm(keycloak_url, admin_token, realm_config):
-    """Import realm configuration"""
+def wait_for_keycloak(session, keycloak_url, timeout=60):
+    """Poll Keycloak with exponential backoff until ready or timeout"""
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    attempt = 1
+    while True:
+        if check_keycloak_health(session, keycloak_url):
+            return True
+        if time.monotonic() + delay > deadline:
+            return False
+        print(f"⏳ Retrying in {delay:.2f}s... (attempt {attempt})")
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+        attempt += 1
+
+def check_realm_exists(session, keycloak_url, realm_name):
+    """Check whether the realm already exists"""
+    response = session.get(f"{keycloak_url}/admin/realms/{realm_name}")
+    return response.status_code == 200
+
+def import_realm(session, keycloak_url, realm_config):
+    """Import realm configuration. Returns True, False, or None if the realm exists."""
     import_url = f"{keycloak_url}/admin/realms"
-    headers = {
-        'Authorization': f'Bearer {admin_token}',
-        'Content-Type': 'application/json'
-    }
-    
+
     try:
-        response = requests.post(import_url, json=realm_config, headers=headers)
+        response = session.post(import_url, json=realm_config)
         if response.status_code == 201:
             print("✅ Realm imported successfully!")
             return True
         elif response.status_code == 409:
-            print("⚠️  Realm already exists. Updating...")
-            return update_realm(keycloak_url, admin_token, realm_config)
+            return None
         else:
             print(f"❌ Error importing realm: {response.status_code} - {response.text}")
             return False
@@ -68,17 +177,13 @@ def import_realm(keycloak_url, admin_token, realm_config):
         print(f"❌ Error importing realm: {e}")
         return False
 
-def update_realm(keycloak_url, admin_token, realm_config):
-    """Update existing realm"""
+def update_realm(session, keycloak_url, realm_config):
+    """Update existing realm with the whole configuration"""
     realm_name = realm_config['realm']
     update_url = f"{keycloak_url}/admin/realms/{realm_name}"
-    headers = {
-        'Authorization': f'Bearer {admin_token}',
-        'Content-Type': 'application/json'
-    }
-    
+
     try:
-        response = requests.put(update_url, json=realm_config, headers=headers)
+        response = session.put(update_url, json=realm_config)
         if response.status_code == 204:
             print("✅ Realm updated successfully!")
             return True
@@ -89,42 +194,235 @@ def update_realm(keycloak_url, admin_token, realm_config):
         print(f"❌ Error updating realm: {e}")
         return False
 
-def get_client_secret(keycloak_url, admin_token, realm_name, client_id):
+def get_client_secret(session, keycloak_url, realm_name, client_id):
     """Get client secret"""
     client_url = f"{keycloak_url}/admin/realms/{realm_name}/clients"
-    headers = {
-        'Authorization': f'Bearer {admin_token}',
-        'Content-Type': 'application/json'
-    }
-    
+
     try:
-        response = requests.get(client_url, headers=headers)
+        response = session.get(client_url, params={'clientId': client_id})
         response.raise_for_status()
-        clients = response.json()
-        
-        for client in clients:
+
+        for client in response.json():
             if client['clientId'] == client_id:
-                client_id_uuid = client['id']
-                secret_url = f"{keycloak_url}/admin/realms/{realm_name}/clients/{client_id_uuid}/client-secret"
-                secret_response = requests.get(secret_url, headers=headers)
+                secret_url = f"{client_url}/{client['id']}/client-secret"
+                secret_response = session.get(secret_url)
                 if secret_response.status_code == 200:
-                    secret_data = secret_response.json()
-                    return secret_data['value']
+                    return secret_response.json()['value']
         return None
     except requests.exceptions.RequestException as e:
         print(f"Error getting client secret: {e}")
         return None
 
+# ---------------------------------------------------------------------------
+# Incremental sync
+# ---------------------------------------------------------------------------
+
+def fetch_all(session, url, params=None):
+    """GET a paginated admin collection"""
+    items = []
+    first = 0
+    while True:
+        page_params = dict(params or {}, first=first, max=PAGE_SIZE)
+        response = session.get(url, params=page_params)
+        response.raise_for_status()
+        page = response.json()
+        items.extend(page)
+        if len(page) < PAGE_SIZE:
+            return items
+        first += PAGE_SIZE
+
+def differs(desired, current):
+    """True if any value in `desired` is missing from or different in `current`"""
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return True
+        return any(
+            differs(value, current.get(key))
+            for key, value in desired.items()
+            if key not in IGNORED_KEYS
+        )
+    if isinstance(desired, list):
+        if not isinstance(current, list) or len(desired) != len(current):
+            return True
+        if all(not isinstance(item, (dict, list)) for item in desired):
+            return sorted(map(str, desired)) != sorted(map(str, current))
+        return any(all(differs(item, other) for other in current) for item in desired)
+    return desired != current
+
+def check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.method} {response.url}: {response.status_code} - {response.text}")
+    return response
+
+def plan_realm_settings(session, base_url, realm_config, current_realm):
+    desired = {
+        key: value for key, value in realm_config.items()
+        if key not in REALM_COLLECTION_KEYS
+    }
+    if not differs(desired, current_realm):
+        return []
+    return [Change('realm', realm_config['realm'], 'update',
+                   lambda: check(session.put(base_url, json=desired)))]
+
+def plan_roles(session, base_url, realm_config):
+    current = {role['name']: role for role in fetch_all(session, f"{base_url}/roles", {'briefRepresentation': 'false'})}
+    changes = []
+    for role in realm_config.get('roles', {}).get('realm', []):
+        name = role['name']
+        if name not in current:
+            changes.append(Change('role', name, 'create',
+                                  lambda role=role: check(session.post(f"{base_url}/roles", json=role))))
+        elif differs(role, current[name]):
+            changes.append(Change('role', name, 'update',
+                                  lambda role=role, name=name: check(session.put(f"{base_url}/roles-by-id/{current[name]['id']}", json=role))))
+    return changes
+
+def plan_clients(session, base_url, realm_config):
+    current = {client['clientId']: client for client in fetch_all(session, f"{base_url}/clients")}
+    changes = []
+    for client in realm_config.get('clients', []):
+        client_id = client['clientId']
+        existing = current.get(client_id)
+        if existing is None:
+            changes.append(Change('client', client_id, 'create',
+                                  lambda client=client: check(session.post(f"{base_url}/clients", json=client))))
+            continue
+        client_url = f"{base_url}/clients/{existing['id']}"
+        if differs(client, existing):
+            changes.append(Change('client', client_id, 'update',
+                                  lambda client=client, client_url=client_url: check(session.put(client_url, json=client))))
+        existing_mappers = {mapper['name'] for mapper in existing.get('protocolMappers', [])}
+        for mapper in client.get('protocolMappers', []):
+            if mapper['name'] not in existing_mappers:
+                changes.append(Change('client', f"{client_id}/{mapper['name']}", 'add mapper',
+                                      lambda mapper=mapper, client_url=client_url: check(session.post(f"{client_url}/protocol-mappers/models", json=mapper))))
+    return changes
+
+def plan_users(session, base_url, realm_config, pool):
+    """Plan user creates/updates and missing realm role mappings"""
+    current = {user['username']: user for user in fetch_all(session, f"{base_url}/users", {'briefRepresentation': 'false'})}
+    desired_users = realm_config.get('users', [])
+
+    # One paged member list per role instead of one role-mapping GET per user
+    def role_members(name):
+        try:
+            return name, [user['username'] for user in fetch_all(session, f"{base_url}/roles/{quote(name, safe='')}/users", {'briefRepresentation': 'true'})]
+        except requests.exceptions.HTTPError as e:
+            # A role that does not exist yet has no members
+            if e.response is not None and e.response.status_code == 404:
+                return name, []
+            raise
+
+    role_names = sorted({name for user in desired_users for name in user.get('realmRoles', [])})
+    current_roles = {}
+    for name, usernames in pool.map(role_members, role_names):
+        for username in usernames:
+            current_roles.setdefault(username, set()).add(name)
+    role_mappings = [current_roles.get(user['username'], set()) for user in desired_users]
+    role_cache = {}
+
+    def role_reps(names):
+        if not role_cache:
+            role_cache.update({role['name']: role for role in fetch_all(session, f"{base_url}/roles")})
+        return [{'id': role_cache[name]['id'], 'name': name} for name in names]
+
+    def create_user(user):
+        response = check(session.post(f"{base_url}/users", json=user))
+        user_id = response.headers['Location'].rstrip('/').rsplit('/', 1)[-1]
+        if user.get('realmRoles'):
+            check(session.post(f"{base_url}/users/{user_id}/role-mappings/realm", json=role_reps(user['realmRoles'])))
+
+    changes = []
+    for user, roles in zip(desired_users, role_mappings):
+        username = user['username']
+        existing = current.get(username)
+        if existing is None:
+            changes.append(Change('user', username, 'create', lambda user=user: create_user(user)))
+            continue
+        user_url = f"{base_url}/users/{existing['id']}"
+        if differs(user, existing):
+            # Credentials are only set on create so a sync never resets passwords
+            update = {key: value for key, value in user.items() if key not in ('credentials', 'realmRoles')}
+            changes.append(Change('user', username, 'update',
+                                  lambda update=update, user_url=user_url: check(session.put(user_url, json=update))))
+        missing = sorted(set(user.get('realmRoles', [])) - roles)
+        if missing:
+            changes.append(Change('user', username, f"add roles {', '.join(missing)}",
+                                  lambda missing=missing, user_url=user_url: check(session.post(f"{user_url}/role-mappings/realm", json=role_reps(missing)))))
+    return changes
+
+def apply_changes(pool, changes):
+    """Apply changes concurrently, returning the list of (change, error) failures"""
+    def run(change):
+        try:
+            change.apply()
+            return None
+        except (requests.exceptions.RequestException, RuntimeError, KeyError) as e:
+            return (change, e)
+    return [failure for failure in pool.map(run, changes) if failure]
+
+def print_report(changes):
+    if not changes:
+        print("✅ Realm is already in sync, nothing to do")
+        return
+    for change in changes:
+        print(f"   • {change.kind:<7} {change.name:<40} {change.action}")
+    print(f"📋 {len(changes)} change(s) planned")
+
+def sync_realm(session, keycloak_url, realm_config, workers, dry_run):
+    """
+    Diff the existing realm against the config and apply only what changed.
+    Objects that exist in Keycloak but not in the config are left untouched.
+    """
+    base_url = f"{keycloak_url}/admin/realms/{realm_config['realm']}"
+    current_realm = check(session.get(base_url)).json()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Roles must exist before users can be mapped to them, so sync in two phases
+        plans = [
+            pool.submit(plan_realm_settings, session, base_url, realm_config, current_realm),
+            pool.submit(plan_roles, session, base_url, realm_config),
+            pool.submit(plan_clients, session, base_url, realm_config),
+        ]
+        first_phase = [change for plan in plans for change in plan.result()]
+        user_phase = plan_users(session, base_url, realm_config, pool)
+
+        print_report(first_phase + user_phase)
+        if dry_run:
+            print("🔎 Dry run, no changes applied")
+            return True
+
+        failures = apply_changes(pool, first_phase)
+        failures += apply_changes(pool, user_phase)
+
+    for change, error in failures:
+        print(f"❌ {change.kind} {change.name} ({change.action}): {error}")
+    if not failures and first_phase + user_phase:
+        print("✅ Realm synced successfully!")
+    return not failures
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import or sync the Keycloak realm configuration")
+    parser.add_argument('--config', default='keycloak-realm-config.json', help="Realm configuration file")
+    parser.add_argument('--url', default='http://localhost:8080', help="Keycloak server URL")
+    parser.add_argument('--dry-run', action='store_true', help="Report the changes a sync would make without applying them")
+    parser.add_argument('--full', action='store_true', help="PUT the whole realm instead of syncing the differences")
+    parser.add_argument('--workers', type=int, default=8, help="Maximum concurrent admin API requests")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+
     # Configuration
-    keycloak_url = "http://localhost:8080"
+    keycloak_url = args.url
     admin_username = "admin"
     admin_password = "admin"
-    config_file = "keycloak-realm-config.json"
-    
+    config_file = args.config
+    session = make_session(args.workers)
+
     print("🚀 Starting Keycloak configuration import...")
     print(f"📁 Loading configuration from: {config_file}")
-    
+
     # Load configuration
     try:
         with open(config_file, 'r') as f:
@@ -135,39 +433,53 @@ def main():
     except json.JSONDecodeError as e:
         print(f"❌ Invalid JSON in configuration file: {e}")
         sys.exit(1)
-    
+
     # Wait for Keycloak to be ready
     print("⏳ Waiting for Keycloak to be ready...")
-    max_retries = 30
-    for i in range(max_retries):
-        if check_keycloak_health(keycloak_url):
-            break
-        
-        if i == max_retries - 1:
-            print("❌ Keycloak is not responding. Please make sure it's running on http://localhost:8080")
-            print("💡 Try: docker run -p 8080:8080 -e KEYCLOAK_ADMIN=admin -e KEYCLOAK_ADMIN_PASSWORD=admin quay.io/keycloak/keycloak:latest start-dev")
-            sys.exit(1)
-        
-        print(f"⏳ Retrying... ({i+1}/{max_retries})")
-        time.sleep(2)
-    
-    # Get admin token
+    if not wait_for_keycloak(session, keycloak_url):
+        print(f"❌ Keycloak is not responding. Please make sure it's running on {keycloak_url}")
+        print("💡 Try: docker run -p 8080:8080 -e KEYCLOAK_ADMIN=admin -e KEYCLOAK_ADMIN_PASSWORD=admin quay.io/keycloak/keycloak:latest start-dev")
+        sys.exit(1)
+
+    # Get admin token, renewed as it expires during long syncs
     print("🔑 Getting admin token...")
-    admin_token = get_admin_token(keycloak_url, admin_username, admin_password)
-    if not admin_token:
+    auth = AdminTokenAuth(keycloak_url, admin_username, admin_password)
+    if not auth.renew():
         print("❌ Failed to get admin token")
         print("💡 Make sure Keycloak is running and admin credentials are correct")
         sys.exit(1)
-    
-    # Import realm
-    print("📦 Importing realm configuration...")
+    session.auth = auth
+    session.headers.update({
+        'Content-Type': 'application/json'
+    })
+
     realm_name = realm_config['realm']
-    if import_realm(keycloak_url, admin_token, realm_config):
+    realm_exists = check_realm_exists(session, keycloak_url, realm_name)
+    if args.dry_run:
+        if realm_exists:
+            print("🔎 Planning sync...")
+            sync_realm(session, keycloak_url, realm_config, args.workers, dry_run=True)
+        else:
+            print(f"🔎 Realm '{realm_name}' does not exist; it would be imported in full")
+        return
+
+    success = None
+    if not realm_exists:
+        print("📦 Importing realm configuration...")
+        success = import_realm(session, keycloak_url, realm_config)
+    if success is None and args.full:
+        print("⚠️  Realm already exists. Updating...")
+        success = update_realm(session, keycloak_url, realm_config)
+    elif success is None:
+        print("🔄 Realm already exists. Syncing changes...")
+        success = sync_realm(session, keycloak_url, realm_config, args.workers, dry_run=False)
+
+    if success:
         print(f"✅ Realm '{realm_name}' configured successfully!")
-        
+
         # Get client secret
         print("🔐 Getting client secret...")
-        client_secret = get_client_secret(keycloak_url, admin_token, realm_name, "hospital-management")
+        client_secret = get_client_secret(session, keycloak_url, realm_name, "hospital-management")
         if client_secret:
             print("✅ Client secret retrieved!")
             print(f"🔑 Client Secret: {client_secret}")
@@ -175,7 +487,7 @@ def main():
             print(f"   'client_secret_key': '{client_secret}'")
         else:
             print("⚠️  Could not retrieve client secret. You'll need to get it manually from the Keycloak admin console.")
-        
+
         print("\n🎉 Configuration complete!")
         print("\n📋 Test Users:")
         print("   Admin: admin / admin123")
@@ -183,10 +495,10 @@ def main():
         print("   Nurse: nurse / nurse123")
         print("   Receptionist: receptionist / receptionist123")
         print("   Viewer: viewer / viewer123")
-        
+
     else:
         print("❌ Failed to import realm configuration")
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -2,13 +2,47 @@
 Custom Keycloak authentication backend for Django
 """
 from django.contrib.auth.backends import BaseBackend
-from django.contrib.auth.models import User
 from django.contrib.auth import get_user_model
-from keycloak_config import keycloak_openid, ROLES, PERMISSIONS
+from keycloak_config import KEYCLOAK_CONFIG, get_keycloak_openid, get_signing_keys, signing_keys_age, ROLES, PERMISSIONS
+from keycloak_session import claims_digest, store_claims
+from keycloak_provisioning import provision_user
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Minimum seconds between forced signing key refetches on verification failure
+KEYS_REFRESH_INTERVAL = 60
+
+
+def _decode(keycloak_openid, token, key):
+    # jwcrypto checks the signature, plus exp/nbf; {'exp': None} makes exp mandatory
+    return keycloak_openid.decode_token(token, key=key, check_claims={'exp': None})
+
+
+def verify_token(token):
+    """
+    Return the claims of a token signed by the realm, unexpired and issued
+    to this client (azp or aud). Refetches the signing keys once if they may
+    have rotated. Raises on any invalid token.
+    """
+    keycloak_openid = get_keycloak_openid()
+    try:
+        claims = _decode(keycloak_openid, token, get_signing_keys())
+    except Exception:
+        age = signing_keys_age()
+        if age is None or age < KEYS_REFRESH_INTERVAL:
+            raise
+        claims = _decode(keycloak_openid, token, get_signing_keys(force=True))
+
+    client_id = KEYCLOAK_CONFIG['client_id']
+    audience = claims.get('aud') or []
+    if isinstance(audience, str):
+        audience = [audience]
+    if claims.get('azp') != client_id and client_id not in audience:
+        raise ValueError(f"Token was not issued to {client_id}")
+    return claims
+
+
 class KeycloakBackend(BaseBackend):
     """
     Custom authentication backend using Keycloak
@@ -22,52 +56,22 @@ class KeycloakBackend(BaseBackend):
             return None
             
         try:
-            # Decode and verify the token
-            token_info = keycloak_openid.decode_token(
-                token,
-                key=keycloak_openid.public_key(),
-                options={
-                    "verify_signature": True,
-                    "verify_aud": False,
-                    "verify_exp": True
-                }
-            )
+            # Decode and verify the token against the cached realm keys
+            token_info = verify_token(token)
             
-            # Extract user information from token
-            username = token_info.get('preferred_username')
-            email = token_info.get('email')
-            first_name = token_info.get('given_name', '')
-            last_name = token_info.get('family_name', '')
-            
-            if not username:
+            digest = claims_digest(token_info)
+            if not digest['username']:
                 return None
-                
-            # Get or create Django user
-            User = get_user_model()
-            user, created = User.objects.get_or_create(
-                username=username,
-                defaults={
-                    'email': email or '',
-                    'first_name': first_name,
-                    'last_name': last_name,
-                    'is_staff': self._has_role(token_info, ROLES['ADMIN']),
-                    'is_superuser': self._has_role(token_info, ROLES['ADMIN'])
-                }
-            )
             
-            # Update user information if not created
-            if not created:
-                user.email = email or user.email
-                user.first_name = first_name or user.first_name
-                user.last_name = last_name or user.last_name
-                user.is_staff = self._has_role(token_info, ROLES['ADMIN'])
-                user.is_superuser = self._has_role(token_info, ROLES['ADMIN'])
-                user.save()
+            # Serve from the verified claims; the User row is synced write-behind
+            user = provision_user(digest)
             
-            # Store token info in user session (safely)
-            if request and hasattr(request, 'session'):
-                request.session['keycloak_token_info'] = token_info
-                request.session['keycloak_token'] = token
+            # Keep a compact claims digest on the request (and existing session)
+            if request is not None:
+                store_claims(request, digest)
+                request.keycloak_user = user
+                # TokenAuthentication reuses this instead of verifying again
+                request.verified_token = (token, token_info)
                 
             return user
             
@@ -1,7 +1,8 @@
 """
 Keycloak configuration for Django backend
 """
-from keycloak import KeycloakOpenID
+import threading
+import time
 
 # Keycloak server configuration
 KEYCLOAK_CONFIG = {
@@ -12,16 +13,65 @@ KEYCLOAK_CONFIG = {
     'admin_password': 'admin',              # Admin password
     'realm_name': 'hospital-realm',         # Realm name
     'verify': True,                         # Verify SSL certificates
+    'jwks_ttl': 3600,                       # Seconds to cache the realm signing keys
+    'timeout': 10,                          # HTTP timeout for Keycloak calls
 }
 
-# Initialize Keycloak OpenID client
-keycloak_openid = KeycloakOpenID(
-    server_url=KEYCLOAK_CONFIG['server_url'],
-    client_id=KEYCLOAK_CONFIG['client_id'],
-    realm_name=KEYCLOAK_CONFIG['realm_name'],
-    client_secret_key=KEYCLOAK_CONFIG['client_secret_key'],
-    verify=KEYCLOAK_CONFIG['verify']
-)
+_lock = threading.RLock()
+_keycloak_openid = None
+_signing_keys = None
+_signing_keys_fetched = 0.0
+
+def get_keycloak_openid():
+    """
+    Return the Keycloak OpenID client, building it on first use
+    """
+    global _keycloak_openid
+    if _keycloak_openid is None:
+        with _lock:
+            if _keycloak_openid is None:
+                from keycloak import KeycloakOpenID
+                _keycloak_openid = KeycloakOpenID(
+                    server_url=KEYCLOAK_CONFIG['server_url'],
+                    client_id=KEYCLOAK_CONFIG['client_id'],
+                    realm_name=KEYCLOAK_CONFIG['realm_name'],
+                    client_secret_key=KEYCLOAK_CONFIG['client_secret_key'],
+                    verify=KEYCLOAK_CONFIG['verify'],
+                    timeout=KEYCLOAK_CONFIG['timeout']
+                )
+    return _keycloak_openid
+
+def get_signing_keys(force=False):
+    """
+    Return the realm's JWKS as a JWKSet, fetched at most once per jwks_ttl
+    unless force is set (e.g. after a key rotation)
+    """
+    global _signing_keys, _signing_keys_fetched
+    if not force and _signing_keys is not None and time.time() - _signing_keys_fetched < KEYCLOAK_CONFIG['jwks_ttl']:
+        return _signing_keys
+    with _lock:
+        if force or _signing_keys is None or time.time() - _signing_keys_fetched >= KEYCLOAK_CONFIG['jwks_ttl']:
+            from jwcrypto import jwk
+            keys = jwk.JWKSet()
+            for cert in get_keycloak_openid().certs()['keys']:
+                keys.add(jwk.JWK(**cert))
+            _signing_keys = keys
+            _signing_keys_fetched = time.time()
+    return _signing_keys
+
+def signing_keys_age():
+    """
+    Seconds since the signing keys were fetched, or None if never fetched
+    """
+    if _signing_keys is None:
+        return None
+    return time.time() - _signing_keys_fetched
+
+def __getattr__(name):
+    # Keep `from keycloak_config import keycloak_openid` working, lazily
+    if name == 'keycloak_openid':
+        return get_keycloak_openid()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Role definitions
 ROLES = {
@@ -45,5 +95,12 @@ PERMISSIONS = {
         'create': ['admin'],
         'update': ['admin'],
         'delete': ['admin']
+    },
+    'audit': {
+        'view': ['admin']
+    },
+    'system': {
+        'profile': ['admin'],
+        'metrics': ['admin']
     }
 } 
\ No newline at end of file
@@ -8,6 +8,7 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from keycloak_config import ROLES, PERMISSIONS
+from keycloak_session import get_request_roles
 import logging
 
 logger = logging.getLogger(__name__)
@@ -22,13 +23,8 @@ def require_role(role):
             if not request.user.is_authenticated:
                 return JsonResponse({'error': 'Authentication required'}, status=401)
             
-            # Get user roles from session (safely)
-            token_info = {}
-            if hasattr(request, 'session'):
-                token_info = request.session.get('keycloak_token_info', {})
-            
-            realm_access = token_info.get('realm_access', {})
-            user_roles = realm_access.get('roles', [])
+            # Get user roles from the verified token claims
+            user_roles = get_request_roles(request)
             
             if role not in user_roles:
                 return JsonResponse({'error': 'Insufficient permissions'}, status=403)
@@ -47,13 +43,8 @@ def require_permission(resource, action):
             if not request.user.is_authenticated:
                 return JsonResponse({'error': 'Authentication required'}, status=401)
             
-            # Get user roles from session (safely)
-            token_info = {}
-            if hasattr(request, 'session'):
-                token_info = request.session.get('keycloak_token_info', {})
-            
-            realm_access = token_info.get('realm_access', {})
-            user_roles = realm_access.get('roles', [])
+            # Get user roles from the verified token claims
+            user_roles = get_request_roles(request)
             
             # Check if user has required permission
             required_roles = PERMISSIONS.get(resource, {}).get(action, [])
@@ -76,13 +67,8 @@ def require_any_role(*roles):
             if not request.user.is_authenticated:
                 return JsonResponse({'error': 'Authentication required'}, status=401)
             
-            # Get user roles from session (safely)
-            token_info = {}
-            if hasattr(request, 'session'):
-                token_info = request.session.get('keycloak_token_info', {})
-            
-            realm_access = token_info.get('realm_access', {})
-            user_roles = realm_access.get('roles', [])
+            # Get user roles from the verified token claims
+            user_roles = get_request_roles(request)
             
             has_role = any(role in user_roles for role in roles)
             if not has_role:
@@ -103,13 +89,8 @@ def drf_require_role(role):
             if not request.user.is_authenticated:
                 return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
             
-            # Get user roles from session (safely)
-            token_info = {}
-            if hasattr(request, 'session'):
-                token_info = request.session.get('keycloak_token_info', {})
-            
-            realm_access = token_info.get('realm_access', {})
-            user_roles = realm_access.get('roles', [])
+            # Get user roles from the verified token claims
+            user_roles = get_request_roles(request)
             
             if role not in user_roles:
                 return Response({'error': 'Insufficient permissions'}, status=status.HTTP_403_FORBIDDEN)
@@ -128,13 +109,8 @@ def drf_require_permission(resource, action):
             if not request.user.is_authenticated:
                 return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
             
-            # Get user roles from session (safely)
-            token_info = {}
-            if hasattr(request, 'session'):
-                token_info = request.session.get('keycloak_token_info', {})
-            
-            realm_access = token_info.get('realm_access', {})
-            user_roles = realm_access.get('roles', [])
+            # Get user roles from the verified token claims
+            user_roles = get_request_roles(request)
             
             # Check if user has required permission
             required_roles = PERMISSIONS.get(resource, {}).get(action, [])
@@ -1,31 +1,59 @@
 """
 Keycloak authentication middleware for Django
 """
-from django.contrib.auth import get_user_model
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from keycloak_auth import KeycloakBackend
+from keycloak_session import session_claims
+from keycloak_provisioning import provision_user
+from api_app import metrics
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Paths served without authentication, matched as prefixes
+SKIP_AUTH_PREFIXES = (
+    '/admin/login/',
+    '/admin/logout/',
+    '/api/auth/',
+    '/health/',
+    '/ready/',
+    '/metrics',
+    '/static/',
+    '/media/',
+)
+
 class KeycloakMiddleware:
     """
     Middleware to handle Keycloak authentication
     """
     
+    sync_capable = True
+    async_capable = True
+    
     def __init__(self, get_response):
         self.get_response = get_response
         self.auth_backend = KeycloakBackend()
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
     
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        
         # Process request
-        self.process_request(request)
+        with metrics.phase('keycloak'):
+            self.process_request(request)
         
-        # Get response
-        response = self.get_response(request)
+        return self.get_response(request)
+    
+    async def __acall__(self, request):
+        # Token verification and the user lookup stay sync; only they hold a thread
+        with metrics.phase('keycloak'):
+            await sync_to_async(self.process_request)(request)
         
-        # Process response
-        return self.process_response(request, response)
+        return await self.get_response(request)
     
     def process_request(self, request):
         """
@@ -49,50 +77,16 @@ class KeycloakMiddleware:
                     request.user = AnonymousUser()
                     
             except Exception as e:
-                logger.error(f"Keycloak middleware error: {e}")
+                logger.error("Keycloak middleware error", extra={'path': request.path, 'error': str(e)})
                 request.user = AnonymousUser()
         else:
-            # Check for token in session (only if session is available)
-            if hasattr(request, 'session'):
-                token = request.session.get('keycloak_token')
-                if token:
-                    try:
-                        user = self.auth_backend.authenticate(request, token=token)
-                        if user:
-                            request.user = user
-                        else:
-                            request.user = AnonymousUser()
-                    except Exception as e:
-                        logger.error(f"Keycloak session authentication error: {e}")
-                        request.user = AnonymousUser()
-                else:
-                    request.user = AnonymousUser()
-            else:
-                # Session not available, set anonymous user
-                request.user = AnonymousUser()
-    
-    def process_response(self, request, response):
-        """
-        Process outgoing response
-        """
-        # Add CORS headers for Keycloak
-        response['Access-Control-Allow-Origin'] = '*'
-        response['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-        
-        return response
+            # Fall back to the claims digest verified earlier and kept in the session
+            claims = session_claims(request)
+            user = provision_user(claims) if claims else None
+            request.user = user or AnonymousUser()
     
     def _should_skip_auth(self, path):
         """
         Check if authentication should be skipped for this path
         """
-        skip_paths = [
-            '/admin/login/',
-            '/admin/logout/',
-            '/api/auth/',
-            '/health/',
-            '/static/',
-            '/media/',
-        ]
-        
-        return any(path.startswith(skip_path) for skip_path in skip_paths) 
\ No newline at end of file
+        return path.startswith(SKIP_AUTH_PREFIXES)
@@ -0,0 +1,270 @@
+"""
+Write-behind provisioning of Django users from verified Keycloak claims.
+
+Claims come from tokens verified against the realm's signing keys
+(keycloak_auth.verify_token) or from a session digest stored after such a
+check. A user seen for the first time is created inline, so requests always
+get a saved row; later changes to an existing user are served from the
+claims immediately and queued, coalesced per username and flushed in
+batched upserts by a background thread.
+"""
+import atexit
+import os
+import threading
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import close_old_connections, connection
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Fields owned by Keycloak and overwritten on every sync
+SYNCED_FIELDS = ('email', 'first_name', 'last_name', 'is_staff', 'is_superuser')
+
+# How many usernames to remember as already in sync
+SYNCED_CACHE_SIZE = 10000
+
+
+def user_fields(digest):
+    """
+    Map a claims digest onto User field values
+    """
+    from keycloak_config import ROLES
+    is_admin = ROLES['ADMIN'] in digest.get('roles', [])
+    return {
+        'email': digest.get('email') or '',
+        'first_name': digest.get('first_name') or '',
+        'last_name': digest.get('last_name') or '',
+        'is_staff': is_admin,
+        'is_superuser': is_admin,
+    }
+
+
+class ProvisioningQueue:
+    """
+    Pending user syncs keyed by username: a later sync for the same user
+    replaces the earlier one, so a login burst costs one write per user.
+    When `max_pending` users are waiting the enqueuing request flushes
+    inline, so the queue stays bounded.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=1.0, max_pending=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.flushed = 0
+        self.failed = 0
+        self._synced = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='user-provisioning', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Stop the worker after it has drained everything queued
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def restart_after_fork(self):
+        # The child has a copy of the queue but not the worker thread, and
+        # its locks and events may have been held by a parent thread
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.start()
+
+    def enqueue(self, username, fields):
+        """
+        Queue a sync unless the last flushed values for the user are the same.
+        Returns True when the caller must flush inline.
+        """
+        with self._lock:
+            if self._synced.get(username) == fields:
+                return False
+            self.pending[username] = fields
+            size = len(self.pending)
+        if size >= self.max_pending or not self.running:
+            return True
+        if size >= self.batch_size:
+            self._wakeup.set()
+        return False
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+        connection.close()
+
+    def flush(self):
+        """
+        Upsert every pending user in batches. Returns how many were written.
+        """
+        # One flush at a time, so an older batch never overwrites a newer one
+        with self._flush_lock:
+            with self._lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return 0
+            return self._write(batch)
+
+    def _write(self, batch):
+        close_old_connections()
+        User = get_user_model()
+        items = list(batch.items())
+        written = 0
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start:start + self.batch_size]
+            users = [
+                User(username=username, password=make_password(None), **fields)
+                for username, fields in chunk
+            ]
+            try:
+                User.objects.bulk_create(
+                    users,
+                    update_conflicts=True,
+                    unique_fields=['username'],
+                    update_fields=list(SYNCED_FIELDS),
+                )
+            except Exception:
+                logger.exception("User provisioning flush failed", extra={'users': len(chunk)})
+                self.failed += len(chunk)
+                self._requeue(chunk)
+                continue
+            written += len(chunk)
+            self._remember(chunk)
+        self.flushed += written
+        return written
+
+    def _requeue(self, chunk):
+        # Keep failed syncs unless a newer one arrived meanwhile
+        with self._lock:
+            for username, fields in chunk:
+                self.pending.setdefault(username, fields)
+
+    def _remember(self, chunk):
+        with self._lock:
+            for username, fields in chunk:
+                self._synced[username] = fields
+                self._synced.move_to_end(username)
+            while len(self._synced) > SYNCED_CACHE_SIZE:
+                self._synced.popitem(last=False)
+
+
+def _create_queue():
+    config = getattr(settings, 'USER_PROVISIONING', {})
+    provisioning_queue = ProvisioningQueue(
+        batch_size=config.get('batch_size', 200),
+        flush_interval=config.get('flush_interval', 1.0),
+        max_pending=config.get('max_pending', 10000),
+    )
+    if config.get('mode', 'write_behind') == 'write_behind':
+        provisioning_queue.start()
+        atexit.register(provisioning_queue.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=provisioning_queue.restart_after_fork)
+    return provisioning_queue
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = _create_queue()
+    return _queue
+
+
+def pending_count():
+    return len(_queue.pending) if _queue is not None else 0
+
+
+def synced_count():
+    return len(_queue._synced) if _queue is not None else 0
+
+
+def _apply_claims(user, fields):
+    """
+    Return (user, needs_sync) with the claim values applied in memory
+    """
+    if all(getattr(user, field) == value for field, value in fields.items()):
+        return user, False
+    for field, value in fields.items():
+        setattr(user, field, value)
+    return user, True
+
+
+def provision_user(digest):
+    """
+    Return the saved User for a verified claims digest.
+
+    Existing users get the claim values applied in memory and the update is
+    queued (written inline with USER_PROVISIONING['mode'] == 'sync'); users
+    not yet in the database are created on the spot.
+    """
+    username = digest.get('username')
+    if not username:
+        return None
+
+    fields = user_fields(digest)
+    User = get_user_model()
+    user = User.objects.filter(username=username).first()
+    if user is None:
+        user, created = User.objects.get_or_create(username=username, defaults={'password': make_password(None), **fields})
+        return user
+    user, needs_sync = _apply_claims(user, fields)
+    if needs_sync:
+        provisioning_queue = get_queue()
+        if provisioning_queue.enqueue(username, fields):
+            provisioning_queue.flush()
+    return user
+
+
+async def aprovision_user(digest):
+    """
+    Async counterpart of provision_user() for the ASGI read path
+    """
+    username = digest.get('username')
+    if not username:
+        return None
+
+    fields = user_fields(digest)
+    User = get_user_model()
+    user = await User.objects.filter(username=username).afirst()
+    if user is None:
+        user, created = await User.objects.aget_or_create(username=username, defaults={'password': make_password(None), **fields})
+        return user
+    user, needs_sync = _apply_claims(user, fields)
+    if needs_sync:
+        provisioning_queue = get_queue()
+        if provisioning_queue.enqueue(username, fields):
+            await sync_to_async(provisioning_queue.flush)()
+    return user
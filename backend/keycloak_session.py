@@ -0,0 +1,72 @@
+"""
+Compact, write-avoiding storage of Keycloak claims in the Django session
+"""
+import time
+
+CLAIMS_SESSION_KEY = 'keycloak_claims'
+
+# Keys written by earlier versions, which stored the full token in the session
+LEGACY_SESSION_KEYS = ('keycloak_token_info', 'keycloak_token')
+
+
+def claims_digest(token_info):
+    """
+    Reduce verified token claims to the few fields the app needs
+    """
+    return {
+        'sub': token_info.get('sub'),
+        'username': token_info.get('preferred_username'),
+        'email': token_info.get('email') or '',
+        'first_name': token_info.get('given_name', ''),
+        'last_name': token_info.get('family_name', ''),
+        'roles': sorted(token_info.get('realm_access', {}).get('roles', [])),
+        'exp': token_info.get('exp'),
+    }
+
+
+def store_claims(request, digest):
+    """
+    Attach the digest to the request and mirror it into an existing session.
+
+    New sessions are never created for bearer traffic, and the session is only
+    marked modified when the digest actually changed (e.g. after a token
+    refresh), so SessionMiddleware skips the save on almost every request.
+    """
+    request.keycloak_claims = digest
+    session = getattr(request, 'session', None)
+    if session is None or session.session_key is None:
+        return
+
+    if session.get(CLAIMS_SESSION_KEY) != digest:
+        session[CLAIMS_SESSION_KEY] = digest
+    for key in LEGACY_SESSION_KEYS:
+        if key in session:
+            del session[key]
+
+
+def session_claims(request):
+    """
+    Return the unexpired claims digest stored in the session, or None
+    """
+    session = getattr(request, 'session', None)
+    if session is None:
+        return None
+    digest = session.get(CLAIMS_SESSION_KEY)
+    if not digest or (digest.get('exp') or 0) <= time.time():
+        return None
+    return digest
+
+
+def get_request_claims(request):
+    """
+    Return the claims digest for the request: from the verified bearer token
+    if one was sent, otherwise from the session
+    """
+    digest = getattr(request, 'keycloak_claims', None)
+    if digest is None:
+        digest = session_claims(request)
+    return digest or {}
+
+
+def get_request_roles(request):
+    return get_request_claims(request).get('roles', [])